@@ -1,9 +1,11 @@
 #include <linux/init.h>
 #include <linux/kernel.h>
 #include <linux/module.h>
+#include <linux/string.h>
 #include <linux/time.h>
 #include <linux/types.h>
 #include <linux/version.h>
+#include <asm/tsc.h>
 
 #include "tsc.h"
 
@@ -28,6 +30,10 @@ MODULE_LICENSE("GPL");
 static int mode = 0;
 module_param(mode, int, 0);
 
+// if non-zero, also time each call and print a histogram of the latencies
+static int hist = 1;
+module_param(hist, int, 0);
+
 // define SNP or TDX for benchmarking
 // #define SNP
 // #define TDX
@@ -348,7 +354,90 @@ static inline void _cpuid(uint64_t rax, uint64_t rcx)
 #endif
 }
 
+// Log-linear histogram of per-call cycles: HIST_SUB buckets per power of two
+// (a relative bucket width of at most 25%).
+#define HIST_SUB_BITS 2
+#define HIST_SUB (1 << HIST_SUB_BITS)
+#define HIST_BUCKETS (64 * HIST_SUB)
+
+static uint64_t hist_count[HIST_BUCKETS];
+
+static inline unsigned int hist_bucket(uint64_t v)
+{
+	unsigned int msb;
+
+	if (v < HIST_SUB)
+		return v;
+	msb = fls64(v) - 1;
+	return ((msb - HIST_SUB_BITS + 1) << HIST_SUB_BITS) +
+	       ((v >> (msb - HIST_SUB_BITS)) & (HIST_SUB - 1));
+}
+
+// the smallest value of bucket b
+static inline uint64_t hist_low(unsigned int b)
+{
+	unsigned int shift;
+
+	if (b < HIST_SUB)
+		return b;
+	shift = (b >> HIST_SUB_BITS) - 1;
+	return (uint64_t)(HIST_SUB + (b & (HIST_SUB - 1))) << shift;
+}
+
+// cycles of an empty rdtsc_ordered() pair, subtracted from per-call samples
+static uint64_t hist_overhead(void)
+{
+	uint64_t overhead = U64_MAX;
+	uint64_t i;
+
+	for (i = 0; i < WARMUP_COUNT; i++) {
+		uint64_t start = rdtsc_ordered();
+		uint64_t end = rdtsc_ordered();
+
+		overhead = min(overhead, end - start);
+	}
+	return overhead;
+}
+
+// Per-call samples are taken with rdtsc_ordered() instead of __tsc_start()
+// because cpuid causes a VMEXIT itself.
+// Output (one line per non-empty bucket, [low, high) in cycles):
+//   bench: _cpuid_0, samples 100000, overhead 30, min_cycle 2600, max_cycle 90000, tsc_khz 2400000
+//   bench: _cpuid_0, hist 2560 3072 99000
+#define DEFINE_HIST(func)                                                                      \
+	static void hist_##func(void)                                                          \
+	{                                                                                      \
+		uint64_t N = BENCH_COUNT;                                                      \
+		uint64_t i = 0;                                                                \
+		uint64_t overhead = hist_overhead();                                           \
+		uint64_t min_cycles = U64_MAX;                                                 \
+		uint64_t max_cycles = 0;                                                       \
+		unsigned int b;                                                                \
+                                                                                               \
+		memset(hist_count, 0, sizeof(hist_count));                                     \
+		for (i = 0; i < N; i++) {                                                      \
+			uint64_t start = rdtsc_ordered();                                      \
+			func();                                                                \
+			uint64_t end = rdtsc_ordered();                                        \
+			uint64_t cycles = end - start;                                         \
+			cycles = cycles > overhead ? cycles - overhead : 0;                    \
+			min_cycles = min(min_cycles, cycles);                                  \
+			max_cycles = max(max_cycles, cycles);                                  \
+			hist_count[hist_bucket(cycles)]++;                                     \
+		}                                                                              \
+                                                                                               \
+		pr_info("%s, samples %llu, overhead %llu, min_cycle %llu, max_cycle %llu, tsc_khz %u\n", \
+			#func, N, overhead, min_cycles, max_cycles, tsc_khz);                  \
+		for (b = 0; b < HIST_BUCKETS; b++) {                                           \
+			if (!hist_count[b])                                                    \
+				continue;                                                      \
+			pr_info("%s, hist %llu %llu %llu\n", #func, hist_low(b),              \
+				hist_low(b + 1), hist_count[b]);                               \
+		}                                                                              \
+	}
+
 #define DEFINE_BENCH(func)                                                                        \
+	DEFINE_HIST(func)                                                                         \
 	static void bench_##func(void)                                                            \
 	{                                                                                         \
 		uint64_t N = 0;                                                                   \
@@ -375,6 +464,8 @@ static inline void _cpuid(uint64_t rax, uint64_t rcx)
 		pr_info("%s, total_cycle %llu, avg_cycle %llu, total_time %lld, avg_time %lld\n", \
 			#func, total_cycles, avg_cycles, total_time,                              \
 			avg_time);                                                                \
+		if (hist)                                                                         \
+			hist_##func();                                                            \
 	}
 
 #define DEFINE_CPUID_FUNC(func, rax)          \
@@ -129,6 +129,7 @@
                 python3.pkgs.click
                 python3.pkgs.seaborn
                 python3.pkgs.pandas
+                python3.pkgs.pyarrow
                 python3.pkgs.binary
                 python3.pkgs.lxml
                 python3.pkgs.ipython
@@ -50,6 +50,21 @@ in
     enable = true;
   };
 
+  # notify the host that the VM is ready (see QemuVm.wait_for_ssh() in tasks/qemu.py)
+  systemd.services."vm-ready" = {
+    description = "Notify the host that sshd is started";
+    wantedBy = [ "multi-user.target" ];
+    after = [ "sshd.service" ];
+    wants = [ "sshd.service" ];
+    serviceConfig.Type = "oneshot";
+    script = ''
+      port=/dev/virtio-ports/org.cvm-eval.ready
+      if [ -e $port ]; then
+        timeout 5 sh -c "echo ready > $port"
+      fi
+    '';
+  };
+
   # XXX: this systemd-networkd configuration seems not work, why?
   # systemd.network.enable = true;
   # # qemu network (for ssh)
@@ -2,7 +2,7 @@
 
 from invoke import Collection
 
-from . import utils, build, vm, memory
+from . import utils, build, vm, memory, store, compare
 from . import plot_phoronix_memory, plot_phoronix_npb, plot_application, plot_network
 from . import plot_boottime, plot_vmexit, plot_storage, plot_unixbench
 
@@ -11,6 +11,8 @@ ns.add_collection(Collection.from_module(utils))
 ns.add_collection(Collection.from_module(build))
 ns.add_collection(Collection.from_module(vm))
 ns.add_collection(Collection.from_module(memory))
+ns.add_collection(Collection.from_module(store), "results")
+ns.add_collection(Collection.from_module(compare))
 ns.add_collection(Collection.from_module(plot_phoronix_memory), "phoronix")
 ns.add_collection(Collection.from_module(plot_phoronix_npb), "npb")
 ns.add_collection(Collection.from_module(plot_application), "app")
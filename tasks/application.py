@@ -3,11 +3,12 @@
 
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 from subprocess import CalledProcessError
 
 from config import PROJECT_ROOT
 from qemu import QemuVm
+from repetition import repeat_runs
 from storage import mount_disk
 
 
@@ -29,13 +30,32 @@ def setup_disk(vm: QemuVm, fail_stop=True) -> bool:
     return True
 
 
+def result_time(
+    parse: Callable, name: str, file: Path, target_ci: Optional[float]
+) -> Optional[float]:
+    """Return the runtime in a log with a parse_*_result_sub() of plot_application.
+    Logs are only parsed for --repeat-ci; a log without a result gives None."""
+    if target_ci is None:
+        return None
+    try:
+        df = parse(name, file)
+    except (OSError, ValueError, UnboundLocalError):
+        df = None
+    if df is None:
+        return None
+    return float(df["time"][0])
+
+
 def run_blender(
     name: str,
     vm: QemuVm,
     repeat: int = 1,
+    target_ci: Optional[float] = None,
+    max_repeat: int = 20,
 ):
     """Run the blender benchmark on the VM.
     The results are saved in ./bench-result/application/blender/{name}/{date}/
+    With `target_ci`, repeat until the render time is stable (see repetition.py).
     """
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     outputdir = Path(f"./bench-result/application/blender/{name}/{date}/")
@@ -55,15 +75,21 @@ def run_blender(
         "run",
     ]
 
-    for i in range(repeat):
-        print(f"Running blender {i+1}/{repeat}")
+    def run(i: int) -> Optional[float]:
+        from plot_application import parse_blender_result_sub
+
+        print(f"Running blender {i}/{repeat}")
         output = vm.ssh_cmd(cmd)
         if output.returncode != 0:
             print(f"Error running blender: {output.stderr}")
-            continue
+            return None
         lines = output.stdout.split("\n")
-        with open(outputdir_host / f"{i+1}.log", "w") as f:
+        with open(outputdir_host / f"{i}.log", "w") as f:
             f.write("\n".join(lines))
+        log = outputdir_host / f"{i}.log"
+        return result_time(parse_blender_result_sub, name, log, target_ci)
+
+    repeat_runs(run, repeat, target_ci, max_repeat)
 
     print(f"Results saved in {outputdir_host}")
 
@@ -73,9 +99,12 @@ def run_tensorflow(
     vm: QemuVm,
     repeat: int = 1,
     thread_cnt: Optional[int] = None,
+    target_ci: Optional[float] = None,
+    max_repeat: int = 20,
 ):
     """Run the tensorflow benchmark on the VM.
     The results are saved in ./bench-result/application/tensorflow/{name}/{date}/
+    With `target_ci`, repeat until the runtime is stable (see repetition.py).
     """
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     outputdir = Path(f"./bench-result/application/tensorflow/{name}/{date}/")
@@ -103,20 +132,26 @@ def run_tensorflow(
         f"{thread_cnt}",
     ]
 
-    for i in range(repeat):
-        print(f"Running tensorflow {i+1}/{repeat}")
+    def run(i: int) -> Optional[float]:
+        from plot_application import parse_tensorflow_result_sub
+
+        print(f"Running tensorflow {i}/{repeat}")
         try:
             output = vm.ssh_cmd(cmd)
         except CalledProcessError as e:
             # Tensorflow may fail due to OOM, ignore that case
             print(f"Error running tensorflow: {e}")
-            continue
+            return None
         if output.returncode != 0:
             print(f"Error running tensorflow: {output.stderr}")
-            continue
+            return None
         lines = output.stdout.split("\n")
-        with open(outputdir_host / f"thread_{thread_cnt}-{i+1}.log", "w") as f:
+        log = outputdir_host / f"thread_{thread_cnt}-{i}.log"
+        with open(log, "w") as f:
             f.write("\n".join(lines))
+        return result_time(parse_tensorflow_result_sub, name, log, target_ci)
+
+    repeat_runs(run, repeat, target_ci, max_repeat)
 
     print(f"Results saved in {outputdir_host}")
 
@@ -126,9 +161,12 @@ def run_pytorch(
     vm: QemuVm,
     repeat: int = 1,
     thread_cnt: Optional[int] = None,
+    target_ci: Optional[float] = None,
+    max_repeat: int = 20,
 ):
     """Run the pytorch benchmark on the VM.
     The results are saved in ./bench-result/application/pytorch/{name}/{date}/
+    With `target_ci`, repeat until the runtime is stable (see repetition.py).
     """
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     outputdir = Path(f"./bench-result/application/pytorch/{name}/{date}/")
@@ -156,15 +194,21 @@ def run_pytorch(
         f"{thread_cnt}",
     ]
 
-    for i in range(repeat):
-        print(f"Running pytorch {i+1}/{repeat}")
+    def run(i: int) -> Optional[float]:
+        from plot_application import parse_pytorch_result_sub
+
+        print(f"Running pytorch {i}/{repeat}")
         output = vm.ssh_cmd(cmd)
         if output.returncode != 0:
             print(f"Error running pytorch: {output.stderr}")
-            continue
+            return None
         lines = output.stdout.split("\n")
-        with open(outputdir_host / f"thread_{thread_cnt}-{i+1}.log", "w") as f:
+        log = outputdir_host / f"thread_{thread_cnt}-{i}.log"
+        with open(log, "w") as f:
             f.write("\n".join(lines))
+        return result_time(parse_pytorch_result_sub, name, log, target_ci)
+
+    repeat_runs(run, repeat, target_ci, max_repeat)
 
     print(f"Results saved in {outputdir_host}")
 
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Host-side statistics of the virtio-blk of a storage benchmark
+(inv vm.start --virtio-blk <path> --action run-fio --blockstats).
+
+While fio runs in the guest, QEMU's block layer is sampled with the QMP
+command query-blockstats every --blockstats-interval seconds. Latency
+histograms are enabled before (block-latency-histogram-set). The samples are
+saved next to the fio result as fio/{name}/{job}/{date}.blockstats.jsonl, a
+line per sample:
+
+    {"time": 1.0, "stats": {"rd_operations": 10, "rd_total_time_ns": 900000,
+     "rd_latency_histogram": {"boundaries": [...], "bins": [...]}, ...}}
+
+"time" is seconds since the first sample. Counters are cumulative, so the
+difference of the last and the first sample covers the fio run. The host
+latency (request submission to completion in QEMU) against fio's latency in
+the guest shows how much of the I/O latency is added in the guest (e.g., by
+swiotlb bounce buffers of CVMs) instead of the host block layer.
+"""
+
+import json
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, IO, List, Optional, Sequence
+
+import numpy as np
+
+import histogram
+
+# histogram bucket boundaries [ns]: 1us to 1s
+LATENCY_BOUNDARIES = [int(m * 10**e) for e in range(3, 9) for m in (1, 2, 5)] + [10**9]
+
+PERCENTILES = [50, 90, 99]
+
+# prefix of the counters in query-blockstats -> direction
+DIRECTIONS = {"rd": "read", "wr": "write", "flush": "flush"}
+
+Send = Callable[[str, Dict[str, Any]], Dict[str, Any]]
+
+
+def qdev_path(device_id: str) -> str:
+    """QOM path of the virtio-blk device of a virtio-blk-pci with `device_id`,
+    used by QMP block commands and as "qdev" of query-blockstats"""
+    return f"/machine/peripheral/{device_id}/virtio-backend"
+
+
+class BlockStatsSampler:
+    def __init__(self, send: Send, qdev: str, interval: float, output: Path) -> None:
+        self.send = send
+        self.qdev = qdev
+        self.interval = interval
+        self.output = output
+        self.thread: Optional[threading.Thread] = None
+        self.done = threading.Event()
+        self.out: Optional[IO[str]] = None
+        self.start_time = 0.0
+
+    def sample(self) -> Dict[str, Any]:
+        for entry in self.send("query-blockstats", {})["return"]:
+            if entry.get("qdev") == self.qdev:
+                return entry["stats"]
+        raise ValueError(f"No block device {self.qdev} in query-blockstats")
+
+    def write_sample(self) -> None:
+        assert self.out is not None
+        t = time.monotonic() - self.start_time
+        self.out.write(json.dumps(dict(time=round(t, 3), stats=self.sample())) + "\n")
+
+    def run(self) -> None:
+        while True:
+            self.write_sample()
+            if self.done.wait(self.interval):
+                break
+
+    def start(self) -> None:
+        """Reset the latency histograms and start sampling in a thread"""
+        self.send(
+            "block-latency-histogram-set",
+            {"id": self.qdev, "boundaries": LATENCY_BOUNDARIES},
+        )
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+        self.out = open(self.output, "w")
+        self.start_time = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name="blockstats")
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Take a last sample and stop"""
+        assert self.thread is not None and self.out is not None
+        self.done.set()
+        self.thread.join()
+        self.write_sample()
+        self.out.close()
+        print(f"[blockstats] saved {self.output}")
+
+
+def load_samples(file: Path) -> List[Dict[str, Any]]:
+    with open(file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def hist_percentiles(
+    boundaries: Sequence[int], bins: Sequence[int], percentiles: Sequence[float]
+) -> np.ndarray:
+    """Percentiles [ns] of a latency histogram of query-blockstats. The
+    unbounded last bucket gives its lower boundary."""
+    low = [0] + list(boundaries)
+    high = list(boundaries) + [boundaries[-1]]
+    return histogram.percentiles(low, high, bins, percentiles)
+
+
+def summarize(
+    samples: List[Dict[str, Any]], percentiles: Sequence[float] = PERCENTILES
+) -> Dict[str, float]:
+    """Operations, bytes, IOPS, bandwidth [B/s] and latency [ns] per direction
+    between the first and the last sample, e.g., {"read_iops": ...}"""
+    first, last = samples[0]["stats"], samples[-1]["stats"]
+    duration = samples[-1]["time"] - samples[0]["time"]
+    summary: Dict[str, float] = {}
+    for prefix, direction in DIRECTIONS.items():
+        ops = last[f"{prefix}_operations"] - first[f"{prefix}_operations"]
+        if ops == 0:
+            continue
+        total_ns = last[f"{prefix}_total_time_ns"] - first[f"{prefix}_total_time_ns"]
+        summary[f"{direction}_ops"] = ops
+        summary[f"{direction}_lat_mean"] = total_ns / ops
+        if duration > 0:
+            summary[f"{direction}_iops"] = ops / duration
+        if prefix != "flush":
+            nbytes = last[f"{prefix}_bytes"] - first[f"{prefix}_bytes"]
+            summary[f"{direction}_bytes"] = nbytes
+            if duration > 0:
+                summary[f"{direction}_bw"] = nbytes / duration
+        hist = last.get(f"{prefix}_latency_histogram")
+        if hist is not None:
+            # the histograms were reset when sampling started
+            ps = hist_percentiles(hist["boundaries"], hist["bins"], percentiles)
+            for p, v in zip(percentiles, ps):
+                summary[f"{direction}_lat_p{p:g}"] = v
+    return summary
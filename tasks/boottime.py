@@ -1,72 +1,296 @@
-from datetime import datetime
-from typing import Any, Optional, List
-from pathlib import Path
+import json
 import os
 import re
+import select
+import signal
 import subprocess
 import time
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
 
 from config import PROJECT_ROOT
 from qemu import spawn_qemu, QemuVm
+from repetition import repeat_runs
+
+SCRIPT_DIR = PROJECT_ROOT / "benchmarks" / "boottime"
+
+# event codes of boot_time_eval*.bt: guest events are the values written to
+# the benchmark port, QEMU events are >= 1000
+EVENTS = {
+    0: "OVMF: PEI main start",
+    1: "OVMF: PEI main end",
+    100: "OVMF: DXE main end",
+    101: "OVMF: DXE main start",
+    102: "OVMF: EXITBOOTSERVICE",
+    230: "Linux: kernel_start",
+    231: "Linux: init_start",
+    240: "Linux: systemd init end",
+    1000: "QEMU: main",
+    1001: "QEMU: exit",
+    1002: "QEMU: sev_kvm_init",
+    1003: "QEMU: sev_kvm_init done",
+    1004: "QEMU: kvm_arch_init",
+    1005: "QEMU: kvm_arch_init done",
+    1006: "QEMU: memory_region_init_rom_device",
+    1007: "QEMU: memory_region_init_rom_device done",
+    1008: "QEMU: sev_snp_launch_finish",
+    1009: "QEMU: sev_snp_launch_finish done",
+    1010: "QEMU: kvm_cpu_exec",
+    1011: "QEMU: qemu_prealloc_mem",
+    1012: "QEMU: qemu_prealloc_mem done",
+    1013: "QEMU: tdx_finalize_vm",
+    1014: "QEMU: tdx_finalize_vm done",
+}
+QEMU_EVENT_BASE = 1000
+
+# counters of the scripts (map name -> label in the result), counted per
+# FAULT_INTERVAL_NS
+COUNTERS = {"@faults": "KVM: page faults", "@psc": "KVM: psc"}
+FAULT_INTERVAL_NS = 50_000_000
+# max_map_keys of the scripts; a full counter map means the counts are truncated
+MAX_MAP_KEYS = 32768
+
+
+@dataclass(order=True)
+class BootEvent:
+    ns: int  # bpftrace's nsecs (CLOCK_MONOTONIC)
+    code: int
+
+    @property
+    def name(self) -> str:
+        return EVENTS.get(self.code, f"unknown event {self.code}")
+
+    def line(self) -> str:
+        """The line the scripts used to print (see plot_boottime.parse_result())"""
+        if self.code >= QEMU_EVENT_BASE:
+            return f"{self.ns}: {self.name}\n"
+        return f"{self.ns}: {self.code} {self.name}\n"
+
+
+@dataclass
+class BootTrace:
+    events: List[BootEvent]
+    # counter label -> {interval start (ns): count}
+    counters: Dict[str, Dict[int, int]]
+
+    def lines(self) -> List[str]:
+        """Events and counters ordered by time, e.g.,
+        1407585682513340: 0 OVMF: PEI main start
+        1407585690000000: KVM: page faults 1234"""
+        lines = [(e.ns, e.line()) for e in self.events]
+        for label, counts in self.counters.items():
+            lines += [(ns, f"{ns}: {label} {n}\n") for ns, n in counts.items()]
+        return [line for _, line in sorted(lines)]
+
+
+def trace_script(type: str) -> Path:
+    # Intel VMs and TDs use the TDX QEMU, which has no SEV functions to probe
+    tdx = type.startswith("tdx") or type.startswith("intel")
+    return SCRIPT_DIR / ("boot_time_eval_tdx.bt" if tdx else "boot_time_eval.bt")
+
+
+def qemu_binary(qemu: str) -> Path:
+    qemu_path = Path(qemu)
+    # QEMU built with nix is wrapped. Get the actual binary path to trace
+    if os.listdir(qemu_path.parent).count(".qemu-system-x86_64-wrapped") > 0:
+        qemu_path = qemu_path.parent / ".qemu-system-x86_64-wrapped"
+    return qemu_path
+
+
+class BootTracer:
+    """Run a boot_time_eval*.bt script with the QEMU binary as $1.
+    bpftrace runs with JSON output, so that the attachment of its probes and
+    the recorded events (the @events map printed on exit) are read as JSON.
+    Events are keyed by the QEMU PID, so VMs booting concurrently (e.g.,
+    inv vm.boot-sweep) do not mix up."""
+
+    def __init__(self, script: Path, qemu: Path) -> None:
+        self.script = script
+        self.qemu = qemu
+        self.proc: Optional[subprocess.Popen] = None
+        # output read by start() after the attached_probes message
+        self.pending = ""
+
+    def start(self, timeout: float = 60) -> None:
+        """Start bpftrace and return once its probes are attached"""
+        self.proc = subprocess.Popen(
+            ["bpftrace", "-f", "json", str(self.script), str(self.qemu)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        assert self.proc.stdout is not None and self.proc.stderr is not None
+        # read the fd directly: with readline(), lines in Python's buffer are
+        # not seen by select()
+        fd = self.proc.stdout.fileno()
+        buf = b""
+        deadline = time.monotonic() + timeout
+        while True:
+            if b"\n" not in buf:
+                remaining = deadline - time.monotonic()
+                ready, _, _ = select.select([fd], [], [], max(remaining, 0))
+                if not ready:
+                    self.kill()
+                    raise TimeoutError("bpftrace did not attach its probes")
+                data = os.read(fd, 65536)
+                if not data:
+                    self.proc.wait()
+                    raise RuntimeError(f"bpftrace failed: {self.proc.stderr.read()}")
+                buf += data
+                continue
+            line, buf = buf.split(b"\n", 1)
+            if line.strip() and json.loads(line).get("type") == "attached_probes":
+                self.pending = buf.decode()
+                return
+
+    def kill(self) -> None:
+        """Kill bpftrace (e.g., if the VM failed) without reading its output"""
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.communicate()
+
+    def stop(self, pid: Optional[int] = None, timeout: float = 60) -> BootTrace:
+        """Stop bpftrace and return the recorded events (ordered by time) and
+        counters of the QEMU process `pid` (of all processes if None)"""
+        assert self.proc is not None
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            out, err = self.proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            out, err = self.proc.communicate()
+        out = self.pending + out
+        if self.proc.returncode != 0:
+            print(f"bpftrace failed with return code {self.proc.returncode}")
+            print(err)
+        maps: Dict[str, Dict[str, int]] = {}
+        for line in out.splitlines():
+            msg = json.loads(line)
+            if msg.get("type") == "map":
+                maps.update(msg["data"])
+
+        def entries(name: str) -> List[Tuple[int, int]]:
+            # keys are "nsecs,pid" (@events) or "pid,interval" (counters)
+            result = []
+            for key, value in maps.get(name, {}).items():
+                a, b = (int(k) for k in re.findall(r"\d+", key))
+                key_pid, x = (b, a) if name == "@events" else (a, b)
+                if pid is None or key_pid == pid:
+                    result.append((x, int(value)))
+            return result
+
+        for name in COUNTERS:
+            if len(maps.get(name, {})) >= MAX_MAP_KEYS:
+                print(f"WARN: {name} has {MAX_MAP_KEYS} keys; counts are truncated")
+        events = sorted(BootEvent(ns, code) for ns, code in entries("@events"))
+        counters = {
+            label: {i * FAULT_INTERVAL_NS: n for i, n in sorted(entries(name))}
+            for name, label in COUNTERS.items()
+            if name in maps
+        }
+        return BootTrace(events, counters)
+
+
+def save_trace(trace: BootTrace, ready_ns: int, outfile: Path) -> None:
+    """Save the trace in the text format of the scripts (read by plot_boottime
+    and the result store) and as JSON next to it ({i}.txt and {i}.json)"""
+    with open(outfile, "w") as f:
+        f.writelines(trace.lines())
+        # same clock as bpftrace's nsecs (CLOCK_MONOTONIC)
+        f.write(f"{ready_ns}: HOST: ssh ready\n")
+    with open(outfile.with_suffix(".json"), "w") as f:
+        records = [dict(ns=e.ns, code=e.code, event=e.name) for e in trace.events]
+        counters = {
+            label: [[ns, n] for ns, n in counts.items()]
+            for label, counts in trace.counters.items()
+        }
+        data = dict(events=records, counters=counters, ssh_ready_ns=ready_ns)
+        json.dump(data, f, indent=2)
 
 
 def boot_test(qemu_cmd: List[str], pin: bool, outfile=None, **kargs: Any) -> None:
     """Start a VM and wait for the VM to boot and then terminate the VM."""
     resource = kargs["config"]["resource"]
     vmconfig = kargs["config"]["vmconfig"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
     trace: bool = kargs["config"].get("boot_trace", True)
 
+    tracer = None
     if trace:
-        trace_script = f"{PROJECT_ROOT}/benchmarks/boottime/boot_time_eval.bt"
-        code = []
-        qemu_path = Path(vmconfig.qemu)
-        # QEMU built with nix is wrapped. Get the actual binary path to trace
-        if os.listdir(qemu_path.parent).count(".qemu-system-x86_64-wrapped") > 0:
-            qemu_path = qemu_path.parent / ".qemu-system-x86_64-wrapped"
-        # replace the qemu path in the bpftrace script
-        pat = re.compile(r"(ur?):.*qemu-system-x86_64.*:(.*)")
-        with open(trace_script) as f:
-            for line in f.readlines():
-                m = pat.match(line)
-                if m:
-                    new_path = f"{m.group(1)}:{qemu_path}:{m.group(2)}"
-                    line = line.replace(m.group(0), new_path)
-                code.append(line.encode())
-
-        cmd = ["bpftrace", "-"]  # read program code from stdin
-        bpftrace = subprocess.Popen(
-            cmd,
-            shell=False,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        bpftrace.stdin.writelines(code)
-        bpftrace.stdin.close()  # send EOF
-        time.sleep(3)  # ensure loading of BPF program
-
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        time.sleep(10)
-        vm.wait_for_ssh()
-        vm.shutdown()
-
-    # get output from bpftrace process
-    if trace:
-        bpftrace.terminate()
-        bpftrace.wait()
-        if bpftrace.returncode != 0:
-            err = bpftrace.stderr.read().decode()
-            print(f"bpftrace failed with return code {bpftrace.returncode}")
-            print(err)
+        script = trace_script(kargs["config"]["type"])
+        tracer = BootTracer(script, qemu_binary(vmconfig.qemu))
+        tracer.start()
+
+    vm: QemuVm
+    try:
+        with spawn_qemu(
+            qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
+        ) as vm:
+            if pin:
+                vm.pin(kargs["config"]["pin_plan"])
+            ready_ns = vm.wait_for_ssh()
+            vm.shutdown()
+            qemu_pid = vm.pid
+    except BaseException:
+        # do not leave bpftrace running with its probes attached
+        if tracer is not None:
+            tracer.kill()
+        raise
+
+    # QEMU has exited here, so all events are recorded
+    if tracer is not None:
+        boot_trace = tracer.stop(qemu_pid)
         if outfile:
-            with open(outfile, "w") as f:
-                f.write(bpftrace.stdout.read().decode())
+            save_trace(boot_trace, ready_ns, Path(outfile))
+
+
+def total_boot_time(file: Path) -> Optional[float]:
+    """Return the boot time (QEMU start to the end of init) in seconds"""
+    from plot_boottime import parse_result
+
+    try:
+        with open(file) as f:
+            return float(sum(parse_result(f.readlines())))
+    except (OSError, AssertionError, UnboundLocalError) as e:
+        print(f"Failed to parse {file}: {e!r}")
+        return None
+
+
+def perturbation(
+    parallel: str,
+    serial: str,
+    result_dir: Path,
+    alpha: float = 0.05,
+    threshold: float = 5.0,
+) -> pd.DataFrame:
+    """Compare the latest boot times of `parallel` (booted next to other VMs)
+    with those of its serial control `serial` per phase and in total (see
+    compare.compare()). A phase is perturbed if the difference is significant
+    and larger than `threshold` %."""
+    import store
+    from compare import compare
+    from plot_boottime import PHASES
+
+    def latest(name: str) -> pd.DataFrame:
+        df = store.query(result_dir, "boottime", name=name)
+        if len(df) == 0:
+            return df
+        df = df[df["date"] == store.select_dates(df)[0]]
+        df = df[df["metric"].isin(PHASES)]
+        first = {c: "first" for c in df.columns if c not in ["run", "value"]}
+        total = df.groupby("run", as_index=False, sort=False).agg(
+            {**first, "value": "sum"}
+        )
+        return pd.concat([df, total.assign(metric="total")], ignore_index=True)
+
+    result = compare(latest(serial), latest(parallel))
+    result["perturbed"] = (result["p_value"] < alpha) & (
+        result["overhead"].abs() > threshold
+    )
+    return result
 
 
 def run_boot_test(
@@ -74,16 +298,26 @@ def run_boot_test(
 ) -> None:
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     repeat: int = kargs["config"].get("repeat", 1)
+    target_ci: Optional[float] = kargs["config"].get("repeat_ci")
+    max_repeat: int = kargs["config"].get("repeat_max", 20)
     trace: bool = kargs["config"].get("boot_trace", True)
 
     outputdir = Path(f"{PROJECT_ROOT}/bench-result/boottime/{name}/{date}")
     if trace:
         outputdir.mkdir(parents=True, exist_ok=True)
+    elif target_ci is not None:
+        print("WARN: --repeat-ci needs the boot trace, run --repeat times")
+        target_ci = None
 
-    for i in range(repeat):
-        outfile = outputdir / f"{i+1}.txt"
+    def run(i: int) -> Optional[float]:
+        outfile = outputdir / f"{i}.txt"
         boot_test(qemu_cmd, pin, outfile, **kargs)
         time.sleep(1)
+        if target_ci is None:
+            return None
+        return total_boot_time(outfile)
+
+    repeat_runs(run, repeat, target_ci, max_repeat)
 
     if trace:
         print(f"Output written to {outputdir}")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Host- and guest-side collectors (perf, mpstat, vmstat, iostat) that run
+while a benchmark action runs (inv vm.start --collect perf --collect mpstat).
+
+Collectors are started when the VM of the action is ready and stopped with
+SIGINT when the action finishes. Their output is saved in
+./trace-result/{action}/{name}/{date}/{host,guest}/ where {date} is the date
+of the result the action saved under bench-result/ (see matrix.result_dir()),
+so that traces and results of a run can be matched. run.json in the same
+directory records the result path.
+
+With --vmexit-profile, a VM-exit profile of the QEMU process is recorded in
+the same window and saved as host/vmexit.json (see vmexit_profile.py). It is
+not written into bench-result/ because plot tasks read every file of a result
+directory.
+
+The guest writes to /share/trace-result/, i.e., the same directory.
+"""
+
+import json
+import signal
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from config import PROJECT_ROOT
+from qemu import QemuVm
+
+TRACE_DIR = PROJECT_ROOT / "trace-result"
+GUEST_TRACE_DIR = Path("/share/trace-result")
+
+COLLECTORS = ["perf", "mpstat", "vmstat", "iostat"]
+
+# long enough for any benchmark; perf is stopped with SIGINT
+GUEST_PERF_DURATION = 24 * 3600
+
+
+def host_cmd(collector: str, outdir: Path, interval: int) -> List[str]:
+    return {
+        "perf": ["perf", "record", "-a", "-g", "-o", str(outdir / "perf.data")],
+        "mpstat": ["mpstat", "-P", "ALL", str(interval)],
+        "vmstat": ["vmstat", "-t", "-w", str(interval)],
+        "iostat": ["iostat", "-d", "-k", "-x", "-y", str(interval)],
+    }[collector]
+
+
+def guest_cmd(collector: str, outdir: Path, interval: int) -> str:
+    return {
+        # same as trace/perf.sh
+        "perf": "just -f /share/justfile perf-record "
+        f"{GUEST_PERF_DURATION} {outdir}/perf.data",
+        "mpstat": f"mpstat -P ALL {interval} > {outdir}/mpstat.txt",
+        "vmstat": f"vmstat -t -w {interval} > {outdir}/vmstat.txt",
+        "iostat": f"iostat -d -k -x -y {interval} > {outdir}/iostat.txt",
+    }[collector]
+
+
+def start_host(
+    collectors: List[str], outdir: Path, interval: int
+) -> List[subprocess.Popen]:
+    outdir.mkdir(parents=True, exist_ok=True)
+    procs = []
+    for c in collectors:
+        out = open(outdir / f"{c}.txt", "w") if c != "perf" else subprocess.DEVNULL
+        procs.append(
+            subprocess.Popen(
+                host_cmd(c, outdir, interval),
+                stdout=out,
+                stderr=subprocess.DEVNULL,
+                # do not get Ctrl-C of the terminal before the benchmark is done
+                start_new_session=True,
+            )
+        )
+        if c != "perf":
+            out.close()
+    return procs
+
+
+def stop_host(procs: List[subprocess.Popen], timeout: float = 60) -> None:
+    for p in procs:
+        p.send_signal(signal.SIGINT)
+    for p in procs:
+        try:
+            p.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+
+def start_guest(vm: QemuVm, collectors: List[str], outdir: Path, interval: int) -> None:
+    vm.ssh_cmd(["mkdir", "-p", str(outdir)])
+    for c in collectors:
+        cmd = guest_cmd(c, outdir, interval)
+        script = f"cd {outdir} && nohup sh -c '{cmd}' > /dev/null 2>&1 &"
+        vm.ssh_cmd(["sh", "-c", script])
+
+
+def stop_guest(vm: QemuVm, collectors: List[str]) -> None:
+    for c in collectors:
+        vm.ssh_cmd(["pkill", "-INT", "-x", c], check=False)
+    # wait until perf has written perf.data
+    if "perf" in collectors:
+        wait = "for i in $(seq 60); do pgrep -x perf || exit 0; sleep 1; done"
+        vm.ssh_cmd(["sh", "-c", wait], check=False, stdout=subprocess.DEVNULL)
+
+
+def result_entry(
+    action: str, name: str, config: Dict[str, Any], since: str
+) -> Optional[Path]:
+    """Return the first result of `action` saved at or after the date `since`"""
+    from matrix import is_result, result_dir
+
+    path = result_dir(action, name, config)
+    if path is None or not path.is_dir():
+        return None
+    entries = [
+        p for p in path.iterdir() if p.name.split(".")[0] >= since and is_result(p)
+    ]
+    return min(entries, key=lambda p: p.name, default=None)
+
+
+@contextmanager
+def collecting(vm: QemuVm, config: Dict[str, Any]) -> Iterator[None]:
+    """Run the collectors of --collect on the host and in the guest during the
+    context (the current action of config)"""
+    collectors: List[str] = config.get("collect", [])
+    vmexit: bool = config.get("vmexit_profile", False)
+    if not collectors and not vmexit:
+        yield
+        return
+    unknown = set(collectors) - set(COLLECTORS)
+    if unknown:
+        raise ValueError(f"Unknown collectors: {sorted(unknown)} ({COLLECTORS})")
+
+    action: str = config["current_action"]
+    name: str = config["name"]
+    interval: int = config.get("collect_interval", 1)
+    guest: bool = config.get("collect_guest", True)
+    run_id = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    rel = Path(action) / name / run_id
+
+    names = collectors + ["vmexit"] * vmexit
+    print(f"[collect] start {', '.join(names)} (run {run_id})")
+    procs = start_host(collectors, TRACE_DIR / rel / "host", interval)
+    if guest and collectors:
+        start_guest(vm, collectors, GUEST_TRACE_DIR / rel / "guest", interval)
+    profiler = None
+    if vmexit:
+        from vmexit_profile import VmexitProfiler
+
+        raw = TRACE_DIR / rel / "host" / "vmexit.txt"
+        profiler = VmexitProfiler(config["type"], vm.pid, raw)
+        try:
+            profiler.start()
+        except BaseException:
+            # do not leave the collectors started above running
+            if guest and collectors:
+                stop_guest(vm, collectors)
+            stop_host(procs)
+            raise
+    try:
+        yield
+    finally:
+        profile = profiler.stop() if profiler is not None else None
+        if guest and collectors:
+            stop_guest(vm, collectors)
+        stop_host(procs)
+        outdir = TRACE_DIR / rel
+        if "perf" in collectors:
+            host = outdir / "host"
+            with open(host / "report.txt", "w") as f:
+                cmd = ["perf", "report", "-i", str(host / "perf.data"), "--no-children"]
+                subprocess.run(cmd, stdout=f, stderr=subprocess.DEVNULL)
+        # use the date of the benchmark result as the run ID
+        entry = result_entry(action, name, config, run_id)
+        if entry is not None:
+            date = entry.name.split(".")[0]
+            if date != run_id and not (outdir.parent / date).exists():
+                outdir = outdir.rename(outdir.parent / date)
+        if profile is not None:
+            from vmexit_profile import save_profile
+
+            save_profile(profile, outdir / "host" / "vmexit.json")
+        with open(outdir / "run.json", "w") as f:
+            json.dump(
+                dict(
+                    action=action,
+                    name=name,
+                    collectors=collectors,
+                    vmexit_profile=vmexit,
+                    start=run_id,
+                    result=str(entry.relative_to(PROJECT_ROOT)) if entry else None,
+                ),
+                f,
+                indent=2,
+            )
+        print(f"[collect] saved in {outdir}")
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Compare two result sets (e.g., a VM and a CVM) across all benchmarks.
+
+Results are taken from the result store (store.py) and compared per
+(benchmark, tags, metric, param) group:
+
+- medians of the baseline and the target, and relative = target / baseline
+- a bootstrap confidence interval of the relative median
+- a bootstrap p-value of "relative == 1"
+- overhead [%] of the target: positive means the target is worse
+
+and per benchmark (and overall), the geometric mean of the relative values.
+The bootstrap is vectorized over resamples and groups with NumPy.
+"""
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from invoke import task
+
+GROUP = ["benchmark", "tags", "metric", "param"]
+
+# benchmarks and metric substrings for which a smaller value is better
+LOWER_IS_BETTER_BENCHMARKS = ["ping", "boottime", "vmexit"]
+LOWER_IS_BETTER_METRICS = ["lat", "time"]
+
+# benchmarks whose param is a run identifier (e.g., the VM name) instead of a
+# parameter of the benchmark, so it is not used for grouping
+IGNORE_PARAM = ["phoronix"]
+
+# upper bound of elements of a bootstrap array (memory use: 8 bytes each)
+CHUNK_ELEMENTS = 1 << 22
+
+
+def lower_is_better(benchmark: str, metric: str, better: str = "") -> bool:
+    """`better` is the orientation recorded by the result file (store column
+    "better", e.g., phoronix's Proportion), which takes precedence over the
+    name-based guess"""
+    if better:
+        return better == "lower"
+    if benchmark in LOWER_IS_BETTER_BENCHMARKS:
+        return True
+    return any(m in metric.lower() for m in LOWER_IS_BETTER_METRICS)
+
+
+def geomean(values: Any) -> float:
+    return float(np.exp(np.mean(np.log(np.asarray(values, dtype=float)))))
+
+
+def overhead(relative: Any, lower_better: Any) -> Any:
+    """Overhead [%] of a target with relative = target / baseline"""
+    relative = np.asarray(relative, dtype=float)
+    return np.where(lower_better, relative - 1, 1 - relative) * 100
+
+
+def pad(groups: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Return a (groups, max size) array padded with NaN and the group sizes"""
+    sizes = np.array([len(g) for g in groups])
+    x = np.full((len(groups), max(sizes.max(initial=0), 1)), np.nan)
+    for i, g in enumerate(groups):
+        x[i, : len(g)] = g
+    return x, sizes
+
+
+def sorted_median(x: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """Median over the last axis of x (groups, ..., width), where group i has
+    sizes[i] values and is padded with NaN (faster than np.nanmedian)"""
+    x = np.sort(x, axis=-1)
+    shape = (len(sizes),) + (1,) * (x.ndim - 1)
+    lo = np.take_along_axis(x, ((sizes - 1) // 2).reshape(shape), axis=-1)
+    hi = np.take_along_axis(x, (sizes // 2).reshape(shape), axis=-1)
+    return ((lo + hi) / 2)[..., 0]
+
+
+def bootstrap_medians(
+    x: np.ndarray, sizes: np.ndarray, resamples: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Medians of `resamples` bootstrap samples of each row of the padded x.
+    Return a (groups, resamples) array."""
+    groups, width = x.shape
+    out = np.empty((groups, resamples))
+    step = max(1, CHUNK_ELEMENTS // (resamples * width))
+    for s in range(0, groups, step):
+        xs, n = x[s : s + step], sizes[s : s + step]
+        shape = (len(xs), resamples, width)
+        # sample indices in [0, n) of each group; columns >= n are padding
+        idx = (rng.random(shape) * n[:, None, None]).astype(np.int64)
+        samples = np.take_along_axis(
+            np.broadcast_to(xs[:, None, :], shape), idx, axis=2
+        )
+        padding = np.arange(width)[None, None, :] >= n[:, None, None]
+        out[s : s + step] = sorted_median(np.where(padding, np.nan, samples), n)
+    return out
+
+
+def compare(
+    base: pd.DataFrame,
+    target: pd.DataFrame,
+    resamples: int = 2000,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> pd.DataFrame:
+    """Compare two long-format result sets (store rows) group by group.
+    Only groups present in both sets are compared."""
+
+    def prepare(df: pd.DataFrame) -> pd.DataFrame:
+        df = df[np.isfinite(df["value"])]
+        return df.assign(
+            param=df["param"].where(~df["benchmark"].isin(IGNORE_PARAM), "")
+        )
+
+    def by_group(df: pd.DataFrame) -> Dict[tuple, np.ndarray]:
+        return {k: g["value"].to_numpy() for k, g in df.groupby(GROUP, sort=True)}
+
+    base, target = prepare(base), prepare(target)
+    b, t = by_group(base), by_group(target)
+    # orientation recorded by the result files, if any
+    better: Dict[tuple, str] = {}
+    if "better" in base.columns:
+        for df in [target, base]:
+            marked = df[df["better"] != ""]
+            better.update(marked.groupby(GROUP)["better"].first().to_dict())
+    keys = [k for k in b if k in t]
+    columns = GROUP + ["n_base", "n_target", "median_base", "median_target"]
+    columns += ["relative", "ci_low", "ci_high", "p_value"]
+    columns += ["lower_is_better", "overhead"]
+    if not keys:
+        return pd.DataFrame(columns=columns)
+
+    xb, nb = pad([b[k] for k in keys])
+    xt, nt = pad([t[k] for k in keys])
+    med_b = np.nanmedian(xb, axis=1)
+    med_t = np.nanmedian(xt, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative = med_t / med_b
+
+        rng = np.random.default_rng(seed)
+        ratios = bootstrap_medians(xt, nt, resamples, rng) / bootstrap_medians(
+            xb, nb, resamples, rng
+        )
+    alpha = 1 - confidence
+    ci_low, ci_high = np.nanquantile(ratios, [alpha / 2, 1 - alpha / 2], axis=1)
+    # two-sided: how often the resampled relative is on the other side of 1
+    below = np.mean(ratios <= 1, axis=1)
+    above = np.mean(ratios >= 1, axis=1)
+    p_value = np.minimum(1.0, 2 * np.minimum(below, above))
+    # a single sample on either side tells nothing about the variance
+    p_value[(nb < 2) | (nt < 2)] = np.nan
+
+    df = pd.DataFrame(keys, columns=GROUP)
+    lower = np.array([lower_is_better(k[0], k[2], better.get(k, "")) for k in keys])
+    df["n_base"], df["n_target"] = nb, nt
+    df["median_base"], df["median_target"] = med_b, med_t
+    df["relative"], df["ci_low"], df["ci_high"] = relative, ci_low, ci_high
+    df["p_value"] = p_value
+    df["lower_is_better"] = lower
+    df["overhead"] = overhead(relative, lower)
+    return df[columns]
+
+
+def summarize(df: pd.DataFrame) -> pd.DataFrame:
+    """Geometric mean of the relative values and its overhead per benchmark.
+    If smaller is better for some metrics and larger for others (e.g., "all"),
+    relative values are oriented as target cost / baseline cost first."""
+    df = df[np.isfinite(df["relative"]) & (df["relative"] > 0)]
+    rows = []
+    for benchmark, g in [*df.groupby("benchmark"), ("all", df)]:
+        if len(g) == 0:
+            continue
+        lower = g["lower_is_better"].to_numpy(dtype=bool)
+        if lower.all() or not lower.any():
+            gm = geomean(g["relative"])
+            ov = float(overhead(gm, lower[0]))
+        else:
+            gm = np.nan
+            ov = (geomean(np.where(lower, g["relative"], 1 / g["relative"])) - 1) * 100
+        rows.append(dict(benchmark=benchmark, groups=len(g), geomean=gm, overhead=ov))
+    return pd.DataFrame(rows)
+
+
+@task
+def table(
+    ctx: Any,
+    baseline: str,  # VM name, e.g., amd-direct-medium
+    target: str,  # VM name, e.g., snp-direct-medium
+    benchmark: Optional[str] = None,  # only compare this benchmark
+    result_dir: str = "./bench-result",
+    resamples: int = 2000,
+    confidence: float = 0.95,
+    alpha: float = 0.05,  # significance level
+    seed: int = 0,
+    output: Optional[str] = None,  # save the table as CSV
+) -> None:
+    """Compare all results of two VMs in the result store"""
+    import store
+
+    s = store.get_store(Path(result_dir))
+    df = s.query(benchmark) if benchmark else s.df[s.df["metric"] != ""]
+    result = compare(
+        df[df["name"] == baseline],
+        df[df["name"] == target],
+        resamples=resamples,
+        confidence=confidence,
+        seed=seed,
+    )
+    result["significant"] = result["p_value"] < alpha
+    fmt = lambda v: f"{v:.4g}"
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(result.to_string(index=False, float_format=fmt))
+        print()
+        print(summarize(result).to_string(index=False, float_format=fmt))
+    if output is not None:
+        result.to_csv(output, index=False)
+        print(f"Saved {output}")
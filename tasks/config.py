@@ -8,3 +8,5 @@ BUILD_DIR: Path = PROJECT_ROOT / "build"
 LINUX_DIR: Path = PROJECT_ROOT / "../linux"
 SSH_PORT: int = 2225
 VM_IP = "172.44.0.2"
+# device ID of the virtio-blk of --virtio-blk (see blockstats.py)
+VIRTIO_BLK_ID = "vblk0"
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""fio parameter sweep (inv vm.start --virtio-blk <path> --action run-fio-sweep).
+
+Instead of a job file of config/fio/, the jobs are generated from the product
+of block sizes, iodepths, numjobs, rw patterns and ioengines (--fio-bs 4k
+--fio-bs 128k --fio-iodepth 1 --fio-iodepth 32 ...). Each combination is a job
+named after its parameters, e.g., "randread-libaio-bs4k-qd32-j4", with the
+global options of config/fio/libaio.fio. All jobs run in the same VM one after
+another; the job file and the fio result of each job are saved as
+
+    ./bench-result/fio-sweep/{name}/{date}/{job}.fio
+    ./bench-result/fio-sweep/{name}/{date}/{job}.json
+
+so that results are keyed by parameters (see store.py and
+plot_storage.plot_fio_sweep).
+"""
+
+import itertools
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Sequence
+
+DEFAULT_RW = ["randread", "randwrite"]
+DEFAULT_BS = ["4k", "128k"]
+DEFAULT_IODEPTH = [1, 2, 4, 8, 16, 32, 64, 128]
+DEFAULT_NUMJOBS = [1]
+DEFAULT_IOENGINE = ["libaio"]
+
+# ioengine of a job name -> fio options (see config/fio/README.md)
+IOENGINES: Dict[str, List[str]] = {
+    "libaio": ["ioengine=libaio"],
+    "io_uring": ["ioengine=io_uring"],
+    "io_uring_c": ["ioengine=io_uring", "hipri=1", "fixedbufs=1", "registerfiles=1"],
+    "io_uring_s": [
+        "ioengine=io_uring",
+        "sqthread_poll=1",
+        "fixedbufs=1",
+        "registerfiles=1",
+    ],
+    "io_uring_sc": [
+        "ioengine=io_uring",
+        "sqthread_poll=1",
+        "hipri=1",
+        "fixedbufs=1",
+        "registerfiles=1",
+    ],
+    "sync": ["ioengine=psync"],
+}
+
+# same as config/fio/libaio.fio
+GLOBAL_OPTIONS = [
+    "direct=1",
+    "thread=1",
+    "norandommap=1",
+    "randrepeat=0",
+    "time_based=1",
+    "group_reporting=1",
+]
+
+JOB_NAME = re.compile(r"^(\w+)-(\w+)-bs(\w+)-qd(\d+)-j(\d+)$")
+
+
+@dataclass(frozen=True)
+class FioParams:
+    rw: str  # fio's rw: read, write, randread, randwrite, randrw, ...
+    ioengine: str  # key of IOENGINES
+    bs: str
+    iodepth: int
+    numjobs: int
+
+    @property
+    def name(self) -> str:
+        params = f"bs{self.bs}-qd{self.iodepth}-j{self.numjobs}"
+        return f"{self.rw}-{self.ioengine}-{params}"
+
+    @classmethod
+    def parse(cls, name: str) -> "FioParams":
+        m = JOB_NAME.match(name)
+        if m is None:
+            raise ValueError(f"Not a fio sweep job name: {name}")
+        rw, ioengine, bs, iodepth, numjobs = m.groups()
+        return cls(rw, ioengine, bs, int(iodepth), int(numjobs))
+
+    def job_file(self, runtime: int = 30, ramp_time: int = 20) -> str:
+        options = GLOBAL_OPTIONS + [f"runtime={runtime}", f"ramp_time={ramp_time}"]
+        options += IOENGINES[self.ioengine]
+        job = [
+            f"rw={self.rw}",
+            f"blocksize={self.bs}",
+            f"iodepth={self.iodepth}",
+            f"numjobs={self.numjobs}",
+        ]
+        return "\n".join(["[global]", *options, "", f"[{self.name}]", *job, ""])
+
+
+def job_matrix(
+    rw: Sequence[str] = (),
+    bs: Sequence[str] = (),
+    iodepth: Sequence[int] = (),
+    numjobs: Sequence[int] = (),
+    ioengine: Sequence[str] = (),
+) -> List[FioParams]:
+    """All combinations of the parameters (the DEFAULT_* ones if empty)"""
+    unknown = set(ioengine) - set(IOENGINES)
+    if unknown:
+        raise ValueError(f"Unknown ioengines: {sorted(unknown)} ({list(IOENGINES)})")
+    return [
+        FioParams(r, e, b, int(d), int(j))
+        for r, e, b, d, j in itertools.product(
+            rw or DEFAULT_RW,
+            ioengine or DEFAULT_IOENGINE,
+            bs or DEFAULT_BS,
+            iodepth or DEFAULT_IODEPTH,
+            numjobs or DEFAULT_NUMJOBS,
+        )
+    ]
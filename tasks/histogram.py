@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Latency histograms (vmexit_bench.py, blockstats.py)"""
+
+from typing import Sequence
+
+import numpy as np
+
+
+def percentiles(
+    low: Sequence[float],
+    high: Sequence[float],
+    counts: Sequence[float],
+    percentiles: Sequence[float],
+) -> np.ndarray:
+    """Percentiles of a histogram with sorted buckets [low, high), interpolated
+    linearly within a bucket. NaN if the histogram is empty."""
+    counts = np.asarray(counts, dtype=float)
+    if len(counts) == 0 or counts.sum() == 0:
+        return np.full(len(percentiles), np.nan)
+    low, high = np.asarray(low, dtype=float), np.asarray(high, dtype=float)
+    cum = np.cumsum(counts)
+    targets = np.asarray(percentiles, dtype=float) / 100 * cum[-1]
+    i = np.minimum(np.searchsorted(cum, targets), len(cum) - 1)
+    before = np.where(i > 0, cum[np.maximum(i - 1, 0)], 0)
+    frac = (targets - before) / (cum[i] - before)
+    return low[i] + frac * (high[i] - low[i])
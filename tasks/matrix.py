@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Declarative experiment matrix (see docs/benchmark.md and experiment/*.toml)
+
+An experiment file (TOML) has a [defaults] table and [[experiment]] entries.
+Each key is an option of `inv vm.start` (with "_" instead of "-"). A list
+value is expanded into one job per element, and `variants` is a list of
+option tables that is expanded the same way:
+
+    [defaults]
+    size = "medium"
+    virtio_nic = true
+
+    [[experiment]]
+    type = ["intel", "tdx"]
+    action = ["run-iperf", "run-nginx"]
+    variants = [{}, {virtio_nic_vhost = true}]
+    runs = 2  # number of results per job
+
+Jobs are executed one after another via vm.start(). The state of each job is
+written to a state file after every job, so that an interrupted experiment can
+be resumed. Jobs that already have `runs` results under bench-result/ are
+skipped, even if they were run outside of the experiment.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import tomllib
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from config import PROJECT_ROOT
+from naming import blk_name_suffix, nic_name_suffix
+
+RESULT_DIR = PROJECT_ROOT / "bench-result"
+
+# start() options that are lists themselves, i.e., not expanded
+LIST_OPTIONS = [
+    "ssh_cmd",
+    "collect",
+    "fio_rw",
+    "fio_bs",
+    "fio_iodepth",
+    "fio_numjobs",
+    "fio_ioengine",
+]
+
+
+@dataclass
+class Job:
+    options: Dict[str, Any]
+    runs: int = 1
+
+    @property
+    def id(self) -> str:
+        # stable across runs of the same experiment file
+        data = json.dumps(self.options, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()[:16]
+
+    def describe(self) -> str:
+        return " ".join(f"{k}={v}" for k, v in sorted(self.options.items()))
+
+
+def expand(options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return the cartesian product of all list values of `options`"""
+    keys = [
+        k for k, v in options.items() if isinstance(v, list) and k not in LIST_OPTIONS
+    ]
+    fixed = {k: v for k, v in options.items() if k not in keys}
+    jobs = []
+    for values in itertools.product(*(options[k] for k in keys)):
+        jobs.append({**fixed, **dict(zip(keys, values))})
+    return jobs
+
+
+def load_experiment(path: Path, valid_options: List[str]) -> List[Job]:
+    with open(path, "rb") as f:
+        data = tomllib.load(f)
+    defaults = data.get("defaults", {})
+    jobs = []
+    for entry in data.get("experiment", []):
+        entry = {**defaults, **entry}
+        runs = entry.pop("runs", 1)
+        variants = entry.pop("variants", [{}])
+        for variant in variants:
+            for options in expand({**entry, **variant}):
+                unknown = set(options) - set(valid_options)
+                if unknown:
+                    raise ValueError(f"{path}: unknown options: {sorted(unknown)}")
+                jobs.append(Job(options, runs))
+    return jobs
+
+
+def result_dir(action: str, name: str, config: Dict[str, Any]) -> Optional[Path]:
+    """Return the directory in which `action` stores its results (one entry per
+    run), or None if the action does not produce results"""
+    nic = name + nic_name_suffix(config)
+    blk = name + blk_name_suffix(config)
+    tls = "-tls" if config["tls"] else ""
+    dirs = {
+        "boottime": f"boottime/{name}",
+        "run-phoronix": f"phoronix/{name}/{config['phoronix_bench_name']}",
+        "run-mlc": f"memory/mlc/{name}",
+        "run-blender": f"application/blender/{name}",
+        "run-tensorflow": f"application/tensorflow/{name}",
+        "run-pytorch": f"application/pytorch/{name}",
+        "run-sqlite": f"application/sqlite/{blk if config['virtio_blk'] else name}",
+        "run-fio": f"fio/{blk}/{config['fio_job']}",
+        "run-fio-sweep": f"fio-sweep/{blk}",
+        "run-vmexit": f"vmexit/{name}",
+        "run-iperf": f"network/iperf/{nic}/tcp",
+        "run-iperf-udp": f"network/iperf/{nic}/udp",
+        "run-memtier": f"network/memtier/redis{tls}/{nic}",
+        "run-memtier-memcached": f"network/memtier/memcached{tls}/{nic}",
+        "run-nginx": f"network/nginx/{nic}",
+        "run-ping": f"network/ping/{nic}",
+        "run-attestation-sev": f"attestation/sev/{name}",
+        "run-attestation-tdx": f"attestation/tdx/{name}",
+    }
+    if action not in dirs:
+        return None
+    return RESULT_DIR / dirs[action]
+
+
+# suffixes of per-run result files; other files next to them (e.g.,
+# {date}.blockstats.jsonl of run-fio --blockstats) belong to the same run
+RESULT_SUFFIXES = [".json", ".xml"]
+
+
+def is_result(path: Path) -> bool:
+    """Whether an entry of a result_dir() is a run: a non-empty date directory
+    or a {date}.json/.xml file"""
+    if path.is_dir():
+        return any(path.iterdir())
+    return path.suffix in RESULT_SUFFIXES and path.name.count(".") == 1
+
+
+def count_results(path: Optional[Path]) -> int:
+    if path is None or not path.is_dir():
+        return 0
+    return sum(1 for p in path.iterdir() if is_result(p))
+
+
+class State:
+    """Per-job status of an experiment, stored as JSON"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        if path.exists():
+            self.jobs = json.loads(path.read_text())["jobs"]
+
+    def get(self, job: Job) -> Optional[str]:
+        return self.jobs.get(job.id, {}).get("status")
+
+    def set(self, job: Job, status: str, results: int) -> None:
+        self.jobs[job.id] = dict(
+            status=status,
+            results=results,
+            options=job.options,
+            time=datetime.now().strftime("%Y-%m-%d-%H-%M-%S"),
+        )
+        # write atomically so that a crash does not corrupt the state file
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(dict(jobs=self.jobs), indent=2))
+        os.replace(tmp, self.path)
+
+
+def run_experiment(
+    jobs: List[Job],
+    state: State,
+    run_job: Callable[[Dict[str, Any]], None],
+    job_config: Callable[[Dict[str, Any]], Dict[str, Any]],
+    dry_run: bool = False,
+) -> None:
+    """Run jobs that do not have enough results yet.
+    `run_job(options)` runs one job; `job_config(options)` returns the complete
+    start() options (i.e., including defaults) used to locate the results."""
+    for i, job in enumerate(jobs):
+        config = job_config(job.options)
+        action = config["action"]
+        path = result_dir(action, config["name"], config)
+        have = count_results(path)
+        prefix = f"[{i+1}/{len(jobs)}]"
+        if path is None and state.get(job) == "done":
+            print(f"{prefix} skip (done): {job.describe()}")
+            continue
+        if path is not None and have >= job.runs:
+            print(f"{prefix} skip ({have}/{job.runs} results): {job.describe()}")
+            if state.get(job) != "done":
+                state.set(job, "done", have)
+            continue
+        print(f"{prefix} run: {job.describe()}")
+        if dry_run:
+            continue
+        runs = job.runs - have if path is not None else job.runs
+        status = "done"
+        for _ in range(runs):
+            try:
+                run_job(job.options)
+            except Exception as e:
+                print(f"{prefix} failed: {e}")
+                status = "failed"
+                break
+        results = count_results(path)
+        if path is not None and results < job.runs:
+            status = "failed"
+        state.set(job, status, results)
+
+    failed = [j for j in jobs if state.get(j) == "failed"]
+    if failed:
+        print(f"{len(failed)} job(s) failed; run the experiment again to retry them:")
+        for job in failed:
+            print(f"  {job.describe()}")
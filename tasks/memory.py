@@ -10,6 +10,7 @@ from invoke import task
 import numpy as np
 import pandas as pd
 
+from compare import geomean
 from config import PROJECT_ROOT
 from qemu import QemuVm
 
@@ -100,20 +101,18 @@ def parse_mlc_result(
     label: str, base_dir: Path, date: Optional[str] = None, max_num: int = 10
 ):
     """Parse the mlc result and return a DataFrame"""
+    import store
 
-    fs = []
-    if date is None:
-        files = sorted([d for d in base_dir.iterdir() if d.is_dir()])[-10:]
-        for f in files:
-            fs.append(f / "mlc.log")
-    else:
-        fs.append(base_dir / date / "mlc.log")
+    # base_dir: {result dir}/memory/mlc/{name}
+    result = store.query(base_dir.parents[2], "mlc", name=base_dir.name)
+    dates = store.select_dates(result, date, max_num)
 
-    # parse file and create a dataframe
+    # | name | random_access_latency | bw_all_read | bw_3_1 | bw_2_1 | bw_1_1 | bw_stream |
     dfs = []
-    for f in fs:
-        name = f.parent.name
-        df = parse_mlc_result_sub(name, f)
+    for date in dates:
+        r = result[result["date"] == date]
+        df = pd.DataFrame([dict(zip(r["metric"], r["value"]))])
+        df.insert(0, "name", date)
         dfs.append(df)
     # concate result
     result = pd.concat(dfs, ignore_index=True)
@@ -179,7 +178,7 @@ def show_mlc_result(
     print(f"cvm_bw: {cvm_bw}")
     overhead = (1 - cvm_bw / vm_bw) * 100
     print(f"bw diff: {overhead}")
-    geo_mean = np.prod(cvm_bw / vm_bw) ** (1 / len(cvm_bw))
+    geo_mean = geomean(cvm_bw / vm_bw)
     print(f"geomean: {geo_mean:.3f}, {(1 - geo_mean)*100:.3f}%")
 
 
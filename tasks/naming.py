@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Suffixes of result names that tell benchmark variants apart (used by vm.py
+to name results and by matrix.py to find them)"""
+
+
+def swiotlb_name_suffix(config: dict) -> str:
+    if config["virtio_iommu"] and "swiotlb" in config["extra_cmdline"]:
+        return "-swiotlb"
+    return ""
+
+
+def nic_name_suffix(config: dict) -> str:
+    """Suffix of the result name of network benchmarks (e.g., "-vhost-mq")"""
+    suffix = ""
+    if config["virtio_nic_vhost"]:
+        suffix += "-vhost"
+    if config["virtio_nic_mq"]:
+        suffix += "-mq"
+    return suffix + swiotlb_name_suffix(config)
+
+
+def blk_name_suffix(config: dict) -> str:
+    """Suffix of the result name of storage benchmarks (e.g., "-native-noiothread")"""
+    suffix = f"-{config['virtio_blk_aio']}"
+    if config.get("virtio_blk_backend", "qemu") != "qemu":
+        suffix = f"-{config['virtio_blk_backend']}" + suffix
+    if not config["virtio_blk_direct"]:
+        suffix += "-nodirect"
+    if not config["virtio_blk_iothread"]:
+        suffix += "-noiothread"
+    elif config.get("virtio_blk_iothreads", 1) > 1:
+        suffix += f"-iothreads{config['virtio_blk_iothreads']}"
+    if config.get("virtio_blk_queues") is not None:
+        suffix += f"-q{config['virtio_blk_queues']}"
+    return suffix + swiotlb_name_suffix(config)
@@ -1,18 +1,148 @@
+import csv
+import os
+import re
+import selectors
+import signal
+import statistics
 import subprocess
+import sys
 from datetime import datetime
 from pathlib import Path
-import subprocess
 import time
-from typing import Optional
+from typing import Callable, Dict, List, Optional
 
 from config import PROJECT_ROOT, VM_IP
 from qemu import QemuVm
 
+# a record of a time series, e.g., {"time": 1.0, "throughput": 9.4}
+Record = Dict[str, float]
+
+# iperf -i 1 (iperf2, -P > 1):
+# [SUM] 0.0000-1.0000 sec  1.17 GBytes  10.0 Gbits/sec
+IPERF_INTERVAL = re.compile(
+    r"\[SUM\]\s+([\d.]+)\s*-\s*([\d.]+)\s+sec\s+[\d.]+\s+\w?Bytes\s+([\d.]+)\s+(\w?)bits/sec"
+)
+# memtier_benchmark progress (stderr, refreshed with "\r"):
+# [RUN #1 12%,   3 secs]  8 threads:   123456 ops,   45678 (avg:   41234) ops/sec, 1.23MB/sec (avg: 1.10MB/sec),  4.56 (avg:  4.78) msec latency
+MEMTIER_PROGRESS = re.compile(
+    r"\[RUN #(\d+)\s+(\d+)%,\s*(\d+) secs\].*?([\d.]+) \(avg:\s*([\d.]+)\) ops/sec"
+    r".*?([\d.]+) \(avg:\s*([\d.]+)\) msec latency"
+)
+UNIT = {"": 1e-9, "K": 1e-6, "M": 1e-3, "G": 1.0, "T": 1e3}
+
+
+def parse_iperf_interval(line: str) -> Optional[Record]:
+    """Parse an interval line of iperf. Throughput is in Gbits/sec"""
+    m = IPERF_INTERVAL.search(line)
+    if m is None:
+        return None
+    start, end = float(m.group(1)), float(m.group(2))
+    if end - start > 1.5:
+        # the summary of the whole run
+        return None
+    return dict(start=start, end=end, throughput=float(m.group(3)) * UNIT[m.group(4)])
+
+
+def parse_memtier_progress(line: str) -> Optional[Record]:
+    """Parse a progress line of memtier_benchmark. Latency is in msec"""
+    m = MEMTIER_PROGRESS.search(line)
+    if m is None:
+        return None
+    return dict(
+        run=int(m.group(1)),
+        secs=int(m.group(3)),
+        ops=float(m.group(4)),
+        avg_ops=float(m.group(5)),
+        latency=float(m.group(6)),
+        avg_latency=float(m.group(7)),
+    )
+
+
+def converged(
+    key: str, window: int = 5, tolerance: float = 0.02, min_records: int = 10
+) -> Callable[[List[Record]], bool]:
+    """Return a stop condition for stream_cmd(): the coefficient of variation
+    of the last `window` values of `key` is below `tolerance`"""
+
+    def check(records: List[Record]) -> bool:
+        if len(records) < max(min_records, window):
+            return False
+        values = [r[key] for r in records[-window:]]
+        mean = statistics.mean(values)
+        return mean > 0 and statistics.stdev(values) / mean < tolerance
 
-def run_ping(name: str, vm: QemuVm, pin_base=20):
-    """Ping the VM.
+    return check
+
+
+def stream_cmd(
+    cmd: List[str],
+    log: Path,
+    series: Path,
+    parse: Callable[[str], Optional[Record]],
+    stop: Optional[Callable[[List[Record]], bool]] = None,
+    check: bool = True,
+) -> int:
+    """Run a benchmark client and process its output while it runs.
+    stdout is written to `log` as it arrives (stderr is passed through).
+    Lines of stdout and stderr are parsed with `parse` and the records are
+    appended to `series` (CSV) with the time since the start.
+    If `stop(records)` returns True, the client is interrupted with SIGINT.
+    Return the exit code."""
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert proc.stdout is not None and proc.stderr is not None
+    sel = selectors.DefaultSelector()
+    sel.register(proc.stdout, selectors.EVENT_READ)
+    sel.register(proc.stderr, selectors.EVENT_READ)
+    pending = {proc.stdout: b"", proc.stderr: b""}
+    records: List[Record] = []
+    stopped = False
+    with open(log, "wb") as logf, open(series, "w", newline="") as seriesf:
+        writer = None
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, 65536)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    lines = [pending[key.fileobj]]
+                else:
+                    if key.fileobj is proc.stdout:
+                        logf.write(data)
+                        logf.flush()
+                    else:
+                        sys.stderr.buffer.write(data)
+                        sys.stderr.flush()
+                    # progress lines are often terminated with "\r"
+                    *lines, pending[key.fileobj] = re.split(
+                        rb"[\r\n]", pending[key.fileobj] + data
+                    )
+                for line in lines:
+                    record = parse(line.decode(errors="replace"))
+                    if record is None:
+                        continue
+                    record = dict(time=round(time.monotonic() - start, 3), **record)
+                    if writer is None:
+                        writer = csv.DictWriter(seriesf, fieldnames=list(record))
+                        writer.writeheader()
+                    writer.writerow(record)
+                    seriesf.flush()
+                    records.append(record)
+                    if stop is not None and not stopped and stop(records):
+                        print("converged, stop the client")
+                        proc.send_signal(signal.SIGINT)
+                        stopped = True
+    returncode = proc.wait()
+    if check and returncode != 0 and not stopped:
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return returncode
+
+
+def run_ping(name: str, vm: QemuVm, pin_base=20, pin_cpus: Optional[str] = None):
+    """Ping the VM (from the CPUs `pin_cpus`, default: `pin_base`).
     The results are saved in ./bench-results/network/ping/{name}/{date}
     """
+    if pin_cpus is None:
+        pin_cpus = str(pin_base)
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     outputdir = Path(f"./bench-result/network/ping/{name}/{date}/")
     outputdir_host = PROJECT_ROOT / outputdir
@@ -20,7 +150,7 @@ def run_ping(name: str, vm: QemuVm, pin_base=20):
 
     for pkt_size in [64, 128, 256, 512, 1024]:
         process = subprocess.Popen(
-            f"taskset -c {pin_base} ping -c 30 -i0.1 -s {pkt_size} {VM_IP}".split(" "),
+            f"taskset -c {pin_cpus} ping -c 30 -i0.1 -s {pkt_size} {VM_IP}".split(" "),
             stderr=subprocess.PIPE,
             stdout=subprocess.PIPE,
         )
@@ -46,9 +176,14 @@ def run_iperf(
     parallel: Optional[int] = None,
     pin_start: int = 20,
     pin_end: Optional[int] = None,
+    stop_converged: bool = False,
+    pin_cpus: Optional[str] = None,  # client CPUs (cpulist) instead of pin_start-end
 ):
     """Run the iperf benchmark on the VM.
     The results are saved in ./bench-result/network/iperf/{name}/{proto}/{date}/
+    ({pkt_size}.log and the per-second throughput in {pkt_size}.series.csv).
+    If `stop_converged` is True, the client is stopped once the throughput
+    is stable (iperf prints the summary when interrupted).
     """
     if udp:
         proto = "udp"
@@ -62,6 +197,8 @@ def run_iperf(
             parallel = 32
     if pin_end is None:
         pin_end = pin_start + parallel - 1
+    if pin_cpus is None:
+        pin_cpus = f"{pin_start}-{pin_end}"
 
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     outputdir = Path(f"./bench-result/network/iperf/{name}/{proto}/{date}/")
@@ -76,9 +213,12 @@ def run_iperf(
     # run client
     for pkt_size in pkt_sizes:
         cmd = [
+            # line buffered stdout to get the interval reports as they come
+            "stdbuf",
+            "-oL",
             "taskset",
             "-c",
-            f"{pin_start}-{pin_end}",
+            pin_cpus,
             "iperf",
             "-c",
             f"{VM_IP}",
@@ -96,10 +236,13 @@ def run_iperf(
         if udp:
             cmd.append("-u")
         print(cmd)
-        output = subprocess.check_output(cmd).decode()
-        lines = output.split("\n")
-        with open(outputdir_host / f"{pkt_size}.log", "w") as f:
-            f.write("\n".join(lines))
+        stream_cmd(
+            cmd,
+            outputdir_host / f"{pkt_size}.log",
+            outputdir_host / f"{pkt_size}.series.csv",
+            parse_iperf_interval,
+            stop=converged("throughput") if stop_converged else None,
+        )
 
         # workaround to avoid "iperf3: error - unable to receive control message - port may not be available"
         time.sleep(1)
@@ -121,10 +264,12 @@ def run_memtier(
     ca_cert: str = PROJECT_ROOT / "benchmarks/network/tls/pki/ca.crt",
     pin_start: int = 20,
     pin_end: Optional[int] = None,
+    pin_cpus: Optional[str] = None,  # client CPUs (cpulist) instead of pin_start-end
 ):
     """Run the memtier benchmark on the VM using redis or memcached.
     `server_threads` is only valid for memcached.
     The results are saved in ./bench-result/network/memtier/{server}[-tls]/{name}/{date}/
+    (memtier.log and the progress per second in memtier.series.csv)
     """
     if tls:
         tls_ = "-tls"
@@ -156,6 +301,8 @@ def run_memtier(
 
     if pin_end is None:
         pin_end = pin_start + client_threads - 1
+    if pin_cpus is None:
+        pin_cpus = f"{pin_start}-{pin_end}"
 
     server_cmd = [
         "just",
@@ -174,7 +321,7 @@ def run_memtier(
         cmd = [
             "taskset",
             "-c",
-            f"{pin_start}-{pin_end}",
+            pin_cpus,
             "memtier_benchmark",
             f"--host={VM_IP}",
             "-p",
@@ -194,7 +341,7 @@ def run_memtier(
         cmd = [
             "taskset",
             "-c",
-            f"{pin_start}-{pin_end}",
+            pin_cpus,
             "memtier_benchmark",
             f"--host={VM_IP}",
             "-p",
@@ -207,14 +354,31 @@ def run_memtier(
             f"--protocol={proto}",
         ]
     print(cmd)
-    output = subprocess.check_output(cmd).decode()
-    lines = output.split("\n")
-    with open(outputdir_host / f"memtier.log", "w") as f:
-        f.write("\n".join(lines))
+    stream_cmd(
+        cmd,
+        outputdir_host / "memtier.log",
+        outputdir_host / "memtier.series.csv",
+        parse_memtier_progress,
+    )
 
     print(f"Results saved in {outputdir_host}")
 
 
+def run_wrk(cmd: List[str], log: Path) -> None:
+    # wrk only reports at the end, so the series has the summary only
+    returncode = stream_cmd(
+        cmd, log, log.with_suffix(".series.csv"), parse_wrk_summary, check=False
+    )
+    if returncode != 0:
+        print(f"Error running wrk: exit code {returncode}")
+
+
+def parse_wrk_summary(line: str) -> Optional[Record]:
+    if line.startswith("Requests/sec:"):
+        return dict(throughput=float(line.split()[1]))
+    return None
+
+
 def run_nginx(
     name: str,
     vm: QemuVm,
@@ -223,9 +387,11 @@ def run_nginx(
     duration: str = "30s",
     pin_start: int = 20,
     pin_end: Optional[int] = None,
+    pin_cpus: Optional[str] = None,  # client CPUs (cpulist) instead of pin_start-end
 ):
     """Run the nginx on the VM and the wrk benchmark on the host.
     The results are saved in ./bench-result/network/nginx/{name}/{date}/
+    ({http,https}.log and {http,https}.series.csv)
     """
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     outputdir = Path(f"./bench-result/network/nginx/{name}/{date}/")
@@ -234,6 +400,8 @@ def run_nginx(
 
     if pin_end is None:
         pin_end = pin_start + threads - 1
+    if pin_cpus is None:
+        pin_cpus = f"{pin_start}-{pin_end}"
 
     server_cmd = ["just", "-f", "/share/benchmarks/network/justfile", "run-nginx"]
     vm.ssh_cmd(server_cmd)
@@ -243,7 +411,7 @@ def run_nginx(
     cmd = [
         "taskset",
         "-c",
-        f"{pin_start}-{pin_end}",
+        pin_cpus,
         "wrk",
         f"http://{VM_IP}",
         f"-t{threads}",
@@ -251,18 +419,13 @@ def run_nginx(
         f"-d{duration}",
     ]
     print(cmd)
-    output = subprocess.run(cmd, capture_output=True, text=True)
-    if output.returncode != 0:
-        print(f"Error running wrk: {output.stderr}")
-    lines = output.stdout.split("\n")
-    with open(outputdir_host / f"http.log", "w") as f:
-        f.write("\n".join(lines))
+    run_wrk(cmd, outputdir_host / "http.log")
 
     # HTTPS
     cmd = [
         "taskset",
         "-c",
-        f"{pin_start}-{pin_end}",
+        pin_cpus,
         "wrk",
         f"https://{VM_IP}",
         f"-t{threads}",
@@ -270,11 +433,6 @@ def run_nginx(
         f"-d{duration}",
     ]
     print(cmd)
-    output = subprocess.run(cmd, capture_output=True, text=True)
-    if output.returncode != 0:
-        print(f"Error running wrk: {output.stderr}")
-    lines = output.stdout.split("\n")
-    with open(outputdir_host / f"https.log", "w") as f:
-        f.write("\n".join(lines))
+    run_wrk(cmd, outputdir_host / "https.log")
 
     print(f"Results saved in {outputdir_host}")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""On-disk memoization of result parsers.
+
+@cached functions store their return value (pickled) under CACHE_DIR, keyed
+by the function name and the hash of the arguments. For Path arguments, and
+str arguments naming an existing file, the hash of the file content is used,
+so a result file is only parsed again when its content changes, regardless of
+where it is or its mtime.
+
+The cache is bounded to MAX_CACHE_SIZE bytes; least recently used entries are
+evicted first.
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import PROJECT_ROOT
+
+CACHE_DIR = PROJECT_ROOT / ".parse-cache"
+MAX_CACHE_SIZE = 512 * 1024 * 1024
+
+# bump to invalidate all entries (e.g., when the return format of parsers changes)
+CACHE_VERSION = "4"
+
+# (path, mtime, size) -> content hash, to avoid hashing a file twice per process
+_FILE_HASHES: Dict[Tuple[str, int, int], str] = {}
+_cache_size: Optional[int] = None
+
+
+def file_hash(path: Path) -> str:
+    st = path.stat()
+    key = (str(path.resolve()), st.st_mtime_ns, st.st_size)
+    if key not in _FILE_HASHES:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(chunk)
+        _FILE_HASHES[key] = h.hexdigest()
+    return _FILE_HASHES[key]
+
+
+def cache_key(fn: Callable, args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> str:
+    h = hashlib.sha256()
+    h.update(f"{CACHE_VERSION}:{fn.__module__}.{fn.__qualname__}".encode())
+    for name, arg in [*((None, a) for a in args), *sorted(kwargs.items())]:
+        if name is not None:
+            h.update(f"{name}=".encode())
+        # e.g., parse_xml() and the network parsers are also called with str paths
+        if isinstance(arg, str) and os.path.isfile(arg):
+            arg = Path(arg)
+        if isinstance(arg, Path):
+            h.update(b"file:" + file_hash(arg).encode())
+        else:
+            h.update(pickle.dumps(arg))
+    return h.hexdigest()
+
+
+def entries() -> list:
+    return [p for p in CACHE_DIR.glob("*/*.pkl") if p.is_file()]
+
+
+def evict(max_size: int = MAX_CACHE_SIZE) -> None:
+    """Remove least recently used entries until the cache fits into max_size"""
+    global _cache_size
+    files = sorted(entries(), key=lambda p: p.stat().st_mtime)
+    size = sum(p.stat().st_size for p in files)
+    while files and size > max_size:
+        p = files.pop(0)
+        size -= p.stat().st_size
+        p.unlink(missing_ok=True)
+    _cache_size = size
+
+
+def _store(path: Path, value: Any) -> None:
+    global _cache_size
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    if _cache_size is None:
+        evict()
+    else:
+        _cache_size += path.stat().st_size
+        if _cache_size > MAX_CACHE_SIZE:
+            evict()
+
+
+def cached(fn: Callable) -> Callable:
+    """Memoize a parser on disk (see the module docstring)"""
+
+    @functools.wraps(fn)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        try:
+            key = cache_key(fn, args, kwargs)
+        except (OSError, pickle.PicklingError, TypeError):
+            # e.g., the file does not exist: let fn report the error
+            return fn(*args, **kwargs)
+        path = CACHE_DIR / key[:2] / f"{key}.pkl"
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            # mark as recently used
+            os.utime(path)
+            return value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        value = fn(*args, **kwargs)
+        try:
+            _store(path, value)
+        except OSError as e:
+            print(f"[parse-cache] failed to store {fn.__qualname__}: {e}")
+        return value
+
+    wrapper.uncached = fn
+    return wrapper
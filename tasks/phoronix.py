@@ -13,6 +13,7 @@ import pandas as pd
 from lxml import etree
 
 from config import PROJECT_ROOT
+from parse_cache import cached
 from qemu import QemuVm
 
 # Based on
@@ -55,6 +56,7 @@ def yes_please() -> IO[bytes]:
     return yes_please.stdout
 
 
+@cached
 def parse_xml(path: Union[str, Path]) -> pd.DataFrame:
     """Parse the Phoronix XML file (or str) and return a DataFrame with the results."""
     if isinstance(path, Path):
@@ -62,34 +64,34 @@ def parse_xml(path: Union[str, Path]) -> pd.DataFrame:
     else:
         tree = etree.fromstring(path)
     results = defaultdict(list)
-    for result in tree.xpath("./Result"):
-        for entry in result.xpath("./Data/Entry"):
-            value = entry.xpath("./Value")[0].text
-            if value == None:
+    for result in tree.iterfind("./Result"):
+        # per-result fields are the same for all entries. Use .text (None if
+        # empty) as findtext() returns "" for empty elements.
+        title = result.find("Title").text
+        scale = result.find("Scale").text
+        description = result.find("Description").text
+        app_version = result.find("AppVersion").text
+        proportion = result.find("Proportion").text
+        benchmark_id = "%s: %s [%s]" % (title, description, scale)
+        for entry in result.iterfind("./Data/Entry"):
+            value = entry.find("Value").text
+            if not value:
                 # the value can be None if the test failed to run
-                printf(f"XXX: value of {entry} is None! check the xml file")
+                print(f"XXX: value of {entry} is None! check the xml file")
                 continue
-            identifier = entry.xpath("./Identifier")[0].text
-            results["identifier"].append(entry.xpath("./Identifier")[0].text)
-            results["value"].append(float(entry.xpath("./Value")[0].text))
-            results["raw_string"].append(entry.xpath("./RawString")[0].text)
-            json = entry.xpath("./JSON")
-            if len(json) == 0:
-                results["json"].append("")
-            else:
-                results["json"].append(json[0].text)
-
-            title = result.xpath("./Title")[0].text
-            scale = result.xpath("./Scale")[0].text
-            description = result.xpath("./Description")[0].text
+            results["identifier"].append(entry.find("Identifier").text)
+            results["value"].append(float(value))
+            results["raw_string"].append(entry.find("RawString").text)
+            json = entry.find("JSON")
+            results["json"].append(json.text if json is not None else "")
 
             results["title"].append(title)
-            results["app_version"].append(result.xpath("./AppVersion")[0].text)
+            results["app_version"].append(app_version)
             results["description"].append(description)
             results["scale"].append(scale)
 
-            results["proportion"].append(result.xpath("./Proportion")[0].text)
-            results["benchmark_id"].append("%s: %s [%s]" % (title, description, scale))
+            results["proportion"].append(proportion)
+            results["benchmark_id"].append(benchmark_id)
 
     return pd.DataFrame(results)
 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Placement of the host threads of a VM benchmark on physical CPUs.
+
+plan_pinning() assigns CPUs of the host topology (topology.cores()) to
+
+- vCPUs: one SMT thread per physical core, so that vCPUs do not share cores
+- QEMU iothreads and vhost workers: the following cores
+- the host-side load generator of network benchmarks (see network.py): the
+  remaining cores of the VM's NUMA nodes, then free siblings, then other nodes
+
+Only CPUs of the VM's NUMA nodes at or above pin_base are used for the VM
+(CPUs below pin_base are left to the host), or exactly --pin-cpus if given
+(e.g., by the scheduler). SMT siblings of cores used by vCPUs are left idle
+unless the vCPUs do not fit otherwise. Compromises are reported as warnings;
+a VM whose vCPUs do not fit at all is an error instead of a partial pinning.
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from topology import Core, cores, format_cpulist, parse_cpulist
+
+# threads of the host-side load generators of network.py (its defaults);
+# None: as many as vCPUs
+CLIENT_THREADS: Dict[str, Optional[int]] = {
+    "run-iperf": 32,
+    "run-iperf-udp": 8,
+    "run-memtier": 8,
+    "run-memtier-memcached": None,
+    "run-nginx": 8,
+    "run-ping": 1,
+}
+
+
+@dataclass
+class PinPlan:
+    vcpus: List[int]  # CPU of vCPU i
+    iothreads: List[int]
+    vhost: List[int]
+    client: List[int]  # load generator CPUs (may be fewer than its threads)
+    warnings: List[str] = field(default_factory=list)
+
+    def report(self) -> str:
+        parts = dict(
+            vcpus=self.vcpus,
+            iothreads=self.iothreads,
+            vhost=self.vhost,
+            client=self.client,
+        )
+        lines = [f"[pin] {k}: {format_cpulist(set(v))}" for k, v in parts.items() if v]
+        lines += [f"[pin] WARN: {w}" for w in self.warnings]
+        return "\n".join(lines)
+
+    def client_cpus(self) -> Optional[str]:
+        """cpulist for taskset, None if no CPU is free for the load generator"""
+        return format_cpulist(self.client) if self.client else None
+
+
+def take(pool: List[int], num: int) -> List[int]:
+    taken = pool[:num]
+    del pool[:num]
+    return taken
+
+
+def plan_pinning(
+    vcpus: int,
+    iothreads: int = 0,
+    vhost: int = 0,
+    client: int = 0,
+    numa_node: Optional[List[int]] = None,  # default: all nodes
+    pin_base: int = 0,
+    cpus: Optional[List[int]] = None,  # CPUs for the VM instead of nodes/base
+    topology: Optional[List[Core]] = None,
+) -> PinPlan:
+    topology = topology if topology is not None else cores()
+    in_nodes = [c for c in topology if numa_node is None or c.node in numa_node]
+    if cpus is not None:
+        allowed = set(cpus)
+    else:
+        # cores with a CPU below pin_base belong to the host
+        allowed = {t for c in in_nodes if c.threads[0] >= pin_base for t in c.threads}
+    # the first allowed thread of each core is used first, the others later
+    threads = [[t for t in c.threads if t in allowed] for c in topology]
+    primaries = [ts[0] for ts in threads if ts]
+    siblings = {ts[0]: ts[1:] for ts in threads if ts}
+    warnings = []
+
+    vcpu_cpus = take(primaries, vcpus)
+    if len(vcpu_cpus) < vcpus:
+        shared = [s for p in vcpu_cpus for s in siblings.pop(p, [])]
+        vcpu_cpus += take(shared, vcpus - len(vcpu_cpus))
+        warnings.append(f"{vcpus} vCPUs share SMT cores")
+    if len(vcpu_cpus) < vcpus:
+        raise ValueError(
+            f"{vcpus} vCPUs do not fit into CPUs {format_cpulist(sorted(allowed))}"
+            " (use a smaller --size, --pin-base, or --no-pin)"
+        )
+    vcpu_siblings = [s for p in vcpu_cpus for s in siblings.pop(p, [])]
+
+    helpers = iothreads + vhost
+    helper_cpus = take(primaries, helpers)
+    free_siblings = [s for p in sorted(siblings) for s in siblings[p]]
+    helper_cpus += take(free_siblings, helpers - len(helper_cpus))
+    shared = take(vcpu_siblings, helpers - len(helper_cpus))
+    if shared:
+        helper_cpus += shared
+        warnings.append("iothreads/vhost workers share SMT cores with vCPUs")
+    if len(helper_cpus) < helpers:
+        # share the CPUs found (the last vCPU's if none)
+        pool = helper_cpus or vcpu_cpus[-1:]
+        helper_cpus = [pool[i % len(pool)] for i in range(helpers)]
+        warnings.append(
+            f"{helpers} iothreads/vhost workers share CPUs {format_cpulist(pool)}"
+        )
+
+    client_cpus: List[int] = []
+    if client:
+        # CPUs outside of --pin-cpus may belong to other VMs
+        other_nodes = [
+            c.threads[0]
+            for c in topology
+            if cpus is None and numa_node is not None and c.node not in numa_node
+        ]
+        for pool in [primaries, free_siblings, other_nodes]:
+            client_cpus += take(pool, client - len(client_cpus))
+        if not client_cpus:
+            warnings.append("no CPU is free for the load generator")
+        elif len(client_cpus) < client:
+            warnings.append(
+                f"the load generator runs {client} threads on {len(client_cpus)} CPUs"
+            )
+    return PinPlan(
+        vcpus=vcpu_cpus,
+        iothreads=helper_cpus[:iothreads],
+        vhost=helper_cpus[iothreads:],
+        client=client_cpus,
+        warnings=warnings,
+    )
+
+
+def vm_plan(qemu_cmd: List[str], config: Dict[str, Any]) -> PinPlan:
+    """Plan the pinning of a VM of `inv vm.start` (all actions of --action)"""
+    resource = config["resource"]
+    iothreads = sum(1 for arg in qemu_cmd if arg.startswith("iothread,"))
+    if "storage_daemon_cmd" in config:
+        # qemu-storage-daemon (vhost-user-blk) gets a CPU like an iothread
+        iothreads += 1
+    vhost = 0
+    if config.get("virtio_nic") and config.get("virtio_nic_vhost"):
+        # a worker per queue pair
+        vhost = resource.cpu if config.get("virtio_nic_mq") else 1
+    client = 0
+    for action in config.get("action", "").split(","):
+        if action in CLIENT_THREADS:
+            client = max(client, CLIENT_THREADS[action] or resource.cpu)
+    pin_cpus = config.get("pin_cpus")
+    return plan_pinning(
+        resource.cpu,
+        iothreads=iothreads,
+        vhost=vhost,
+        client=client,
+        numa_node=resource.numa_node,
+        pin_base=config.get("pin_base", resource.pin_base),
+        cpus=parse_cpulist(pin_cpus) if pin_cpus else None,
+    )
+
+
+def vhost_threads(qemu_pid: int) -> List[int]:
+    """TIDs of the vhost workers of a QEMU process: threads of QEMU since Linux
+    6.4, kernel threads before, both named vhost-{qemu_pid}"""
+    name = f"vhost-{qemu_pid}"
+    tids = []
+    for comm in Path(f"/proc/{qemu_pid}/task").glob("*/comm"):
+        if comm.read_text().strip() == name:
+            tids.append(int(comm.parent.name))
+    if not tids:
+        for comm in Path("/proc").glob("[0-9]*/comm"):
+            try:
+                if comm.read_text().strip() == name:
+                    tids.append(int(comm.parent.name))
+            except OSError:
+                continue  # exited
+    return sorted(tids)
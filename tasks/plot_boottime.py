@@ -12,6 +12,9 @@ import seaborn as sns  # type: ignore
 import pandas as pd
 import numpy as np
 
+import store
+from parse_cache import cached
+
 # common graph settings
 
 mpl.use("Agg")
@@ -35,8 +38,13 @@ hatches = ["", "//", "\\"]
 hatches2 = ["", "////", "\\\\"]
 
 
+# boot phases returned by parse_result()
+PHASES = ["QEMU", "OVMF", "Linux", "Init"]
+
+
 # return a list of elapsed time of (1) VM start, (2) Linux start (OVMF end),
 # and (3) Linux user space start
+@cached
 def parse_result(result: list) -> List[float]:
     """Example of file
     Attaching 12 probes...
@@ -94,26 +102,91 @@ def parse_result(result: list) -> List[float]:
     return times
 
 
+# finer phases of parse_breakdown(): QEMU is split into memory preallocation,
+# the launch of the CVM (SNP: sev_snp_launch_finish, TDX: tdx_finalize_vm) and
+# the rest. Phases that are not traced (e.g., no prealloc) are 0.
+BREAKDOWN = ["Prealloc", "Launch", "QEMU other", "OVMF", "Linux", "Init"]
+# phases in which KVM page faults and SNP page state changes are counted; with
+# lazy acceptance, "Ready" (init end to ssh ready) and later include the pages
+# accepted by the booted guest
+COUNTER_PHASES = ["QEMU", "OVMF", "Linux", "Init", "Ready"]
+COUNTERS = {"KVM: page faults": "page faults", "KVM: psc": "psc"}
+
+
+def event_time(line: str) -> int:
+    return int(line.split(":")[0])
+
+
+def durations(result: list, event: str) -> float:
+    """Sum of the intervals [s] between each `event` and the next "{event} done"
+    (e.g., preallocation of several memory backends)"""
+    total, begin = 0, None
+    for line in result:
+        if line.rstrip().endswith(event):
+            begin = event_time(line)
+        elif line.rstrip().endswith(f"{event} done") and begin is not None:
+            total += event_time(line) - begin
+            begin = None
+    return total / 1e9
+
+
+@cached
+def parse_breakdown(result: list) -> Dict[str, Dict[str, float]]:
+    """Return the BREAKDOWN phases [s] and, per counter of the trace ("page
+    faults", "psc"), the counts per COUNTER_PHASES. See parse_result() for the
+    format; counters are lines like
+    1426251840000000: KVM: page faults 1234
+    """
+    qemu, ovmf, linux, init = parse_result(result)
+    prealloc = durations(result, "QEMU: qemu_prealloc_mem")
+    launch = durations(result, "QEMU: sev_snp_launch_finish")
+    launch += durations(result, "QEMU: tdx_finalize_vm")
+    phases = dict(zip(BREAKDOWN, [prealloc, launch, qemu - prealloc - launch]))
+    phases.update(OVMF=ovmf, Linux=linux, Init=init)
+
+    # ends of COUNTER_PHASES (the last one is open)
+    ends = [
+        "QEMU: kvm_cpu_exec",
+        "OVMF: EXITBOOTSERVICE",
+        "Linux: init_start",
+        "Linux: systemd init end",
+    ]
+    bounds = [np.inf] * len(ends)
+    for line in result:
+        for i, label in enumerate(ends):
+            if label in line:
+                bounds[i] = event_time(line)
+    # a phase whose end was not traced ends with the next known end, so that
+    # bounds stay sorted for searchsorted()
+    for i in reversed(range(len(bounds) - 1)):
+        bounds[i] = min(bounds[i], bounds[i + 1])
+    counts: Dict[str, Dict[str, float]] = {}
+    for line in result:
+        for label, counter in COUNTERS.items():
+            if f": {label} " not in line:
+                continue
+            i = int(np.searchsorted(bounds, event_time(line), side="right"))
+            c = counts.setdefault(counter, dict.fromkeys(COUNTER_PHASES, 0.0))
+            c[COUNTER_PHASES[i]] += int(line.split()[-1])
+    return dict(phases=phases, **counts)
+
+
 # bench mark path:
 # ./bench-result/boottime/{name}/{date}
 BENCH_RESULT_DIR = Path("./bench-result/boottime")
 
 
 def load_data(name: str, date=None) -> List[float]:
-    if date is None:
-        # use the latest date
-        date = sorted(os.listdir(BENCH_RESULT_DIR / name))[-1]
-
-    path = BENCH_RESULT_DIR / name / date
+    result = store.query(BENCH_RESULT_DIR.parent, "boottime", name=name)
+    # use the latest date
+    date = store.select_dates(result, date)[0]
+    result = result[result["date"] == date]
 
     # directory contains results of multiple runs
     results = []
-    for file in os.listdir(path):
-        if file.endswith(".txt"):
-            with open(path / file) as f:
-                result = f.readlines()
-            parsed = parse_result(result)
-            results.append(parsed)
+    for _, r in result.groupby("run", sort=False):
+        phases = dict(zip(r["metric"], r["value"]))
+        results.append(np.array([phases[p] for p in PHASES]))
 
     # choose median value of the total time as a result
     total_times = np.sum(results, axis=1)
@@ -577,3 +650,109 @@ def plot_boottime_snp(
 
     plt.savefig(outdir / outname, format="pdf", pad_inches=0, bbox_inches="tight")
     print(f"Output written to {outdir}/{outname}")
+
+
+def load_breakdown(name: str, date=None) -> pd.DataFrame:
+    """Median over the runs of `name` of the BREAKDOWN phases [s] and of the
+    counters per phase (columns "page faults", "psc" if traced)"""
+    result = store.query(BENCH_RESULT_DIR.parent, "boottime", name=name)
+    date = store.select_dates(result, date)[0]
+    result = result[result["date"] == date]
+    phases = result[result["metric"].isin(BREAKDOWN) & (result["param"] == "")]
+    phases = phases.groupby("metric")["value"].median().reindex(BREAKDOWN)
+    df = pd.DataFrame({"time": phases})
+    counters = result[result["metric"].isin(COUNTERS.values())]
+    if len(counters) > 0:
+        counts = counters.groupby(["param", "metric"])["value"].median().unstack()
+        df = df.join(counts, how="outer")
+    # "QEMU" and "Ready" only have counts; COUNTER_PHASES are in boot order
+    order = ["QEMU"] + BREAKDOWN + ["Ready"]
+    return df.reindex([p for p in order if p in df.index])
+
+
+@task
+def boot_breakdown(
+    ctx: Any,
+    name: list = [],  # VM names, e.g., --name snp-direct-boot-mem64
+    date=None,
+    outdir: str = "plot",
+    result_dir=None,
+) -> None:
+    """Print and plot the fine-grained boot phases of VMs with the page
+    faults and SNP page state changes (psc) counted in each phase"""
+    if result_dir is not None:
+        global BENCH_RESULT_DIR
+        BENCH_RESULT_DIR = Path(result_dir)
+    times = {}
+    for n in name:
+        df = load_breakdown(n, date)
+        print(f"{n}:")
+        print(df.to_string(float_format="{:.3f}".format))
+        times[n] = df["time"].reindex(BREAKDOWN)
+    df = pd.DataFrame(times).T
+
+    fig, ax = plt.subplots(figsize=(figwidth_full, 0.4 + 0.3 * len(df)))
+    df.plot(kind="barh", stacked=True, ax=ax, color=palette, edgecolor="black")
+    ax.set_xlabel("Time (s)")
+    ax.set_ylabel("")
+    ax.invert_yaxis()
+    ax.legend(
+        ncol=len(BREAKDOWN), fontsize=5, loc="upper center", bbox_to_anchor=(0.5, 1.25)
+    )
+    plt.tight_layout()
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    plt.savefig(outdir / "boottime_breakdown.pdf", format="pdf", bbox_inches="tight")
+    print(f"Output written to {outdir}/boottime_breakdown.pdf")
+
+
+@task
+def accept_progress(
+    ctx: Any,
+    name: list = [],  # VM names, e.g., --name snp-direct-boot-mem64
+    counter: str = "page faults",  # or psc
+    date=None,
+    outdir: str = "plot",
+    result_dir=None,
+) -> None:
+    """Plot the cumulative count of a counter (page faults: memory the guest
+    touches or accepts, psc: SNP page state changes) over the time since the
+    first vCPU ran, one line per run"""
+    if result_dir is not None:
+        global BENCH_RESULT_DIR
+        BENCH_RESULT_DIR = Path(result_dir)
+    label = {v: k for k, v in COUNTERS.items()}[counter]
+    fig, ax = plt.subplots(figsize=(figwidth_half, 2.2))
+    for color, n in zip(palette, name):
+        result = store.query(BENCH_RESULT_DIR.parent, "boottime", name=n)
+        run_dir = BENCH_RESULT_DIR / n / store.select_dates(result, date)[0]
+        for i, file in enumerate(sorted(run_dir.glob("*.txt"))):
+            with open(file) as f:
+                lines = f.readlines()
+            starts = [event_time(l) for l in lines if "QEMU: kvm_cpu_exec" in l]
+            if not starts:
+                print(f"WARN: skip {file}: no QEMU: kvm_cpu_exec event")
+                continue
+            start = starts[0]
+            points = [
+                (event_time(l), int(l.split()[-1])) for l in lines if f": {label} " in l
+            ]
+            if not points:
+                continue
+            t, count = np.array(points).T
+            ax.plot(
+                (t - start) / 1e9,
+                np.cumsum(count),
+                color=color,
+                linewidth=0.8,
+                label=n if i == 0 else None,
+            )
+    ax.set_xlabel("Time since the first vCPU run (s)")
+    ax.set_ylabel(f"Cumulative {counter}")
+    ax.legend(fontsize=5)
+    plt.tight_layout()
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    outname = f"boottime_{counter.replace(' ', '_')}.pdf"
+    plt.savefig(outdir / outname, format="pdf", bbox_inches="tight")
+    print(f"Output written to {outdir}/{outname}")
@@ -12,6 +12,9 @@ from pathlib import Path
 
 from invoke import task
 
+import store
+from parse_cache import cached
+
 mpl.use("Agg")
 mpl.rcParams["text.latex.preamble"] = r"\usepackage{amsmath}"
 mpl.rcParams["pdf.fonttype"] = 42
@@ -55,27 +58,33 @@ hatches3 = ["", "*", "//", "-", "\\", ".", "o-", "*-"]
 BENCH_RESULT_DIR = Path("./bench-result/network")
 
 
+@cached
+def parse_iperf_log(file: Path) -> float:
+    """Return the throughput (Gbits/sec) of an iperf log"""
+    with file.open("r") as f:
+        lines = f.readlines()
+
+    # example format:
+    # > [SUM]   0.00-10.00  sec  11.7 GBytes  10.1 Gbits/sec                  receiver
+    # find the line with [SUM] from the end
+    for line in reversed(lines):
+        if "[SUM]" in line:
+            break
+    else:
+        raise ValueError("No [SUM] line found")
+    th = float(line.split()[5])
+    if line.split()[6] == "Mbits/sec":
+        th /= 1000.0
+    return th
+
+
 def parse_iperf_result_sub(
     name: str, mode: str, date: str, lebel: str, pkt_size: [int]
 ) -> pd.DataFrame:
     ths = []
     for size in pkt_size:
         file = BENCH_RESULT_DIR / "iperf" / name / mode / date / f"{size}.log"
-        with file.open("r") as f:
-            lines = f.readlines()
-
-        # example format:
-        # > [SUM]   0.00-10.00  sec  11.7 GBytes  10.1 Gbits/sec                  receiver
-        # find the line with [SUM] from the end
-        for line in reversed(lines):
-            if "[SUM]" in line:
-                break
-        else:
-            raise ValueError("No [SUM] line found")
-        th = float(line.split()[5])
-        if line.split()[6] == "Mbits/sec":
-            th /= 1000.0
-        ths.append(th)
+        ths.append(parse_iperf_log(file))
 
     df = pd.DataFrame({"name": lebel, "size": pkt_size, "throughput": ths})
     return df
@@ -99,58 +108,60 @@ def parse_iperf_result(
     else:
         raise ValueError(f"Invalid mode: {mode}")
 
-    dates = []
-    if date is None:
-        # use the latest date
-        dates = sorted(os.listdir(BENCH_RESULT_DIR / "iperf" / name / mode))[-max_num:]
-    else:
-        dates.append(date)
+    result = store.query(BENCH_RESULT_DIR.parent, "iperf", name=name, tags=mode)
+    dates = store.select_dates(result, date, max_num)
 
     dfs = []
     for date in dates:
-        df = parse_iperf_result_sub(name, mode, date, label, pktsize)
-        dfs.append(df)
+        r = result[result["date"] == date].set_index("param")["value"]
+        sizes = [s for s in pktsize if str(s) in r.index]
+        ths = [r[str(s)] for s in sizes]
+        dfs.append(pd.DataFrame({"name": label, "size": sizes, "throughput": ths}))
 
     df = pd.concat(dfs)
 
     return df
 
 
+@cached
+def parse_ping_log(file: Path) -> List[float]:
+    """Return the latencies (ms) of a ping log"""
+    with file.open("r") as f:
+        lines = f.readlines()
+
+    # example format:
+    # > 128 bytes from 172.44.0.2: icmp_seq=1 ttl=64 time=0.131 ms
+    # > 128 bytes from 172.44.0.2: icmp_seq=2 ttl=64 time=0.221 ms
+    # > 128 bytes from 172.44.0.2: icmp_seq=3 ttl=64 time=0.212 ms
+    # > 128 bytes from 172.44.0.2: icmp_seq=4 ttl=64 time=0.200 ms
+    lats = []
+    for line in lines:
+        if "icmp_seq" in line:
+            lats.append(float(line.split()[6].split("=")[1]))
+    # drop firt 3 pings to get stable result
+    return lats[3:]
+
+
 def parse_ping_result(name: str, label: str, date=None, all=False) -> pd.DataFrame:
     if all:
         pktsize = [64, 128, 256, 512, 1024, 1460]
-        pktsize_actual = [64, 128, 256, 512, 1024, 1460]
     else:
         pktsize = [64]
-        pktsize_actual = [64]
-    pktsize_ = []
-    lats = []
 
-    if date is None:
-        # use the latest date
-        date = sorted(os.listdir(BENCH_RESULT_DIR / "ping" / name))[-1]
+    result = store.query(BENCH_RESULT_DIR.parent, "ping", name=name)
+    # use the latest date
+    date = store.select_dates(result, date)[0]
 
     print(f"date: {date}")
 
-    for size in pktsize_actual:
-        path = Path(f"{BENCH_RESULT_DIR}/ping/{name}/{date}/{size}.log")
-        if not path.exists():
-            print(f"XXX: {path} not found!")
+    result = result[result["date"] == date]
+    pktsize_ = []
+    lats = []
+    for size in pktsize:
+        lats_ = result[result["param"] == str(size)]["value"].tolist()
+        if not lats_:
+            print(f"XXX: {name}/{date}/{size}.log not found!")
             continue
-        with path.open("r") as f:
-            lines = f.readlines()
-
-        # example format:
-        # > 128 bytes from 172.44.0.2: icmp_seq=1 ttl=64 time=0.131 ms
-        # > 128 bytes from 172.44.0.2: icmp_seq=2 ttl=64 time=0.221 ms
-        # > 128 bytes from 172.44.0.2: icmp_seq=3 ttl=64 time=0.212 ms
-        # > 128 bytes from 172.44.0.2: icmp_seq=4 ttl=64 time=0.200 ms
-        lats_ = []
-        for line in lines:
-            if "icmp_seq" in line:
-                lats_.append(float(line.split()[6].split("=")[1]))
-        # drop firt 3 pings to get stable result
-        lats_ = lats_[3:]
         lats.extend(lats_)
         pktsize_.extend([size] * len(lats_))
 
@@ -158,6 +169,7 @@ def parse_ping_result(name: str, label: str, date=None, all=False) -> pd.DataFra
     return df
 
 
+@cached
 def parse_memtier_result_sub(
     path: str, label: str, server: str, tls: bool = False
 ) -> pd.DataFrame:
@@ -198,40 +210,35 @@ def parse_memtier_result_sub(
     return df
 
 
+def memtier_df(
+    result: pd.DataFrame, label: str, server: str, tls: bool
+) -> pd.DataFrame:
+    tls_ = " (tls)" if tls else ""
+    return pd.DataFrame(
+        {
+            "name": label,
+            "workload": [f"{w}{tls_}" for w in result["param"]],
+            "throughput": result["value"].tolist(),
+            "server": server,
+        }
+    )
+
+
 def parse_memtier_result(
     name: str, label: str, server: str, date=None, date_tls=None, max_num: int = 10
 ) -> pd.DataFrame:
-    dates = []
-
-    if date is None:
-        dates = sorted(os.listdir(BENCH_RESULT_DIR / "memtier" / server / name))[
-            -max_num:
-        ]
-    else:
-        dates.append(date)
+    result = store.query(BENCH_RESULT_DIR.parent, "memtier", name=name, tags=server)
+    result_tls = store.query(
+        BENCH_RESULT_DIR.parent, "memtier", name=name, tags=f"{server}-tls"
+    )
+    dates = store.select_dates(result, date, max_num)
+    date_tls = store.select_dates(result_tls, date_tls)[0]
 
     dfs = []
     for date in dates:
-        df = parse_memtier_result_sub(
-            BENCH_RESULT_DIR / "memtier" / server / name / date / "memtier.log",
-            label,
-            server,
-            False,
-        )
-        if date_tls is None:
-            date_tls = sorted(
-                os.listdir(BENCH_RESULT_DIR / "memtier" / f"{server}-tls" / name)
-            )[-1]
-        df_tls = parse_memtier_result_sub(
-            BENCH_RESULT_DIR
-            / "memtier"
-            / f"{server}-tls"
-            / name
-            / date_tls
-            / "memtier.log",
-            f"{label}",
-            server,
-            True,
+        df = memtier_df(result[result["date"] == date], label, server, False)
+        df_tls = memtier_df(
+            result_tls[result_tls["date"] == date_tls], label, server, True
         )
         dfs.append(df)
         dfs.append(df_tls)
@@ -241,6 +248,7 @@ def parse_memtier_result(
     return df
 
 
+@cached
 def parse_nginx_result_sub(path: str, name: str, workload: str) -> pd.DataFrame:
     """
         Example output:
@@ -268,23 +276,22 @@ def parse_nginx_result_sub(path: str, name: str, workload: str) -> pd.DataFrame:
 def parse_nginx_result(
     name: str, label: str, date=None, max_num: int = 10
 ) -> pd.DataFrame:
-    dates = []
-    if date is None:
-        dates = sorted(os.listdir(BENCH_RESULT_DIR / "nginx" / name))[-max_num:]
-    else:
-        dates.append(date)
+    result = store.query(BENCH_RESULT_DIR.parent, "nginx", name=name)
+    dates = store.select_dates(result, date, max_num)
 
     dfs = []
     for date in dates:
-        df = parse_nginx_result_sub(
-            BENCH_RESULT_DIR / "nginx" / name / date / "http.log", label, "http"
-        )
-        df_ssl = parse_nginx_result_sub(
-            BENCH_RESULT_DIR / "nginx" / name / date / "https.log", label, "https"
-        )
-
-        dfs.append(df)
-        dfs.append(df_ssl)
+        r = result[result["date"] == date].set_index("param")["value"]
+        for workload in ["http", "https"]:
+            dfs.append(
+                pd.DataFrame(
+                    {
+                        "name": [label],
+                        "workload": [workload],
+                        "throughput": [r[workload]],
+                    }
+                )
+            )
 
     df = pd.concat(dfs)
 
@@ -13,7 +13,9 @@ from matplotlib.patches import Patch
 
 from invoke import task
 
+import compare
 import phoronix
+import store
 
 # common graph settings
 
@@ -72,11 +74,16 @@ BENCH_RESULT_DIR = Path("./bench-result/phoronix/")
 
 
 def parse_result(name: str, date: Optional[str] = None) -> pd.DataFrame:
-    if date is None:
-        date = sorted(os.listdir(BENCH_RESULT_DIR / name / "npb"))[-1]
-    path = BENCH_RESULT_DIR / name / "npb" / date
-
-    df = phoronix.parse_xml(path)
+    result = store.query(BENCH_RESULT_DIR.parent, "phoronix", name=name, tags="npb")
+    date = store.select_dates(result, Path(date).stem if date else None)[0]
+    result = result[result["date"] == date]
+    df = pd.DataFrame(
+        {
+            "identifier": result["param"].tolist(),
+            "benchmark_id": result["metric"].tolist(),
+            "value": result["value"].tolist(),
+        }
+    )
     return df
 
 
@@ -232,7 +239,7 @@ def plot_npb(
     relative = cvm_index / vm_index
     print(relative)
     # geomean
-    geomean = np.exp(np.mean(np.log(relative)))
+    geomean = compare.geomean(relative)
     overhead = (1 - geomean) * 100
     print(f"Geometric mean of relative values: {geomean}")
     print(f"Overhead: {overhead:.2f}%")
@@ -438,8 +445,8 @@ def plot_npb_omp(
     print(f"Overhead (active): {ov_active}")
 
     # calculate geomen of overhead
-    geomean_passive = np.exp(np.mean(np.log(ov_passive)))
-    geomean_active = np.exp(np.mean(np.log(ov_active)))
+    geomean_passive = compare.geomean(ov_passive)
+    geomean_active = compare.geomean(ov_active)
     print(f"Geometric mean of overhead (passive): {geomean_passive}")
     print(f"Geometric mean of overhead (active): {geomean_active}")
 
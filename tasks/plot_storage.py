@@ -14,6 +14,9 @@ import numpy as np
 import pandas as pd
 import seaborn as sns
 
+import store
+from parse_cache import cached
+
 # common graph settings
 
 mpl.use("Agg")
@@ -58,6 +61,29 @@ def read_json(file):
     return data
 
 
+@cached
+def read_fio_result(file: Path, name: str) -> pd.DataFrame:
+    return process_data(read_json(file), name)
+
+
+FIO_COLUMNS = [
+    "name",
+    "jobname",
+    "read_iops_mean",
+    "read_iops_stddev",
+    "read_bw_mean",
+    "read_bw_dev",
+    "read_lat_mean",
+    "read_lat_dev",
+    "write_iops_mean",
+    "write_iops_stddev",
+    "write_bw_mean",
+    "write_bw_dev",
+    "write_lat_mean",
+    "write_lat_dev",
+]
+
+
 def process_data(data, name):
     d = []
     for job in data["jobs"]:
@@ -79,23 +105,7 @@ def process_data(data, name):
                 float(job["write"]["lat_ns"]["stddev"]),
             ]
         )
-    columns = [
-        "name",
-        "jobname",
-        "read_iops_mean",
-        "read_iops_stddev",
-        "read_bw_mean",
-        "read_bw_dev",
-        "read_lat_mean",
-        "read_lat_dev",
-        "write_iops_mean",
-        "write_iops_stddev",
-        "write_bw_mean",
-        "write_bw_dev",
-        "write_lat_mean",
-        "write_lat_dev",
-    ]
-    df = pd.DataFrame(d, columns=columns)
+    df = pd.DataFrame(d, columns=FIO_COLUMNS)
     return df
 
 
@@ -105,23 +115,20 @@ BENCH_RESULT_DIR = Path("./bench-result/fio")
 def read_result(
     name: str, label: str, jobname: str, date=None, max_num: int = 10
 ) -> pd.DataFrame:
-    dates = []
-    if date is None:
-        # use the latest results
-        # note: fio reports stddev
-        dates = [
-            Path(i).stem
-            for i in sorted(os.listdir(BENCH_RESULT_DIR / name / jobname))[-max_num:]
-        ]
-    else:
-        dates.append(date)
+    # use the latest results
+    # note: fio reports stddev
+    result = store.query(BENCH_RESULT_DIR.parent, "fio", name=name, tags=jobname)
+    dates = store.select_dates(result, date, max_num)
 
     dfs = []
     for date in dates:
-        file = BENCH_RESULT_DIR / name / jobname / f"{date}.json"
-        data = read_json(file)
-        df = process_data(data, label)
-        dfs.append(df)
+        r = result[result["date"] == date]
+        df = r.pivot_table(
+            index="param", columns="metric", values="value", sort=False
+        ).reset_index()
+        df = df.rename(columns={"param": "jobname"}).rename_axis(columns=None)
+        df.insert(0, "name", label)
+        dfs.append(df[FIO_COLUMNS])
 
     # merge df
     df = pd.concat(dfs)
@@ -787,3 +794,158 @@ def analyze_fio(
 
     print(df[(df["jobname"] == "iops randwrite")]["write_iops_mean"])
     print(cdf[(cdf["jobname"] == "iops randwrite")]["write_iops_mean"])
+
+
+def guest_latency(data: Dict[str, Any]) -> Dict[str, float]:
+    """Mean fio latency [ns] per direction over all jobs, weighted by I/Os"""
+    latency = {}
+    for direction in ["read", "write"]:
+        ios = [job[direction]["total_ios"] for job in data["jobs"]]
+        lat = [job[direction]["lat_ns"]["mean"] for job in data["jobs"]]
+        if sum(ios) > 0:
+            latency[direction] = float(np.average(lat, weights=ios))
+    return latency
+
+
+@task
+def host_latency(
+    ctx: Any,
+    name: str,  # VM name with the storage suffixes, e.g., amd-direct-medium-native
+    jobfile: str = "test",
+    result_dir=None,
+):
+    """Compare fio's latency in the guest with QEMU's block layer latency on the
+    host of runs with --blockstats (see blockstats.py). The difference is spent
+    in the guest and virtio (e.g., in swiotlb bounce buffers)."""
+    from blockstats import load_samples, summarize
+
+    outdir = Path(result_dir) if result_dir is not None else BENCH_RESULT_DIR
+    rows = []
+    for host_file in sorted((outdir / name / jobfile).glob("*.blockstats.jsonl")):
+        date = host_file.name.split(".")[0]
+        fio_file = host_file.parent / f"{date}.json"
+        samples = load_samples(host_file)
+        if not fio_file.exists() or not samples:
+            continue
+        host = summarize(samples)
+        for direction, guest_ns in guest_latency(read_json(fio_file)).items():
+            host_ns = host.get(f"{direction}_lat_mean", np.nan)
+            rows.append(
+                dict(
+                    date=date,
+                    direction=direction,
+                    guest_us=guest_ns / 1000,
+                    host_us=host_ns / 1000,
+                    guest_only_us=(guest_ns - host_ns) / 1000,
+                    host_share=host_ns / guest_ns * 100,
+                )
+            )
+    if not rows:
+        print(f"No fio results with block statistics of {name}/{jobfile}")
+        return
+    df = pd.DataFrame(rows)
+    with pd.option_context("display.width", 200):
+        print(df.to_string(index=False, float_format="{:.1f}".format))
+
+
+SWEEP_PARAMS = ["rw", "ioengine", "bs", "iodepth", "numjobs"]
+
+
+def bs_bytes(bs: str) -> int:
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30}
+    bs = bs.lower()
+    if bs[-1] in units:
+        return int(bs[:-1]) * units[bs[-1]]
+    return int(bs)
+
+
+def read_sweep(name: str, label: str, date=None, max_num: int = 1) -> pd.DataFrame:
+    """Results of the latest `max_num` fio sweeps of `name`, a row per job and
+    date with the parameters of the job name (see fio_matrix.py)"""
+    from fio_matrix import FioParams
+
+    result = store.query(BENCH_RESULT_DIR.parent, "fio-sweep", name=name)
+    dates = store.select_dates(result, date, max_num)
+    result = result[result["date"].isin(dates)]
+    if len(result) == 0:
+        raise ValueError(f"No fio sweep results of {name}")
+    df = result.pivot_table(
+        index=["date", "tags"], columns="metric", values="value", sort=False
+    ).reset_index()
+    params = pd.DataFrame([vars(FioParams.parse(t)) for t in df["tags"]])
+    df = pd.concat([df.rename_axis(columns=None), params], axis=1)
+    df["bs_bytes"] = df["bs"].map(bs_bytes)
+    df.insert(0, "name", label)
+    return df
+
+
+@task
+def plot_fio_sweep(
+    ctx: Any,
+    name: [str] = [],  # VM names with the storage suffixes (the first is the baseline)
+    label: [str] = [],  # legend labels of the names (default: the names)
+    x: str = "iodepth",  # iodepth, numjobs or bs
+    metric: str = "iops",  # throughput metric: iops or bw
+    date=None,
+    max_num: int = 1,  # number of latest sweeps per name
+    outdir="plot",
+    result_dir=None,
+):
+    """Throughput and latency of fio sweeps (run-fio-sweep) as curves over x,
+    per rw pattern. With several names, the overhead against the first name is
+    printed per x, which shows where the overhead stops being amortized."""
+    if result_dir is not None:
+        global BENCH_RESULT_DIR
+        BENCH_RESULT_DIR = Path(result_dir)
+    if x not in ["iodepth", "numjobs", "bs"]:
+        raise ValueError(f"x must be iodepth, numjobs or bs: {x}")
+    labels = label or name
+    df = pd.concat(
+        [read_sweep(n, l, date, max_num) for n, l in zip(name, labels)],
+        ignore_index=True,
+    )
+    xcol = "bs_bytes" if x == "bs" else x
+    # the other parameters that vary distinguish the curves
+    others = [p for p in SWEEP_PARAMS if p not in ["rw", x] and df[p].nunique() > 1]
+    df["series"] = df[others].astype(str).agg(" ".join, axis=1) if others else ""
+
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    for rw, d in df.groupby("rw"):
+        direction = "write" if "write" in rw else "read"
+        y = f"{direction}_{metric}_mean"
+        d = d.assign(lat_us=d[f"{direction}_lat_mean"] / 1000)
+        fig, axes = plt.subplots(1, 2, figsize=(figwidth_full, 2.5))
+        style = "series" if others else None
+        for ax, col, ylabel in [
+            (axes[0], y, "IOPS" if metric == "iops" else "Bandwidth [KiB/s]"),
+            (axes[1], "lat_us", "Latency [us]"),
+        ]:
+            sns.lineplot(
+                data=d, x=xcol, y=col, hue="name", style=style, marker="o", ax=ax
+            )
+            ax.set_xscale("log", base=2)
+            ax.set_xlabel(x)
+            ax.set_ylabel(ylabel)
+        axes[1].get_legend().remove()
+        axes[0].set_title(rw, fontsize=FONTSIZE)
+        outfile = outdir / f"fio_sweep_{rw}_{x}.pdf"
+        plt.savefig(outfile, format="pdf", pad_inches=0, bbox_inches="tight")
+        print(f"saved to {outfile}")
+        plt.close(fig)
+
+        if len(labels) < 2:
+            continue
+        keys = ["series", xcol]
+        medians = d.groupby(["name"] + keys)[[y, "lat_us"]].median()
+        base = medians.loc[labels[0]]
+        for target in labels[1:]:
+            rel = medians.loc[target] / base
+            table = pd.DataFrame(
+                {
+                    f"{metric} overhead [%]": (1 - rel[y]) * 100,
+                    "latency overhead [%]": (rel["lat_us"] - 1) * 100,
+                }
+            )
+            print(f"{rw}: {target} vs {labels[0]}")
+            print(table.to_string(float_format="{:.1f}".format))
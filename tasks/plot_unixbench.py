@@ -13,6 +13,7 @@ from pathlib import Path
 from invoke import task
 
 import phoronix
+import store
 
 # common graph settings
 
@@ -114,21 +115,19 @@ def parse_result(type: str, name: str, date: Optional[str] = None, max_num:int =
     System Call Overhead                          15000.0   13710090.9   9140.1
     """
 
-    path = BENCH_RESULT_DIR / name
-    files = []
-    if date is None:
-        files = os.listdir(path)
-        # remove if file contains extension (e.g., .html)
-        files = [f for f in files if "." not in f and Path(path / f).is_file()]
-        date = sorted(files)[-max_num:]
-        files = [path / d for d in date]
-    else:
-        path = path / date
-        files.append(path)
+    result = store.query(BENCH_RESULT_DIR.parent, "unixbench", name=name)
+    dates = store.select_dates(result, date, max_num)
 
     dfs = []
-    for file in files:
-        df = parse_result_sub(file, type)
+    for date in dates:
+        r = result[result["date"] == date]
+        df = pd.DataFrame(
+            {
+                "type": type,
+                "benchmark": r["metric"].tolist(),
+                "index": r["value"].tolist(),
+            }
+        )
         dfs.append(df)
     df = pd.concat(dfs)
 
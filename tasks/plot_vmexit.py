@@ -38,41 +38,81 @@ palette = [vm_col, cvm_col, cvm_opt_col]
 hatches = ["", "//", "x"]
 
 # bench mark path:
-# ./bench-result/vmexit/{name}.txt
+# ./bench-result/vmexit/{name}/{date}/{i}.txt (inv vm.start --action run-vmexit)
+# or ./bench-result/vmexit/{name}.txt (saved by hand)
 BENCH_RESULT_DIR = Path("./bench-result/vmexit")
 
 
 def load_data(name):
-    file = BENCH_RESULT_DIR / f"{name}.txt"
-    start = -1
-    with open(file) as f:
-        lines = f.readlines()
-        # find message "bench: Initializing" form the end
-        for i, line in enumerate(reversed(lines)):
-            if "bench: Initializing" in line:
-                start = len(lines) - i
-                break
-
-    if start == -1:
-        raise (f"Invalid format: {file}")
-
-    # Example format
-    # [  104.161314] bench: _cpuid_0, total_cycle 273468339, avg_cycle 2734, total_time 101286422, avg_time 1012
-    # [  104.263563] bench: _cpuid_1, total_cycle 273312738, avg_cycle 2733, total_time 101228723, avg_time 1012
-
-    results = {}
-    for i in range(start, len(lines)):
-        if "]" not in lines[i]:
-            continue
-        line = lines[i].split("]")[1]
-        if "bench:" in line and "avg_time" in line:
-            name = line.split(",")[0].strip().split()[1]
-            avg_time = int(line.split(",")[4].strip().split()[1])
-            results[name] = avg_time
-        elif "bench: done" in line:
-            break
-
-    return results
+    """avg_time [ns] per operation (the median over runs)"""
+    from vmexit_bench import load_runs
+
+    runs = load_runs(name, BENCH_RESULT_DIR)
+    return {
+        op: int(np.median([r.avg_time for r in results]))
+        for op, results in runs.items()
+    }
+
+
+@task
+def stats(
+    ctx: Any, name: str, percentiles="50,90,99,99.9", result_dir=None, output=None
+):
+    """Print per-operation latency percentiles [ns] over all runs of a VM"""
+    from vmexit_bench import load_runs, summarize
+
+    result_dir = Path(result_dir) if result_dir is not None else BENCH_RESULT_DIR
+    ps = [float(p) for p in percentiles.split(",")]
+    df = summarize(load_runs(name, result_dir), ps)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(df.to_string(index=False, float_format="{:.0f}".format))
+    if output is not None:
+        df.to_csv(output, index=False)
+        print(f"Saved {output}")
+
+
+@task
+def plot_vmexit_cdf(ctx: Any, cvm="snp", outdir="plot", result_dir=None):
+    """CDF of per-call latencies of the operations of plot-vmexit"""
+    from vmexit_bench import load_runs, merged_hist
+
+    result_dir = Path(result_dir) if result_dir is not None else BENCH_RESULT_DIR
+    vm, cvm_label = ("amd", "snp") if cvm == "snp" else ("intel", "td")
+    ops = {
+        "cpuid_1": "_cpuid_1",
+        "cpuid_40M": "_cpuid_0x40000000",
+        "msr": "_rdmsr_0x1b",
+        "hypercall": "_hypercall_2",
+        "inb": "_inb_0x40",
+    }
+    runs = {"vm": load_runs(vm, result_dir), cvm_label: load_runs(cvm, result_dir)}
+
+    fig, axes = plt.subplots(1, len(ops), figsize=(figwidth_full, 1.5), sharey=True)
+    for ax, (label, op) in zip(axes, ops.items()):
+        lines = [("vm", runs["vm"], op), (cvm_label, runs[cvm_label], op)]
+        lines.append((f"{cvm_label}*", runs[cvm_label], f"{cvm}{op}"))
+        for (line_label, data, key), color in zip(lines, palette):
+            if key not in data:
+                continue
+            hist = merged_hist(data[key])
+            if len(hist) == 0:
+                continue
+            # step at the upper bound of each bucket
+            cdf = hist["count"].cumsum() / hist["count"].sum()
+            ax.step(hist["high_ns"], cdf, where="post", color=color, label=line_label)
+        ax.set_xscale("log")
+        ax.set_title(label, fontsize=7)
+        ax.set_xlabel("Time (ns)", fontsize=7)
+    axes[0].set_ylabel("CDF")
+    axes[0].legend(fontsize=5, loc="lower right")
+    sns.despine(top=True)
+    plt.tight_layout()
+
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    plt.savefig(
+        outdir / "vmexit_cdf.pdf", format="pdf", pad_inches=0, bbox_inches="tight"
+    )
 
 
 @task
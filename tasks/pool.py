@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import atexit
+import subprocess
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+import psutil
+
+from qemu import QemuVm
+
+ResetHook = Callable[[QemuVm], None]
+PoolKey = Tuple[Any, ...]
+
+
+def reset_servers(vm: QemuVm) -> None:
+    """Stop the benchmark servers started by the previous action
+    (see benchmarks/network/justfile)"""
+    for server in ["iperf", "redis-server", "memcached", "nginx"]:
+        vm.ssh_cmd(
+            ["pkill", "-x", server],
+            check=False,
+            stderr=subprocess.DEVNULL,
+            verbose=False,
+        )
+
+
+def reset_mounts(vm: QemuVm) -> None:
+    """Unmount the virtio-blk disk so that storage.mount_disk() starts from scratch"""
+    vm.ssh_cmd(
+        ["sudo", "umount", "/mnt"],
+        check=False,
+        stderr=subprocess.DEVNULL,
+        verbose=False,
+    )
+
+
+def reset_page_cache(vm: QemuVm) -> None:
+    """Drop the guest page cache so that the next run does not start warm"""
+    vm.ssh_cmd(
+        ["sh", "-c", "sync; echo 3 > /proc/sys/vm/drop_caches"],
+        check=False,
+        verbose=False,
+    )
+
+
+# hooks executed (in order) before a warm VM is handed out again
+RESET_HOOKS: List[ResetHook] = [reset_servers, reset_mounts, reset_page_cache]
+
+
+def register_reset_hook(hook: ResetHook) -> None:
+    RESET_HOOKS.append(hook)
+
+
+def pool_key(qemu_cmd: List[str], config: dict) -> PoolKey:
+    """VMs are only shared if they are started with exactly the same QEMU command.
+    type and size are included to make the key readable in logs."""
+    return (config["type"], config["size"], tuple(qemu_cmd))
+
+
+def conflicts(a: dict, b: dict) -> bool:
+    """Return True if two VMs cannot be alive at the same time because they
+    use the same host resources (ssh port forwarding, vsock CID, tap device)"""
+    for key in ["ssh_port", "guest_cid"]:
+        if a.get(key) is not None and a.get(key) == b.get(key):
+            return True
+    if a.get("virtio_nic") and b.get("virtio_nic"):
+        return True
+    return False
+
+
+@dataclass
+class PooledVm:
+    vm: QemuVm
+    config: dict
+    # holds the spawn_qemu() context. closing it shuts down the VM
+    stack: ExitStack = field(default_factory=ExitStack)
+    runs: int = 0
+
+    def alive(self) -> bool:
+        return psutil.pid_exists(self.vm.pid)
+
+    def close(self) -> None:
+        self.stack.close()
+
+
+class VmPool:
+    """Keep booted VMs alive across actions.
+
+    VMs are indexed by pool_key() (VM type, size and the complete QEMU command
+    line, i.e., including virtio-blk/virtio-nic options). When an action
+    releases a VM, the VM stays alive and the next action with the same key
+    gets it after RESET_HOOKS ran.
+    """
+
+    def __init__(self, max_idle_per_key: int = 1) -> None:
+        self.max_idle_per_key = max_idle_per_key
+        self.idle: Dict[PoolKey, List[PooledVm]] = {}
+        self.busy: List[PooledVm] = []
+
+    def _take(self, key: PoolKey) -> Optional[PooledVm]:
+        entries = self.idle.get(key, [])
+        while entries:
+            entry = entries.pop()
+            if entry.alive():
+                return entry
+            print(f"[pool] drop dead VM (pid {entry.vm.pid})")
+            entry.close()
+        return None
+
+    def _evict_conflicting(self, config: dict) -> None:
+        for key, entries in self.idle.items():
+            for entry in [e for e in entries if conflicts(e.config, config)]:
+                print(f"[pool] shutdown idle VM {key[:2]} to free host resources")
+                entries.remove(entry)
+                entry.close()
+
+    def _reset(self, entry: PooledVm) -> None:
+        for hook in RESET_HOOKS:
+            hook(entry.vm)
+
+    @contextmanager
+    def acquire(
+        self,
+        key: PoolKey,
+        boot: Callable[[], ContextManager[QemuVm]],
+        config: dict,
+    ) -> Iterator[QemuVm]:
+        """Yield a warm VM for `key`, or boot a new one with `boot()`.
+        `boot()` must return a context manager that yields a VM reachable via ssh."""
+        entry = self._take(key)
+        if entry is None:
+            self._evict_conflicting(config)
+            print(f"[pool] boot a new VM for {key[:2]}")
+            entry = PooledVm(vm=None, config=config)
+            try:
+                entry.vm = entry.stack.enter_context(boot())
+            except BaseException:
+                entry.close()
+                raise
+        else:
+            print(f"[pool] reuse VM (pid {entry.vm.pid}, {entry.runs} runs)")
+            self._reset(entry)
+
+        self.busy.append(entry)
+        try:
+            yield entry.vm
+        except BaseException:
+            # the VM may be in an unknown state, do not hand it out again
+            self.busy.remove(entry)
+            entry.close()
+            raise
+        self.busy.remove(entry)
+        entry.runs += 1
+        entries = self.idle.setdefault(key, [])
+        if len(entries) < self.max_idle_per_key and entry.alive():
+            entries.append(entry)
+        else:
+            entry.close()
+
+    def close(self) -> None:
+        """Shutdown all VMs in the pool"""
+        for entries in self.idle.values():
+            for entry in entries:
+                entry.close()
+        self.idle.clear()
+        for entry in self.busy:
+            entry.close()
+        self.busy.clear()
+
+
+_POOL: Optional[VmPool] = None
+
+
+def get_pool() -> VmPool:
+    """Return the process-wide VM pool. VMs are shut down when the process exits."""
+    global _POOL
+    if _POOL is None:
+        _POOL = VmPool()
+        atexit.register(_POOL.close)
+    return _POOL
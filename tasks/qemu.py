@@ -4,9 +4,10 @@
 # (c) 2021-2022 Jörg Thalheim
 # https://github.com/Mic92/vmsh/blob/358cd4b6ec7de0dcac05a12e32486ef30658018c/tests/qemu.py
 
-import json
+import itertools
 import os
 import re
+import select
 import socket
 import subprocess
 import psutil
@@ -19,59 +20,58 @@ from shlex import quote
 from tempfile import TemporaryDirectory
 from typing import Any, Dict, Iterator, List, Text, Optional
 
+from pinning import PinPlan, vhost_threads
 from procs import ChildFd, pprint_cmd, run
+from qmp import AsyncQmpClient, EventCallback, run_sync
 from config import PROJECT_ROOT
 
+# each spawned VM gets its own tmux server so that several VMs can be alive at once
+_tmux_session_ids = itertools.count()
+
+# The guest writes READY_MARKER to this virtio-serial port once sshd is up
+# (see the vm-ready service in nix/guest-config.nix)
+READY_PORT_NAME = "org.cvm-eval.ready"
+READY_MARKER = b"ready"
+# if no marker arrived within this window [s], also poll ssh in case the guest
+# image does not have the vm-ready service
+READY_MARKER_WINDOW = 1.0
+SSH_POLL_INTERVAL = 0.1
+
 
 class QmpSession:
-    def __init__(self, sock: socket.socket) -> None:
-        self.sock = sock
+    """Blocking interface to AsyncQmpClient.
+
+    The client runs in the event loop shared by all VMs of this process
+    (qmp.get_event_loop()). Use `client` with qmp.run_sync() (or from a
+    coroutine in that loop) to issue concurrent commands or subscribe to events.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.client: AsyncQmpClient = run_sync(AsyncQmpClient.connect(path))
         self.pending_events: Queue[Dict[str, Any]] = Queue()
-        self.reader = sock.makefile("r")
-        self.writer = sock.makefile("w")
-        hello = self._result()
-        assert "QMP" in hello, f"Unexpected result: {hello}"
-        self.send("qmp_capabilities")
-
-    def _readmsg(self) -> Dict[str, Any]:
-        line = self.reader.readline()
-        return json.loads(line)
-
-    def _raise_unexpected_msg(self, msg: Dict[str, Any]) -> None:
-        m = json.dumps(msg, sort_keys=True, indent=4)
-        raise RuntimeError(f"Got unexpected qmp response: {m}")
-
-    def _result(self) -> Dict[str, Any]:
-        while True:
-            # QMP is in the handshake
-            res = self._readmsg()
-            if "return" in res or "QMP" in res:
-                return res
-            elif "event" in res:
-                self.pending_events.put(res)
-                continue
-            else:
-                self._raise_unexpected_msg(res)
+        self.client.subscribe(None, self.pending_events.put_nowait)
 
     def events(self) -> Iterator[Dict[str, Any]]:
         while not self.pending_events.empty():
             yield self.pending_events.get()
 
-        res = self._readmsg()
+        yield self.pending_events.get()
 
-        if "event" not in res:
-            self._raise_unexpected_msg(res)
-        yield res
+    def wait_event(self, name: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Block until the next event `name` arrives"""
+        return run_sync(self.client.wait_event(name, timeout))
 
-    def send(self, cmd: str, args: Dict[str, str] = {}) -> Dict[str, str]:
-        data: Dict[str, Any] = dict(execute=cmd)
-        if args != {}:
-            data["arguments"] = args
+    def subscribe(self, name: Optional[str], callback: EventCallback) -> None:
+        """Call `callback(event)` (in the QMP event loop thread) for each event `name`"""
+        self.client.subscribe(name, callback)
+
+    def send(
+        self, cmd: str, args: Dict[str, str] = {}, timeout: Optional[float] = None
+    ) -> Dict[str, str]:
+        return run_sync(self.client.execute(cmd, args, timeout))
 
-        json.dump(data, self.writer)
-        self.writer.write("\n")
-        self.writer.flush()
-        return self._result()
+    def close(self) -> None:
+        run_sync(self.client.close())
 
 
 def is_port_open(ip: str, port: int, wait_response: bool = False) -> bool:
@@ -88,13 +88,11 @@ def is_port_open(ip: str, port: int, wait_response: bool = False) -> bool:
 
 @contextmanager
 def connect_qmp(path: Path) -> Iterator[QmpSession]:
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    sock.connect(str(path))
-
+    session = QmpSession(path)
     try:
-        yield QmpSession(sock)
+        yield session
     finally:
-        sock.close()
+        session.close()
 
 
 def parse_regs(qemu_output: str) -> Dict[str, int]:
@@ -119,10 +117,16 @@ def get_ssh_port(session: QmpSession) -> int:
     return ssh_port
 
 
-def ssh_cmd(port: int) -> List[str]:
+def ssh_cmd(
+    port: int, control_path: Optional[Path] = None, extra_opts: List[str] = []
+) -> List[str]:
+    """Return the ssh command line to login to the VM.
+    If control_path is given, ssh multiplexes the session over the master
+    connection listening on the path (if any, otherwise ssh connects normally).
+    """
     key_path = PROJECT_ROOT.joinpath("nix", "ssh_key")
     key_path.chmod(0o400)
-    return [
+    cmd = [
         "ssh",
         "-i",
         str(key_path),
@@ -132,40 +136,129 @@ def ssh_cmd(port: int) -> List[str]:
         "-oStrictHostKeyChecking=no",
         "-oConnectTimeout=5",
         "-oUserKnownHostsFile=/dev/null",
-        "root@localhost",
     ]
+    if control_path is not None:
+        cmd += [f"-oControlPath={control_path}", "-oControlMaster=no"]
+    return cmd + extra_opts + ["root@localhost"]
 
 
 class QemuVm:
     def __init__(
-        self, qmp_session: QmpSession, tmux_session: str, pid: int, config: dict = {}
+        self,
+        qmp_session: QmpSession,
+        tmux_session: str,
+        pid: int,
+        config: dict = {},
+        ready_sock: Optional[socket.socket] = None,
+        control_path: Optional[Path] = None,
     ) -> None:
         self.qmp_session = qmp_session
         self.tmux_session = tmux_session
         self.pid = pid
         self.ssh_port = get_ssh_port(qmp_session)
         self.config = config
+        self.ready_sock = ready_sock
+        # time.monotonic_ns() when the VM became ready (set by wait_for_ssh())
+        self.ready_ns: Optional[int] = None
+        # unix socket of the ssh master connection shared by all ssh commands
+        self.control_path = control_path
+        self.ssh_master = False
 
     def events(self) -> Iterator[Dict[str, Any]]:
         return self.qmp_session.events()
 
-    def wait_for_ssh(self) -> None:
+    def ssh_ok(self) -> bool:
+        return (
+            self.ssh_cmd(
+                ["echo", "ok"],
+                check=False,
+                stderr=subprocess.DEVNULL,
+                verbose=False,
+            ).returncode
+            == 0
+        )
+
+    def _wait_ready_marker(self, timeout: float) -> bool:
+        """Wait until the guest writes READY_MARKER to the ready port.
+        Return False on timeout or if the port is closed."""
+        assert self.ready_sock is not None
+        deadline = time.monotonic() + timeout
+        buf = b""
+        while READY_MARKER not in buf:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            r, _, _ = select.select([self.ready_sock], [], [], remaining)
+            if not r:
+                return False
+            data = self.ready_sock.recv(4096)
+            if not data:
+                self.ready_sock.close()
+                self.ready_sock = None
+                return False
+            buf += data
+        return True
+
+    def _wait_for_ssh(self) -> int:
+        start = time.monotonic()
+        while self.ready_sock is not None:
+            if self._wait_ready_marker(SSH_POLL_INTERVAL):
+                ready_ns = time.monotonic_ns()
+                if self.ssh_ok():
+                    print("vm is ready (notified by the guest)")
+                    return ready_ns
+                # sshd is started but not yet accepting connections
+                break
+            if time.monotonic() - start >= READY_MARKER_WINDOW and self.ssh_ok():
+                return time.monotonic_ns()
+        while not self.ssh_ok():
+            time.sleep(SSH_POLL_INTERVAL)
+        return time.monotonic_ns()
+
+    def wait_for_ssh(self) -> int:
         """
-        Block until ssh port is accessible
+        Block until ssh port is accessible and then start the ssh master
+        connection. Return the time (time.monotonic_ns(), the same clock as
+        bpftrace's nsecs) when the VM became ready.
+
+        If the guest notifies readiness via the virtio-serial port, we wait
+        for the notification. If it has not arrived after
+        READY_MARKER_WINDOW seconds, ssh is polled every SSH_POLL_INTERVAL
+        seconds as well, as it is without the port.
         """
         print(f"wait for ssh on {self.ssh_port}")
-        while True:
-            if (
-                self.ssh_cmd(
-                    ["echo", "ok"],
-                    check=False,
-                    stderr=subprocess.DEVNULL,
-                    verbose=False,
-                ).returncode
-                == 0
-            ):
-                break
-            time.sleep(0.1)
+        self.ready_ns = self._wait_for_ssh()
+        self.start_ssh_master()
+        return self.ready_ns
+
+    def start_ssh_master(self) -> None:
+        """Open a persistent ssh connection. Successive ssh commands are
+        multiplexed over it instead of doing a new key exchange each time."""
+        if self.control_path is None or self.ssh_master:
+            return
+        cmd = ssh_cmd(
+            self.ssh_port,
+            extra_opts=[
+                f"-oControlPath={self.control_path}",
+                "-oControlMaster=yes",
+                "-oControlPersist=yes",
+                "-N",  # no remote command
+                "-f",  # go to background after authentication
+            ],
+        )
+        self.ssh_master = run(cmd, check=False, verbose=False).returncode == 0
+        if not self.ssh_master:
+            print("failed to start the ssh master connection, use plain ssh")
+
+    def stop_ssh_master(self) -> None:
+        if not self.ssh_master:
+            return
+        cmd = ssh_cmd(
+            self.ssh_port,
+            extra_opts=[f"-oControlPath={self.control_path}", "-Oexit"],
+        )
+        run(cmd, check=False, stderr=subprocess.DEVNULL, verbose=False)
+        self.ssh_master = False
 
     def ssh_Popen(
         self,
@@ -176,10 +269,26 @@ class QemuVm:
         """
         opens a background process with an interactive ssh session
         """
-        cmd = ssh_cmd(self.ssh_port)
+        cmd = ssh_cmd(self.ssh_port, self.control_path)
         pprint_cmd(cmd)
         return subprocess.Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
 
+    def _remote_cmd(self, argv: List[str], extra_env: Dict[str, str]) -> List[str]:
+        env_cmd = []
+        if len(extra_env):
+            env_cmd.append("env")
+            # "-" option makes phoronix-test-suite to complain about mktemp and sh not found
+            # TODO: check if this is correct way to handle this
+            # env_cmd.append("-")
+            for k, v in extra_env.items():
+                env_cmd.append(f"{k}={v}")
+        return (
+            ssh_cmd(self.ssh_port, self.control_path)
+            + ["--"]
+            + env_cmd
+            + [" ".join(map(quote, argv))]
+        )
+
     def ssh_cmd(
         self,
         argv: List[str],
@@ -194,19 +303,37 @@ class QemuVm:
         @return: CompletedProcess.stderr/stdout contains output of `cmd` which
         is run in the vm via ssh.
         """
-        env_cmd = []
-        if len(extra_env):
-            env_cmd.append("env")
-            # "-" option makes phoronix-test-suite to complain about mktemp and sh not found
-            # TODO: check if this is correct way to handle this
-            # env_cmd.append("-")
-            for k, v in extra_env.items():
-                env_cmd.append(f"{k}={v}")
-        cmd = ssh_cmd(self.ssh_port) + ["--"] + env_cmd + [" ".join(map(quote, argv))]
+        cmd = self._remote_cmd(argv, extra_env)
         return run(
             cmd, stdin=stdin, stdout=stdout, stderr=stderr, check=check, verbose=verbose
         )
 
+    def ssh_stream(
+        self,
+        argv: List[str],
+        extra_env: Dict[str, str] = {},
+        check: bool = True,
+        stderr: ChildFd = None,
+        verbose: bool = True,
+    ) -> Iterator[str]:
+        """Run `cmd` in the vm via ssh and yield its stdout line by line
+        while the command is running."""
+        cmd = self._remote_cmd(argv, extra_env)
+        if verbose:
+            pprint_cmd(cmd)
+        with subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=stderr, text=True, bufsize=1
+        ) as proc:
+            assert proc.stdout is not None
+            try:
+                yield from proc.stdout
+            except GeneratorExit:
+                # the caller stopped reading
+                proc.terminate()
+                raise
+        if check and proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
     def regs(self) -> Dict[str, int]:
         """
         Get cpu register:
@@ -239,35 +366,29 @@ class QemuVm:
         """
         return self.qmp_session.send(cmd, args)
 
-    def pin_vcpu(self, pcpu_base: int = 0) -> None:
-        """Pin vCPUs to physical CPUs"""
-        cpu_info = self.send("query-cpus-fast")["return"]
-        num_cpus = len(cpu_info)
-        for cpu in cpu_info:
-            tid = cpu["thread-id"]
-            cpuidx = cpu["cpu-index"]
-            try:
-                cmd = ["taskset", "-pc", str(cpuidx + pcpu_base), str(tid)]
-                run(cmd)
-            except subprocess.CalledProcessError as e:
-                print("Failed to pin vCPU{}: {}".format(cpuidx, e))
-                return
-
-        iothreads_info = self.send("query-iothreads")["return"]
-        num_iothreads = len(iothreads_info)
-        if num_iothreads == 0:
-            print("No iothreads found")
+    def pin(self, plan: PinPlan) -> None:
+        """Pin vCPUs and iothreads to the CPUs of a plan (see pinning.py)"""
+        for cpu in self.send("query-cpus-fast")["return"]:
+            pcpu = plan.vcpus[cpu["cpu-index"]]
+            run(["taskset", "-pc", str(pcpu), str(cpu["thread-id"])])
+        iothreads = self.send("query-iothreads")["return"]
+        if iothreads and not plan.iothreads:
+            print(f"WARN: {len(iothreads)} iothreads are not in the pinning plan")
             return
-        print("Pin iothreads")
-        for i, cpu in enumerate(iothreads_info):
-            tid = cpu["thread-id"]
-            try:
-                cmd = ["taskset", "-pc", str(pcpu_base + num_cpus + i), str(tid)]
-                run(cmd)
-            except subprocess.CalledProcessError as e:
-                # FIXME: this can happen if pcpu_base + num_cpus + i is bigger than the number of available CPUs
-                print("Failed to pin vCPU{}: {}".format(cpuidx, e))
-                return
+        for i, iothread in enumerate(iothreads):
+            pcpu = plan.iothreads[i % len(plan.iothreads)]
+            run(["taskset", "-pc", str(pcpu), str(iothread["thread-id"])])
+
+    def pin_vhost(self, plan: PinPlan) -> None:
+        """Pin vhost workers, which exist once the guest has started the
+        virtio-net device (i.e., call this after boot)"""
+        if not plan.vhost:
+            return
+        tids = vhost_threads(self.pid)
+        if not tids:
+            print("WARN: no vhost workers found")
+        for i, tid in enumerate(tids):
+            run(["taskset", "-pc", str(plan.vhost[i % len(plan.vhost)]), str(tid)])
 
     def shutdown(self, timeout=10) -> None:
         """Try graceful shutdown"""
@@ -291,9 +412,16 @@ def spawn_qemu(
     extra_args_pre: List[str] = [],
     numa_node: Optional[List[int]] = None,
     config: dict = {},
+    ready_notify: bool = True,
 ) -> Iterator[QemuVm]:
+    """Start QEMU in a tmux session and yield a QemuVm connected via QMP.
+    If ready_notify is True, add a virtio-serial port for the guest to notify
+    the readiness (see QemuVm.wait_for_ssh()).
+    """
     with TemporaryDirectory() as tempdir:
         qmp_socket = Path(tempdir).joinpath("qmp.sock")
+        ready_socket = Path(tempdir).joinpath("ready.sock")
+        ssh_control = Path(tempdir).joinpath("ssh.sock")
         cmd = extra_args_pre.copy()
 
         if numa_node is not None:
@@ -309,12 +437,21 @@ def spawn_qemu(
         ]
         cmd += qemu_command
         cmd += qmp_command
+        if ready_notify:
+            cmd += [
+                "-chardev",
+                f"socket,id=cvm-ready,path={str(ready_socket)},server,nowait",
+                "-device",
+                "virtio-serial-pci,id=cvm-ready-serial",
+                "-device",
+                f"virtserialport,bus=cvm-ready-serial.0,chardev=cvm-ready,name={READY_PORT_NAME}",
+            ]
         cmd += extra_args
 
         print(cmd)
 
         # run qemu in a tmux session so that we can kill qemu threads easily
-        tmux_session = f"pytest-{os.getpid()}"
+        tmux_session = f"pytest-{os.getpid()}-{next(_tmux_session_ids)}"
         tmux = [
             "tmux",
             "-L",
@@ -348,7 +485,20 @@ def spawn_qemu(
                 except ProcessLookupError:
                     raise Exception("qemu vm was terminated")
             with connect_qmp(qmp_socket) as session:
-                yield QemuVm(session, tmux_session, qemu_pid, config)
+                # QMP is ready, so all chardevs are created
+                ready_sock = None
+                if ready_notify:
+                    ready_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    ready_sock.connect(str(ready_socket))
+                vm = QemuVm(
+                    session, tmux_session, qemu_pid, config, ready_sock, ssh_control
+                )
+                try:
+                    yield vm
+                finally:
+                    vm.stop_ssh_master()
+                    if ready_sock is not None:
+                        ready_sock.close()
         finally:
             subprocess.run(["tmux", "-L", tmux_session, "kill-server"])
             while True:
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""asyncio based QMP client (https://wiki.qemu.org/Documentation/QMP)
+
+Commands are tagged with an "id" so that several commands can be in flight at
+the same time. Events are dispatched to callbacks subscribed by event name.
+
+All clients of a process share one event loop running in a background thread
+(see get_event_loop()), so synchronous code can drive many VMs without a
+thread per VM (see qemu.QmpSession).
+"""
+
+import asyncio
+import itertools
+import json
+import threading
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+
+EventCallback = Callable[[Dict[str, Any]], Union[None, Awaitable[None]]]
+
+# QMP messages (e.g., query-blockstats of many disks) can be larger than the
+# default StreamReader limit (64KiB)
+READ_LIMIT = 16 * 1024 * 1024
+
+
+class QmpError(RuntimeError):
+    def __init__(self, cmd: str, error: Dict[str, Any]) -> None:
+        self.cmd = cmd
+        self.error = error
+        super().__init__(f"{cmd}: {error.get('class')}: {error.get('desc')}")
+
+
+class AsyncQmpClient:
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.ids = itertools.count()
+        self.pending: Dict[str, asyncio.Future] = {}
+        # event name (None: all events) -> callbacks
+        self.subscribers: Dict[Optional[str], List[EventCallback]] = {}
+        self.reader_task: Optional[asyncio.Task] = None
+        self.closed = asyncio.Event()
+
+    @classmethod
+    async def connect(cls, path: Path, timeout: float = 10) -> "AsyncQmpClient":
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(str(path), limit=READ_LIMIT), timeout
+        )
+        client = cls(reader, writer)
+        await client._handshake(timeout)
+        return client
+
+    async def _handshake(self, timeout: float) -> None:
+        hello = json.loads(await asyncio.wait_for(self.reader.readline(), timeout))
+        assert "QMP" in hello, f"Unexpected result: {hello}"
+        self.reader_task = asyncio.create_task(self._read_loop())
+        await self.execute("qmp_capabilities", timeout=timeout)
+
+    async def _read_loop(self) -> None:
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line)
+                if "event" in msg:
+                    await self._dispatch(msg)
+                elif "id" in msg:
+                    fut = self.pending.pop(msg["id"], None)
+                    if fut is not None and not fut.done():
+                        fut.set_result(msg)
+                else:
+                    m = json.dumps(msg, sort_keys=True, indent=4)
+                    print(f"Got unexpected qmp response: {m}")
+        finally:
+            self.closed.set()
+            for fut in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("QMP connection closed"))
+            self.pending.clear()
+
+    async def _dispatch(self, event: Dict[str, Any]) -> None:
+        callbacks = self.subscribers.get(event["event"], []) + self.subscribers.get(
+            None, []
+        )
+        for callback in callbacks:
+            try:
+                res = callback(event)
+                if asyncio.iscoroutine(res):
+                    await res
+            except Exception as e:
+                print(f"QMP event callback for {event['event']} failed: {e}")
+
+    async def execute(
+        self,
+        cmd: str,
+        args: Dict[str, Any] = {},
+        timeout: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """Send a command and wait for its response.
+        Raise QmpError if QEMU returns an error and asyncio.TimeoutError on timeout."""
+        if self.closed.is_set():
+            raise ConnectionError("QMP connection closed")
+        id = f"cvm-{next(self.ids)}"
+        data: Dict[str, Any] = dict(execute=cmd, id=id)
+        if args != {}:
+            data["arguments"] = args
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[id] = fut
+        try:
+            self.writer.write(json.dumps(data).encode() + b"\n")
+            await self.writer.drain()
+            res = await asyncio.wait_for(fut, timeout)
+        finally:
+            self.pending.pop(id, None)
+        if "error" in res:
+            raise QmpError(cmd, res["error"])
+        return res
+
+    def subscribe(
+        self, name: Optional[str], callback: EventCallback
+    ) -> Callable[[], None]:
+        """Call `callback(event)` for every event `name` (all events if None).
+        The callback runs in the event loop; it can be a coroutine function.
+        Return a function to unsubscribe."""
+        self.subscribers.setdefault(name, []).append(callback)
+
+        def unsubscribe() -> None:
+            if callback in self.subscribers.get(name, []):
+                self.subscribers[name].remove(callback)
+
+        return unsubscribe
+
+    async def wait_event(
+        self, name: str, timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """Wait for the next event `name`"""
+        fut = asyncio.get_running_loop().create_future()
+
+        def callback(event: Dict[str, Any]) -> None:
+            if not fut.done():
+                fut.set_result(event)
+
+        unsubscribe = self.subscribe(name, callback)
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            unsubscribe()
+
+    async def close(self) -> None:
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, BrokenPipeError):
+            pass
+        if self.reader_task is not None:
+            await self.reader_task
+
+
+_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_LOOP_LOCK = threading.Lock()
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Return the event loop shared by all QMP clients of this process.
+    The loop runs in a daemon thread started on first use."""
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            thread = threading.Thread(
+                target=_LOOP.run_forever, name="qmp-event-loop", daemon=True
+            )
+            thread.start()
+        return _LOOP
+
+
+def run_sync(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """Run a coroutine in the shared event loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result(timeout)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Repeat a benchmark until its result is stable.
+
+With a fixed `repeat`, stable benchmarks are run more often than needed and
+noisy ones (e.g., TDX boot) too rarely. repeat_runs() instead repeats a run
+until the relative half-width of the 95% confidence interval of the mean of
+its primary metric (Student's t) is at most `target_ci`, or `max_runs` runs
+were made.
+"""
+
+import math
+import statistics
+from typing import Callable, List, Optional
+
+# two-sided 95% quantiles of Student's t distribution for 1..30 degrees of freedom
+# fmt: off
+T_95 = [
+    12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228,
+    2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093, 2.086,
+    2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042,
+]
+# fmt: on
+Z_95 = 1.960
+
+
+def relative_ci(values: List[float]) -> float:
+    """Return the half-width of the 95% CI of the mean relative to the mean"""
+    n = len(values)
+    if n < 2:
+        return math.inf
+    mean = statistics.mean(values)
+    if mean == 0:
+        return math.inf
+    t = T_95[n - 2] if n - 1 <= len(T_95) else Z_95
+    return t * statistics.stdev(values) / math.sqrt(n) / abs(mean)
+
+
+def repeat_runs(
+    run: Callable[[int], Optional[float]],
+    repeat: int = 1,
+    target_ci: Optional[float] = None,
+    max_runs: int = 20,
+) -> List[float]:
+    """Call run(i) for i = 1, 2, ... and return the metrics of successful runs.
+    `run` returns the primary metric of the run, or None if the run failed.
+    Without `target_ci`, run `repeat` times. Otherwise run at least `repeat`
+    (and at least 2) times, then stop once relative_ci() <= target_ci.
+    Failed runs count towards `max_runs`."""
+    values: List[float] = []
+    if target_ci is None:
+        for i in range(1, repeat + 1):
+            value = run(i)
+            if value is not None:
+                values.append(value)
+        return values
+
+    min_runs = max(repeat, 2)
+    for i in range(1, max(max_runs, min_runs) + 1):
+        value = run(i)
+        if value is not None:
+            values.append(value)
+        ci = relative_ci(values)
+        print(f"[repeat] run {i}: {len(values)} results, CI ±{ci * 100:.1f}%")
+        if len(values) >= min_runs and ci <= target_ci:
+            print(f"[repeat] converged after {i} runs")
+            return values
+    print(f"[repeat] not converged after {i} runs (target ±{target_ci * 100:.1f}%)")
+    return values
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Run several `inv vm.start` jobs concurrently on one host.
+
+Each job runs in its own `inv vm.start` process. A job gets a contiguous
+range of physical CPUs (--pin-cpus, within which pinning.py places the VM's
+threads) on one NUMA node (--numa-node), which no other running job uses, as
+well as its own ssh port and vsock CID. Jobs that do not fit wait until
+running jobs finish.
+
+Jobs that cannot share the host run alone ("exclusive"):
+- VMs spanning several NUMA nodes (e.g., "numa" size)
+- VMs that do not fit into one NUMA node
+- jobs using virtio-nic: the tap device, the guest IP and the host-side load
+  generators (see network.py) are shared
+- jobs using a virtio-blk device
+Exclusive jobs use the pinning of the resource config (VMRESOURCES).
+"""
+
+import socket
+import subprocess
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from config import PROJECT_ROOT, SSH_PORT
+from topology import NumaNode, format_cpulist
+
+# first vsock CID handed out to jobs (CIDs 0-2 are reserved)
+GUEST_CID_BASE = 11
+
+
+@dataclass
+class Job:
+    type: str
+    size: str
+    action: str
+    cpu: int  # number of vCPUs
+    memory: int  # GB
+    numa_node: List[int]
+    # extra arguments for `inv vm.start`
+    args: List[str] = field(default_factory=list)
+    # number of physical CPUs used in addition to vCPUs (e.g., iothreads)
+    extra_pcpus: int = 0
+    exclusive: bool = False
+    # distinguishes jobs of the same type, size and action (e.g., "-serial")
+    suffix: str = ""
+
+    @property
+    def name(self) -> str:
+        return f"{self.type}-{self.size}-{self.action}{self.suffix}"
+
+    @property
+    def pcpus(self) -> int:
+        return self.cpu + self.extra_pcpus
+
+
+@dataclass
+class Placement:
+    node: Optional[int]  # None for exclusive jobs
+    cpus: List[int]
+    ssh_port: int
+    guest_cid: int
+
+    def args(self) -> List[str]:
+        args = ["--ssh-port", str(self.ssh_port), "--guest-cid", str(self.guest_cid)]
+        if self.node is not None:
+            args += ["--numa-node", str(self.node)]
+            args += ["--pin-cpus", format_cpulist(self.cpus)]
+        return args
+
+
+def port_is_free(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(("", port))
+        except OSError:
+            return False
+    return True
+
+
+class Allocator:
+    """Track free CPUs and memory per NUMA node, ssh ports, and vsock CIDs"""
+
+    def __init__(
+        self,
+        nodes: List[NumaNode],
+        reserved_cpus: Set[int] = set(),
+        memory_headroom: int = 4,  # GB per node kept for the host
+    ) -> None:
+        self.nodes = nodes
+        self.free_cpus: Dict[int, Set[int]] = {
+            n.id: set(n.cpus) - reserved_cpus for n in nodes
+        }
+        self.free_memory: Dict[int, int] = {
+            n.id: n.memory - memory_headroom for n in nodes
+        }
+        self.used_ports: Set[int] = set()
+        self.used_cids: Set[int] = set()
+
+    def fits_empty_host(self, job: Job) -> bool:
+        """Return True if the job fits into one NUMA node of an idle host"""
+        for n in self.nodes:
+            cpus = self._find_cpus(sorted(self.free_cpus[n.id]), job.pcpus)
+            if cpus is not None and job.memory <= self.free_memory[n.id]:
+                return True
+        return False
+
+    @staticmethod
+    def _find_cpus(free: List[int], num: int) -> Optional[List[int]]:
+        # consecutive CPUs are usually distinct cores, which pinning.py prefers
+        free_set = set(free)
+        for start in free:
+            cpus = list(range(start, start + num))
+            if all(c in free_set for c in cpus):
+                return cpus
+        return None
+
+    def _ssh_port(self) -> int:
+        port = SSH_PORT
+        while port in self.used_ports or not port_is_free(port):
+            port += 1
+        return port
+
+    def _guest_cid(self) -> int:
+        cid = GUEST_CID_BASE
+        while cid in self.used_cids:
+            cid += 1
+        return cid
+
+    def allocate(self, job: Job) -> Optional[Placement]:
+        if job.exclusive:
+            placement = Placement(None, [], SSH_PORT, GUEST_CID_BASE)
+        else:
+            # prefer the node with the most free CPUs to spread the load
+            placement = None
+            for n in sorted(self.nodes, key=lambda n: -len(self.free_cpus[n.id])):
+                if job.memory > self.free_memory[n.id]:
+                    continue
+                cpus = self._find_cpus(sorted(self.free_cpus[n.id]), job.pcpus)
+                if cpus is not None:
+                    placement = Placement(
+                        n.id, cpus, self._ssh_port(), self._guest_cid()
+                    )
+                    break
+            if placement is None:
+                return None
+            self.free_cpus[placement.node] -= set(placement.cpus)
+            self.free_memory[placement.node] -= job.memory
+        self.used_ports.add(placement.ssh_port)
+        self.used_cids.add(placement.guest_cid)
+        return placement
+
+    def release(self, job: Job, placement: Placement) -> None:
+        if placement.node is not None:
+            self.free_cpus[placement.node] |= set(placement.cpus)
+            self.free_memory[placement.node] += job.memory
+        self.used_ports.discard(placement.ssh_port)
+        self.used_cids.discard(placement.guest_cid)
+
+
+@dataclass
+class RunningJob:
+    index: int  # of the job in the list passed to Scheduler
+    job: Job
+    placement: Placement
+    proc: subprocess.Popen
+    start: float
+
+
+class Scheduler:
+    def __init__(
+        self,
+        jobs: List[Job],
+        allocator: Allocator,
+        logdir: Optional[Path] = None,
+        dry_run: bool = False,
+    ) -> None:
+        self.jobs = list(jobs)
+        # indexes of the jobs not started yet
+        self.pending = list(range(len(jobs)))
+        self.allocator = allocator
+        self.running: List[RunningJob] = []
+        # exit code of each job. Jobs may share a name (e.g., with different args)
+        self.results: List[Optional[int]] = [None] * len(jobs)
+        date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+        self.logdir = logdir or PROJECT_ROOT / f"bench-result/schedule/{date}"
+        self.dry_run = dry_run
+        for job in jobs:
+            if not job.exclusive and not allocator.fits_empty_host(job):
+                job.exclusive = True
+
+    def command(self, job: Job, placement: Placement) -> List[str]:
+        return (
+            ["inv", "vm.start"]
+            + ["--type", job.type, "--size", job.size, "--action", job.action]
+            + ["--no-warn"]
+            + placement.args()
+            + job.args
+        )
+
+    def _launch(self, index: int, placement: Placement) -> None:
+        job = self.jobs[index]
+        cmd = self.command(job, placement)
+        print(
+            f"[sched] start {job.name} on node {placement.node} cpus {placement.cpus}"
+        )
+        print("$ " + " ".join(cmd))
+        if self.dry_run:
+            proc = subprocess.Popen(["true"])
+        else:
+            self.logdir.mkdir(parents=True, exist_ok=True)
+            log = open(self.logdir / f"{index}-{job.name}.log", "w")
+            proc = subprocess.Popen(
+                cmd,
+                cwd=PROJECT_ROOT,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            log.close()
+        self.running.append(RunningJob(index, job, placement, proc, time.monotonic()))
+
+    def _schedule(self) -> None:
+        """Start pending jobs in order as long as they fit.
+        Later jobs may overtake a job that does not fit, unless the job that
+        does not fit is exclusive (otherwise it would starve)."""
+        if any(r.job.exclusive for r in self.running):
+            return
+        for index in list(self.pending):
+            job = self.jobs[index]
+            if job.exclusive and self.running:
+                return
+            placement = self.allocator.allocate(job)
+            if placement is None:
+                continue
+            self.pending.remove(index)
+            self._launch(index, placement)
+            if job.exclusive:
+                return
+
+    def _reap(self) -> None:
+        for r in list(self.running):
+            if r.proc.poll() is None:
+                continue
+            self.running.remove(r)
+            self.allocator.release(r.job, r.placement)
+            self.results[r.index] = r.proc.returncode
+            elapsed = time.monotonic() - r.start
+            status = "done" if r.proc.returncode == 0 else "FAILED"
+            print(f"[sched] {status} {r.job.name} ({elapsed:.0f}s)")
+
+    def run(self, interval: float = 1.0) -> List[Optional[int]]:
+        """Run all jobs and return the exit code of each job, in the order of
+        the jobs"""
+        while self.pending or self.running:
+            self._schedule()
+            if not self.running and self.pending:
+                # should not happen: an idle host always fits an exclusive job
+                names = [self.jobs[i].name for i in self.pending]
+                raise RuntimeError(f"cannot place jobs: {names}")
+            time.sleep(interval)
+            self._reap()
+        if not self.dry_run:
+            print(f"[sched] logs are in {self.logdir}")
+        return self.results
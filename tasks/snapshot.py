@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Start normal (non-confidential) VMs from a saved state instead of booting.
+
+The first VM started with a QEMU command boots normally and its state is
+saved to a file with QMP migration (`migrate` to "exec:cat > state"). The
+following VMs with the same command are started with `-incoming defer` and
+restore the state (`migrate-incoming`), which takes a second or so instead of
+a full OVMF+Linux boot.
+
+The guest disk is part of the state: the snapshot VM writes to a qcow2
+overlay of the image, which is kept with the saved state, and every restored
+VM writes to a throwaway overlay of that overlay.
+
+SNP and TDX guests cannot be snapshotted (the host cannot save or restore
+encrypted guest memory and CPU state), so they always boot normally.
+"""
+
+import hashlib
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Iterator, List
+
+from config import BUILD_DIR
+from procs import run
+from qemu import QemuVm, spawn_qemu
+
+SNAPSHOT_DIR = BUILD_DIR / "snapshots"
+
+UNSUPPORTED_TYPES = ["snp", "tdx", "tdx-ubuntu"]
+
+
+def is_supported(type: str) -> bool:
+    return type not in UNSUPPORTED_TYPES
+
+
+def snapshot_id(qemu_cmd: List[str], image: Path) -> str:
+    """Snapshots are invalidated when the QEMU command or the image changes"""
+    h = hashlib.sha256()
+    h.update("\0".join(map(str, qemu_cmd)).encode())
+    h.update(str(image.stat().st_mtime_ns).encode())
+    return h.hexdigest()[:16]
+
+
+def replace_disk(qemu_cmd: List[str], image: Path, disk: Path) -> List[str]:
+    """Replace the guest image by `disk` in the QEMU command"""
+    old = f"file.filename={image}"
+    if not any(old in arg for arg in qemu_cmd):
+        raise ValueError(f"{image} is not used by the QEMU command")
+    return [arg.replace(old, f"file.filename={disk}") for arg in qemu_cmd]
+
+
+def create_overlay(qemu_img: Path, backing: Path, path: Path) -> None:
+    run(
+        [
+            str(qemu_img),
+            "create",
+            "-q",
+            "-f",
+            "qcow2",
+            "-F",
+            "qcow2",
+            "-b",
+            str(backing),
+            str(path),
+        ]
+    )
+
+
+def wait_migration(vm: QemuVm, timeout: float = 600) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        info = vm.send("query-migrate")["return"]
+        status = info.get("status")
+        if status == "completed":
+            return
+        if status in ["failed", "cancelled"]:
+            raise RuntimeError(f"migration {status}: {info.get('error-desc', '')}")
+        time.sleep(0.1)
+    raise TimeoutError("migration did not complete")
+
+
+def save_snapshot(
+    path: Path,
+    qemu_cmd: List[str],
+    pin: bool,
+    config: dict,
+    image: Path,
+    qemu_img: Path,
+) -> None:
+    """Boot a VM and save its state and disk to `path`"""
+    resource = config["resource"]
+    tmp = path.with_suffix(".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    disk = tmp / "disk.qcow2"
+    create_overlay(qemu_img, image, disk)
+
+    print(f"[snapshot] boot a VM to create a snapshot in {path}")
+    vm: QemuVm
+    with spawn_qemu(
+        replace_disk(qemu_cmd, image, disk),
+        numa_node=resource.numa_node,
+        config=config,
+    ) as vm:
+        if pin:
+            vm.pin(config["pin_plan"])
+        vm.wait_for_ssh()
+        # QEMU blocks migration while a 9p filesystem is mounted
+        vm.ssh_cmd(["umount", "/share"])
+        vm.ssh_cmd(["sync"])
+        vm.stop_ssh_master()
+        vm.send("stop")
+        vm.send("migrate", {"uri": f"exec:cat > {tmp / 'state'}"})
+        wait_migration(vm)
+    tmp.rename(path)
+
+
+@contextmanager
+def restored_vm(
+    qemu_cmd: List[str],
+    pin: bool,
+    config: dict,
+    image: Path,
+    qemu_img: Path,
+) -> Iterator[QemuVm]:
+    """Start a VM from the snapshot of `qemu_cmd` (created on first use) and
+    wait until ssh is available. The VM is shut down when the context exits."""
+    resource = config["resource"]
+    path = SNAPSHOT_DIR / snapshot_id(qemu_cmd, image)
+    if not path.exists():
+        save_snapshot(path, qemu_cmd, pin, config, image, qemu_img)
+
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    with TemporaryDirectory(dir=SNAPSHOT_DIR) as tempdir:
+        disk = Path(tempdir) / "disk.qcow2"
+        create_overlay(qemu_img, path / "disk.qcow2", disk)
+        cmd = replace_disk(qemu_cmd, image, disk) + ["-incoming", "defer"]
+        vm: QemuVm
+        with spawn_qemu(cmd, numa_node=resource.numa_node, config=config) as vm:
+            if pin:
+                vm.pin(config["pin_plan"])
+            start = time.monotonic()
+            vm.send("migrate-incoming", {"uri": f"exec:cat {path / 'state'}"})
+            wait_migration(vm)
+            # the source was stopped before saving, so the VM starts paused
+            if vm.send("query-status")["return"]["status"] != "running":
+                vm.send("cont")
+            # the guest already notified readiness before the snapshot
+            if vm.ready_sock is not None:
+                vm.ready_sock.close()
+                vm.ready_sock = None
+            vm.wait_for_ssh()
+            vm.ssh_cmd(["mount", "/share"])
+            print(f"[snapshot] restored in {time.monotonic() - start:.1f}s")
+            yield vm
+            vm.shutdown()
@@ -3,9 +3,11 @@
 
 from datetime import datetime
 from pathlib import Path
+from typing import List, Optional
 
 import time
-from config import PROJECT_ROOT
+from config import PROJECT_ROOT, VIRTIO_BLK_ID
+from fio_matrix import FioParams
 from qemu import QemuVm
 
 
@@ -14,6 +16,7 @@ def run_fio(
     vm: QemuVm,
     job: str = "test",
     filename: str = "/dev/vdb",
+    blockstats_interval: Optional[float] = None,  # sample QEMU's block statistics
 ):
     date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     outputdir = Path(f"./bench-result/fio/{name}/{job}/")
@@ -28,7 +31,64 @@ def run_fio(
         "--output-format=json",
         fio_job,
     ]
-    vm.ssh_cmd(cmd)
+    stats = outputdir_host / f"{date}.blockstats.jsonl"
+    run_fio_cmd(vm, cmd, blockstats_interval, stats)
+
+
+def run_fio_cmd(
+    vm: QemuVm,
+    cmd: List[str],
+    blockstats_interval: Optional[float] = None,
+    blockstats_output: Optional[Path] = None,
+) -> None:
+    """Run fio in the guest, sampling QEMU's block statistics if an interval is
+    given (see blockstats.py)"""
+    if blockstats_interval is None or blockstats_output is None:
+        vm.ssh_cmd(cmd)
+        return
+
+    from blockstats import BlockStatsSampler, qdev_path
+
+    sampler = BlockStatsSampler(
+        vm.send, qdev_path(VIRTIO_BLK_ID), blockstats_interval, blockstats_output
+    )
+    sampler.start()
+    try:
+        vm.ssh_cmd(cmd)
+    finally:
+        sampler.stop()
+
+
+def run_fio_sweep(
+    name: str,
+    vm: QemuVm,
+    jobs: List[FioParams],
+    filename: str = "/dev/vdb",
+    runtime: int = 30,
+    ramp_time: int = 20,
+    blockstats_interval: Optional[float] = None,
+) -> None:
+    """Run the generated fio jobs one after another (see fio_matrix.py)"""
+    date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    outputdir = Path(f"./bench-result/fio-sweep/{name}/{date}/")
+    outputdir_host = PROJECT_ROOT / outputdir
+    outputdir_host.mkdir(parents=True, exist_ok=True)
+    total = len(jobs) * (runtime + ramp_time) / 60
+    print(f"[fio-sweep] {len(jobs)} jobs (~{total:.0f} min), saved in {outputdir_host}")
+    for i, params in enumerate(jobs):
+        job_file = outputdir / f"{params.name}.fio"
+        (PROJECT_ROOT / job_file).write_text(params.job_file(runtime, ramp_time))
+        print(f"[fio-sweep] {i + 1}/{len(jobs)}: {params.name}")
+        output = Path("/share") / outputdir / f"{params.name}.json"
+        cmd = [
+            "fio",
+            f"--filename={filename}",
+            f"--output={output}",
+            "--output-format=json",
+            str(Path("/share") / job_file),
+        ]
+        stats = outputdir_host / f"{params.name}.blockstats.jsonl"
+        run_fio_cmd(vm, cmd, blockstats_interval, stats)
 
 
 def mount_disk(vm: QemuVm, dev: str, mountpoint: str = "/mnt", format="no") -> bool:
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""vhost-user-blk served by qemu-storage-daemon
+(inv vm.start --virtio-blk <path> --virtio-blk-backend vhost-user).
+
+The daemon opens the file or block device with the same blockdev options as
+QEMU's virtio-blk (aio, cache.direct) and exports it on a unix socket. QEMU
+connects with a vhost-user-blk-pci device, so the virtqueues are processed by
+the daemon (polling adaptively in its iothread) instead of QEMU.
+
+The daemon maps guest memory to access the buffers, so guest memory must be a
+shared, fd-backed memory backend (see vm.qemu_option_memory). CVMs cannot use
+it: the guest only does I/O through (shared) bounce buffers for devices that
+offer VIRTIO_F_ACCESS_PLATFORM, which the vhost-user-blk export does not.
+"""
+
+import shlex
+import shutil
+import signal
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, List, Optional
+
+# VM types whose guest memory the daemon can use
+VHOST_USER_TYPES = ["amd", "intel", "intel-ubuntu"]
+
+
+def check_vhost_user(type: str, virtio_iommu: bool, iothreads: int) -> None:
+    """Raise ValueError if a VM of `type` cannot use a vhost-user-blk"""
+    if type not in VHOST_USER_TYPES:
+        raise ValueError(
+            f"{type} guests cannot share their memory with a vhost-user-blk "
+            "backend: guest memory is private, and the guest only does I/O "
+            "through shared bounce buffers for devices offering "
+            "VIRTIO_F_ACCESS_PLATFORM, which qemu-storage-daemon's vhost-user-blk "
+            "export does not. Use --virtio-blk-backend qemu."
+        )
+    if virtio_iommu:
+        raise ValueError(
+            "--virtio-iommu needs a device IOTLB, which qemu-storage-daemon's "
+            "vhost-user-blk export does not support"
+        )
+    if iothreads > 1:
+        raise ValueError("qemu-storage-daemon serves an export with one iothread")
+
+
+def daemon_binary(qemu: Path) -> Path:
+    """qemu-storage-daemon of the QEMU build, or the one in PATH"""
+    binary = Path(qemu).parent / "qemu-storage-daemon"
+    if binary.exists():
+        return binary
+    found = shutil.which("qemu-storage-daemon")
+    if found is None:
+        raise FileNotFoundError(f"No qemu-storage-daemon in {binary.parent} or PATH")
+    return Path(found)
+
+
+def daemon_cmd(
+    binary: Path,
+    file: Path,
+    socket: Path,
+    aio: str = "native",
+    direct: bool = True,
+    iothread: bool = True,
+    num_queues: int = 1,
+) -> List[str]:
+    driver = "host_device" if file.is_block_device() else "file"
+    cache_direct = "on" if direct else "off"
+    export = (
+        f"type=vhost-user-blk,id=export0,node-name=disk0,writable=on,"
+        f"addr.type=unix,addr.path={socket},num-queues={num_queues}"
+    )
+    options = f"""
+        {binary}
+        --blockdev node-name=disk0,driver=raw,file.driver={driver},file.filename={file},file.aio={aio},cache.direct={cache_direct},cache.no-flush=off
+    """
+    if iothread:
+        options += " --object iothread,id=iothread0"
+        export += ",iothread=iothread0"
+    options += f" --export {export}"
+    return shlex.split(options)
+
+
+def qemu_option_vhost_user_blk(socket: Path, num_queues: int) -> List[str]:
+    """QEMU options connecting to the export of a daemon on `socket`"""
+    option = f"""
+        -chardev socket,id=vub0,path={socket}
+        -device vhost-user-blk-pci,chardev=vub0,num-queues={num_queues}
+    """
+    return shlex.split(option)
+
+
+class StorageDaemon:
+    def __init__(self, cmd: List[str], socket: Path, log: Path) -> None:
+        self.cmd = cmd
+        self.socket = socket
+        self.log = log
+        self.proc: Optional[subprocess.Popen] = None
+        self.out: Optional[IO[str]] = None
+
+    @property
+    def pid(self) -> int:
+        assert self.proc is not None
+        return self.proc.pid
+
+    def start(self, timeout: float = 30) -> None:
+        """Start the daemon and wait until it listens on the socket"""
+        self.socket.unlink(missing_ok=True)
+        self.out = open(self.log, "w")
+        print(f"[storage-daemon] {shlex.join(self.cmd)}")
+        self.proc = subprocess.Popen(
+            self.cmd,
+            stdout=self.out,
+            stderr=subprocess.STDOUT,
+            # do not get Ctrl-C of the terminal before QEMU is gone
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + timeout
+        while not self.socket.is_socket():
+            if self.proc.poll() is not None:
+                raise RuntimeError(
+                    f"qemu-storage-daemon failed: {self.log.read_text()}"
+                )
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"qemu-storage-daemon did not create {self.socket}")
+            time.sleep(0.1)
+
+    def pin(self, cpus: List[int]) -> None:
+        """Pin all threads of the daemon (main loop and iothread)"""
+        cpulist = ",".join(str(c) for c in cpus)
+        subprocess.run(["taskset", "-apc", cpulist, str(self.pid)], check=True)
+
+    def stop(self, timeout: float = 10) -> None:
+        assert self.proc is not None and self.out is not None
+        self.proc.send_signal(signal.SIGTERM)
+        try:
+            self.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.out.close()
+        self.socket.unlink(missing_ok=True)
+
+
+@contextmanager
+def storage_daemon(
+    cmd: List[str], socket: Path, cpus: Optional[List[int]] = None
+) -> Iterator[StorageDaemon]:
+    """Run qemu-storage-daemon during the context. It accepts a new connection
+    after a VM disconnected, so it serves all VMs of the actions in turn."""
+    daemon = StorageDaemon(cmd, socket, socket.with_suffix(".log"))
+    daemon.start()
+    try:
+        if cpus:
+            daemon.pin(cpus)
+        yield daemon
+    finally:
+        daemon.stop()
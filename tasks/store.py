@@ -0,0 +1,495 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Columnar store of all benchmark results under bench-result/
+
+Raw result files are parsed once into a long-format table saved as
+{result dir}/.store.parquet with the columns:
+
+| benchmark | name | tags | date | run | metric | param | value | better | file | mtime |
+
+- benchmark: e.g., "iperf", "fio", "mlc"
+- name: VM name including the configuration suffixes (e.g., "snp-direct-medium-vhost")
+- tags: benchmark specific configuration (e.g., "udp", "redis-tls", fio job name)
+- date: date of the run (directory or file name)
+- run: file within a run (e.g., boottime repetition)
+- metric, param, value: e.g., ("throughput", "1460", 9.3) of iperf
+- better: "lower" or "higher" if the result file says which values are
+  better (e.g., phoronix), otherwise "" (see compare.lower_is_better())
+- file, mtime: source file relative to the result dir, and its mtime
+
+The store is updated incrementally: only files that are new or whose mtime
+changed since the last update are parsed. Plot tasks query the store instead
+of reading raw files (see query()).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd
+from invoke import task
+
+STORE_FILE = ".store.parquet"
+
+# with fewer files, parsing in this process is faster than starting workers
+PARALLEL_THRESHOLD = 32
+
+COLUMNS = [
+    "benchmark",
+    "name",
+    "tags",
+    "date",
+    "run",
+    "metric",
+    "param",
+    "value",
+    "better",
+    "file",
+    "mtime",
+]
+
+# rows returned by parsers: dicts with (a subset of) name, tags, date, run,
+# metric, param, value, better
+Row = Dict[str, Any]
+
+
+@dataclass
+class Ingester:
+    benchmark: str
+    # glob pattern relative to the result dir
+    pattern: str
+    # parse(file, parts of the path relative to the result dir) -> rows
+    parse: Callable[[Path, List[str]], List[Row]]
+
+
+def ingest_iperf(file: Path, parts: List[str]) -> List[Row]:
+    # network/iperf/{name}/{proto}/{date}/{size}.log
+    from plot_network import parse_iperf_log
+
+    _, _, name, proto, date, _ = parts
+    return [
+        dict(
+            name=name,
+            tags=proto,
+            date=date,
+            metric="throughput",  # Gbits/sec
+            param=file.stem,
+            value=parse_iperf_log(file),
+        )
+    ]
+
+
+def ingest_ping(file: Path, parts: List[str]) -> List[Row]:
+    # network/ping/{name}/{date}/{size}.log
+    from plot_network import parse_ping_log
+
+    _, _, name, date, _ = parts
+    return [
+        dict(
+            name=name,
+            date=date,
+            run=str(i),
+            metric="latency",
+            param=file.stem,
+            value=lat,
+        )
+        for i, lat in enumerate(parse_ping_log(file))
+    ]
+
+
+def ingest_memtier(file: Path, parts: List[str]) -> List[Row]:
+    # network/memtier/{server}[-tls]/{name}/{date}/memtier.log
+    from plot_network import parse_memtier_result_sub
+
+    _, _, server, name, date, _ = parts
+    df = parse_memtier_result_sub(file, name, server)
+    return [
+        dict(name=name, tags=server, date=date, metric="throughput", param=w, value=th)
+        for w, th in zip(df["workload"], df["throughput"])
+    ]
+
+
+def ingest_nginx(file: Path, parts: List[str]) -> List[Row]:
+    # network/nginx/{name}/{date}/{http,https}.log
+    from plot_network import parse_nginx_result_sub
+
+    _, _, name, date, _ = parts
+    df = parse_nginx_result_sub(file, name, file.stem)
+    return [
+        dict(name=name, date=date, metric="throughput", param=file.stem, value=th)
+        for th in df["throughput"]
+    ]
+
+
+def ingest_fio(file: Path, parts: List[str]) -> List[Row]:
+    # fio/{name}/{job}/{date}.json
+    from plot_storage import read_fio_result
+
+    _, name, job, _ = parts
+    df = read_fio_result(file, name)
+    rows = []
+    for _, r in df.iterrows():
+        for metric in df.columns[2:]:
+            rows.append(
+                dict(
+                    name=name,
+                    tags=job,
+                    date=file.stem,
+                    metric=metric,
+                    param=r["jobname"],
+                    value=r[metric],
+                )
+            )
+    return rows
+
+
+def ingest_fio_host(file: Path, parts: List[str]) -> List[Row]:
+    # fio/{name}/{job}/{date}.blockstats.jsonl: QEMU's block statistics
+    from blockstats import load_samples, summarize
+
+    _, name, job, _ = parts
+    samples = load_samples(file)
+    if not samples:
+        return []
+    date = file.name.split(".")[0]
+    return [
+        dict(name=name, tags=job, date=date, metric=metric, value=value)
+        for metric, value in summarize(samples).items()
+    ]
+
+
+def ingest_fio_sweep(file: Path, parts: List[str]) -> List[Row]:
+    # fio-sweep/{name}/{date}/{job}.json: the job name has the parameters
+    from plot_storage import read_fio_result
+
+    _, name, date, _ = parts
+    df = read_fio_result(file, name)
+    return [
+        dict(name=name, tags=r["jobname"], date=date, metric=metric, value=r[metric])
+        for _, r in df.iterrows()
+        for metric in df.columns[2:]
+    ]
+
+
+def ingest_fio_sweep_host(file: Path, parts: List[str]) -> List[Row]:
+    # fio-sweep/{name}/{date}/{job}.blockstats.jsonl
+    from blockstats import load_samples, summarize
+
+    _, name, date, _ = parts
+    samples = load_samples(file)
+    if not samples:
+        return []
+    job = file.name.split(".")[0]
+    return [
+        dict(name=name, tags=job, date=date, metric=metric, value=value)
+        for metric, value in summarize(samples).items()
+    ]
+
+
+def ingest_mlc(file: Path, parts: List[str]) -> List[Row]:
+    # memory/mlc/{name}/{date}/mlc.log
+    from memory import parse_mlc_result_sub
+
+    _, _, name, date, _ = parts
+    df = parse_mlc_result_sub(date, file)
+    return [
+        dict(name=name, date=date, metric=metric, value=df[metric][0])
+        for metric in df.columns[1:]
+    ]
+
+
+def ingest_boottime(file: Path, parts: List[str]) -> List[Row]:
+    # boottime/{name}/{date}/{i}.txt
+    # rows of the finer phases (not in PHASES) and of page fault/PSC counts
+    # per phase (metric "page faults"/"psc", param = phase) follow the phases
+    from plot_boottime import PHASES, parse_breakdown, parse_result
+
+    _, name, date, _ = parts
+    with open(file) as f:
+        lines = f.readlines()
+    times = parse_result(lines)
+    rows = [
+        dict(name=name, date=date, run=file.stem, metric=phase, value=t)
+        for phase, t in zip(PHASES, times)
+    ]
+    row = dict(name=name, date=date, run=file.stem)
+    breakdown = parse_breakdown(lines)
+    for phase, t in breakdown.pop("phases").items():
+        if phase not in PHASES:
+            rows.append(dict(row, metric=phase, value=t))
+    for counter, counts in breakdown.items():
+        rows += [dict(row, metric=counter, param=p, value=n) for p, n in counts.items()]
+    return rows
+
+
+def ingest_unixbench(file: Path, parts: List[str]) -> List[Row]:
+    # unixbench/{name}/{date} (the same directory has {date}.html etc.)
+    from plot_unixbench import parse_result_sub
+
+    _, name, date = parts
+    if "." in date:
+        return []
+    df = parse_result_sub(file, name)
+    return [
+        dict(name=name, date=date, metric=b, value=i)
+        for b, i in zip(df["benchmark"], df["index"])
+    ]
+
+
+def ingest_phoronix(file: Path, parts: List[str]) -> List[Row]:
+    # phoronix/{name}/{bench_name}/{date}.xml
+    from phoronix import parse_xml
+
+    _, name, bench_name, _ = parts
+    df = parse_xml(file)
+    # Proportion: HIB (higher is better) or LIB (lower is better)
+    better = {"HIB": "higher", "LIB": "lower"}
+    return [
+        dict(
+            name=name,
+            tags=bench_name,
+            date=file.stem,
+            metric=b,
+            param=i,
+            value=v,
+            better=better.get(p, ""),
+        )
+        for b, i, v, p in zip(
+            df["benchmark_id"], df["identifier"], df["value"], df["proportion"]
+        )
+    ]
+
+
+def ingest_application(file: Path, parts: List[str]) -> List[Row]:
+    # application/{app}/{name}/{date}/{i}.log (blender),
+    # thread_{n}-{i}.log (pytorch, tensorflow) or {workload}.log (sqlite)
+    import plot_application
+
+    _, app, name, date, _ = parts
+    if app == "sqlite":
+        df = plot_application.parse_sqlite_result_sub(name, file.stem, file)
+        return [
+            dict(
+                name=name,
+                tags=app,
+                date=date,
+                metric="time",
+                param=file.stem,
+                value=df["time"][0],
+            )
+        ]
+    parse = {
+        "blender": plot_application.parse_blender_result_sub,
+        "pytorch": plot_application.parse_pytorch_result_sub,
+        "tensorflow": plot_application.parse_tensorflow_result_sub,
+    }
+    if app not in parse:
+        return []
+    df = parse[app](name, file)
+    # tensorflow reports examples/sec, the others the runtime in seconds
+    metric = "throughput" if app == "tensorflow" else "time"
+    threads = file.stem.rsplit("-", 1)[0] if "-" in file.stem else ""
+    return [
+        dict(
+            name=name,
+            tags=app,
+            date=date,
+            run=file.stem,
+            metric=metric,
+            param=threads,
+            value=df["time"][0],
+        )
+    ]
+
+
+def ingest_vmexit(file: Path, parts: List[str]) -> List[Row]:
+    # vmexit/{name}/{date}/{i}.txt: avg_time and per-call percentiles [ns]
+    from vmexit_bench import PERCENTILES, hist_percentiles, merged_hist, parse_result
+
+    _, name, date, _ = parts
+    with open(file) as f:
+        results = parse_result(f.readlines())
+    rows = []
+    for op, r in results.items():
+        row = dict(name=name, date=date, run=file.stem, metric=op)
+        rows.append(dict(row, param="avg_time", value=r.avg_time))
+        for p, v in zip(PERCENTILES, hist_percentiles(merged_hist([r]), PERCENTILES)):
+            rows.append(dict(row, param=f"p{p:g}", value=v))
+    return rows
+
+
+INGESTERS = [
+    Ingester("iperf", "network/iperf/*/*/*/*.log", ingest_iperf),
+    Ingester("ping", "network/ping/*/*/*.log", ingest_ping),
+    Ingester("memtier", "network/memtier/*/*/*/memtier.log", ingest_memtier),
+    Ingester("nginx", "network/nginx/*/*/*.log", ingest_nginx),
+    Ingester("fio", "fio/*/*/*.json", ingest_fio),
+    Ingester("fio-host", "fio/*/*/*.blockstats.jsonl", ingest_fio_host),
+    Ingester("fio-sweep", "fio-sweep/*/*/*.json", ingest_fio_sweep),
+    Ingester(
+        "fio-sweep-host", "fio-sweep/*/*/*.blockstats.jsonl", ingest_fio_sweep_host
+    ),
+    Ingester("mlc", "memory/mlc/*/*/mlc.log", ingest_mlc),
+    Ingester("boottime", "boottime/*/*/*.txt", ingest_boottime),
+    Ingester("unixbench", "unixbench/*/*", ingest_unixbench),
+    Ingester("phoronix", "phoronix/*/*/*.xml", ingest_phoronix),
+    Ingester("application", "application/*/*/*/*.log", ingest_application),
+    Ingester("vmexit", "vmexit/*/*/*.txt", ingest_vmexit),
+]
+
+
+def empty() -> pd.DataFrame:
+    return normalize(pd.DataFrame(columns=COLUMNS))
+
+
+def normalize(df: pd.DataFrame) -> pd.DataFrame:
+    """Fix the column types so that the parquet schema is stable"""
+    df = df.reindex(columns=COLUMNS)
+    for c in COLUMNS:
+        if c == "value":
+            df[c] = df[c].astype("float64")
+        elif c == "mtime":
+            df[c] = df[c].astype("int64")
+        else:
+            df[c] = df[c].fillna("").astype(str)
+    return df
+
+
+def parse_file(ingester: Ingester, root: Path, file: Path) -> pd.DataFrame:
+    rel = file.relative_to(root)
+    mtime = file.stat().st_mtime_ns
+    try:
+        rows = ingester.parse(file, list(rel.parts))
+    except Exception as e:
+        print(f"[store] failed to parse {file}: {e}")
+        rows = []
+    if not rows:
+        # remember the file so that it is not parsed again until it changes
+        rows = [dict(metric="", value=float("nan"))]
+    df = pd.DataFrame(rows)
+    df["benchmark"] = ingester.benchmark
+    df["file"] = str(rel)
+    df["mtime"] = mtime
+    return normalize(df)
+
+
+ParseJob = Tuple[Ingester, Path, Path]  # (ingester, result dir, file)
+
+
+def _parse_job(job: ParseJob) -> pd.DataFrame:
+    return parse_file(*job)
+
+
+def parse_files(
+    jobs: List[ParseJob], workers: Optional[int] = None
+) -> Iterator[pd.DataFrame]:
+    """Parse files with a pool of worker processes.
+    DataFrames are yielded as they are parsed, in the order of `jobs`."""
+    if workers == 1 or len(jobs) < PARALLEL_THRESHOLD:
+        for job in jobs:
+            yield _parse_job(job)
+        return
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        yield from executor.map(_parse_job, jobs, chunksize=chunksize)
+
+
+class ResultStore:
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        self.path = self.root / STORE_FILE
+        self.df = pd.read_parquet(self.path) if self.path.exists() else empty()
+        if set(COLUMNS) - set(self.df.columns):
+            # written by an older version: parse all files again
+            self.df = empty()
+
+    def scan(self) -> Dict[str, Any]:
+        """Return {file: (ingester, mtime)} of all result files"""
+        files = {}
+        for ingester in INGESTERS:
+            for file in self.root.glob(ingester.pattern):
+                if file.is_file():
+                    rel = str(file.relative_to(self.root))
+                    files[rel] = (ingester, file.stat().st_mtime_ns)
+        return files
+
+    def update(self, workers: Optional[int] = None) -> int:
+        """Parse new and modified files (in parallel with `workers` processes)
+        and drop removed files. Return the number of parsed files."""
+        known = dict(zip(self.df["file"], self.df["mtime"]))
+        files = self.scan()
+        stale = [f for f in known if f not in files or files[f][1] != known[f]]
+        new = [f for f in files if f not in known or files[f][1] != known[f]]
+        if not stale and not new:
+            return 0
+        jobs = [(files[f][0], self.root, self.root / f) for f in sorted(new)]
+        frames = list(parse_files(jobs, workers))
+        df = self.df[~self.df["file"].isin(set(stale))]
+        df = pd.concat([df, *frames], ignore_index=True)
+        # the row order does not depend on when files were ingested
+        self.df = normalize(df.sort_values("file", kind="stable", ignore_index=True))
+        self.save()
+        return len(new)
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        self.df.to_parquet(tmp, index=False)
+        os.replace(tmp, self.path)
+
+    def query(self, benchmark: str, **filters: str) -> pd.DataFrame:
+        """Return the rows of `benchmark` matching all column=value filters,
+        ordered by date and in the order of the raw file"""
+        df = self.df
+        mask = (df["benchmark"] == benchmark) & (df["metric"] != "")
+        for column, value in filters.items():
+            mask &= df[column] == value
+        return df[mask].sort_values("date", kind="stable")
+
+
+_STORES: Dict[Path, ResultStore] = {}
+
+
+def get_store(root: Path) -> ResultStore:
+    """Return the up-to-date store of the result dir `root`.
+    The store is updated once per process."""
+    key = Path(root).resolve()
+    if key not in _STORES:
+        store = ResultStore(root)
+        store.update()
+        _STORES[key] = store
+    return _STORES[key]
+
+
+def query(root: Path, benchmark: str, **filters: str) -> pd.DataFrame:
+    return get_store(root).query(benchmark, **filters)
+
+
+def select_dates(
+    df: pd.DataFrame, date: Optional[str] = None, max_num: int = 1
+) -> List[str]:
+    """Return `date`, or the latest `max_num` dates of df"""
+    if date is not None:
+        return [date]
+    return sorted(df["date"].unique())[-max_num:]
+
+
+@task
+def ingest(
+    ctx: Any,
+    result_dir: str = "./bench-result",
+    rebuild: bool = False,
+    jobs: Optional[int] = None,  # number of parser processes (default: number of CPUs)
+) -> None:
+    """Parse new and modified result files into {result_dir}/.store.parquet"""
+    # invoke passes options without a typed default (None) as strings
+    if jobs is not None:
+        jobs = int(jobs)
+    store = ResultStore(Path(result_dir))
+    if rebuild:
+        store.df = empty()
+    n = store.update(workers=jobs)
+    print(f"parsed {n} files, {len(store.df)} rows in {store.path}")
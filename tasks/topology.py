@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Host CPU/NUMA topology read from sysfs"""
+
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List
+
+import psutil
+
+SYSFS_NODE = Path("/sys/devices/system/node")
+SYSFS_CPU = Path("/sys/devices/system/cpu")
+
+
+def parse_cpulist(cpulist: str) -> List[int]:
+    """Parse a cpulist (e.g., "0-3,8,10-11") used in sysfs and taskset"""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if part == "":
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def format_cpulist(cpus: List[int]) -> str:
+    """Inverse of parse_cpulist()"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{s}-{e}" if s != e else f"{s}" for s, e in ranges)
+
+
+@dataclass
+class NumaNode:
+    id: int
+    cpus: List[int]
+    memory: int  # GB
+
+
+def numa_nodes() -> List[NumaNode]:
+    """Return the NUMA nodes of the host.
+    If sysfs does not expose NUMA information, the whole host is one node."""
+    nodes = []
+    for d in SYSFS_NODE.glob("node[0-9]*"):
+        cpus = parse_cpulist((d / "cpulist").read_text())
+        # e.g., "Node 0 MemTotal:       263856196 kB"
+        m = re.search(r"MemTotal:\s+(\d+) kB", (d / "meminfo").read_text())
+        memory = int(m.group(1)) // (1024 * 1024) if m else 0
+        nodes.append(NumaNode(id=int(d.name[len("node") :]), cpus=cpus, memory=memory))
+    if not nodes:
+        memory = psutil.virtual_memory().total // (1024**3)
+        nodes.append(NumaNode(id=0, cpus=list(range(os.cpu_count())), memory=memory))
+    return sorted(nodes, key=lambda n: n.id)
+
+
+@dataclass
+class Core:
+    node: int
+    threads: List[int]  # SMT siblings in ascending order
+
+
+def cores() -> List[Core]:
+    """Return the physical cores of the host ordered by their first CPU.
+    Without topology information in sysfs, each CPU is a core."""
+    node_of = {cpu: n.id for n in numa_nodes() for cpu in n.cpus}
+    result, seen = [], set()
+    for cpu in sorted(node_of):
+        if cpu in seen:
+            continue
+        siblings = SYSFS_CPU / f"cpu{cpu}" / "topology" / "thread_siblings_list"
+        threads = parse_cpulist(siblings.read_text()) if siblings.exists() else [cpu]
+        # offline siblings are not in any node
+        threads = sorted(t for t in threads if t in node_of) or [cpu]
+        seen.update(threads)
+        result.append(Core(node=node_of[cpu], threads=threads))
+    return result
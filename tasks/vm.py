@@ -1,15 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+from contextlib import contextmanager, nullcontext
 from copy import deepcopy
-from dataclasses import dataclass
-from typing import Any, Optional, List
+from dataclasses import dataclass, replace
+from typing import Any, ContextManager, Iterator, Optional, List, Tuple
 from pathlib import Path
+import json
+import os
 import shlex
 
 from invoke import task
 
-from config import BUILD_DIR, PROJECT_ROOT, LINUX_DIR, SSH_PORT
+from config import BUILD_DIR, PROJECT_ROOT, LINUX_DIR, SSH_PORT, VIRTIO_BLK_ID
+from naming import blk_name_suffix, nic_name_suffix
 from qemu import spawn_qemu, QemuVm
 
 
@@ -26,7 +30,13 @@ class VMResource:
     memory: int  # GB
     pin_base: int
     numa_node: [int] = None
-    vnuma: Optional[NodeInfo] = None
+    # guest NUMA nodes; node i is bound to the host node numa_node[i]
+    vnuma: Optional[List[NodeInfo]] = None
+    # memory backend tuning (see qemu_option_memory())
+    hugepages: Optional[str] = None  # huge page size, e.g., "2M", "1G"
+    hugetlbfs: Optional[str] = None  # hugetlbfs mount (default: memfd with hugetlb=on)
+    prealloc_threads: Optional[int] = None  # QEMU's default is 1
+    reserve: bool = True  # if False, map guest memory with MAP_NORESERVE
 
 
 @dataclass
@@ -302,9 +312,74 @@ def get_vm_config(name: str) -> VMConfig:
     raise ValueError(f"Unknown VM image: {name}")
 
 
+def memory_tuned(resource: VMResource) -> bool:
+    return (
+        resource.hugepages is not None
+        or resource.prealloc_threads is not None
+        or not resource.reserve
+    )
+
+
+def qemu_option_memory(
+    resource: VMResource,
+    config: dict,
+    backend: str = "ram",  # ram or memfd (SNP)
+    share: bool = False,
+    required: bool = True,  # if False, use a backend only if tuned or with vnuma
+) -> Tuple[str, str]:
+    """Return the -machine suboption and the options of the guest memory.
+
+    With resource.vnuma, there is a backend per guest node that is bound to its
+    host node (host-nodes, policy=bind). Otherwise there is a single backend
+    "ram1" (numactl of spawn_qemu() binds it). Huge pages use a
+    memory-backend-file on resource.hugetlbfs if given, otherwise a
+    memory-backend-memfd with hugetlb=on. Preallocation (--boot-prealloc) is
+    done by resource.prealloc_threads threads. A vhost-user-blk backend
+    (--virtio-blk-backend vhost-user) needs a shared memfd backend.
+    """
+    if config.get("virtio_blk") and config.get("virtio_blk_backend") == "vhost-user":
+        # qemu-storage-daemon maps guest memory (see storage_daemon.py)
+        backend, share, required = "memfd", True, True
+    if not required and resource.vnuma is None and not memory_tuned(resource):
+        return "", ""
+    props = f"prealloc={'on' if config.get('boot_prealloc', True) else 'off'}"
+    if resource.prealloc_threads is not None:
+        props += f",prealloc-threads={resource.prealloc_threads}"
+    if not resource.reserve:
+        props += ",reserve=off"
+    if share:
+        props += ",share=true"
+    if resource.hugepages is None:
+        obj = f"memory-backend-{backend}"
+    elif resource.hugetlbfs is not None:
+        obj = f"memory-backend-file,mem-path={resource.hugetlbfs}"
+    else:
+        obj = f"memory-backend-memfd,hugetlb=on,hugetlbsize={resource.hugepages}"
+
+    if resource.vnuma is None:
+        memory = f"-object {obj},id=ram1,size={resource.memory}G,{props}"
+        return ",memory-backend=ram1", memory
+
+    host_nodes = resource.numa_node or list(range(len(resource.vnuma)))
+    if len(host_nodes) != len(resource.vnuma):
+        raise ValueError("vnuma needs a host NUMA node (numa_node) per guest node")
+    options, dists = [], []
+    for i, (node, host_node) in enumerate(zip(resource.vnuma, host_nodes)):
+        options += [
+            f"-object {obj},id=node{i},size={node.mem}G,{props}"
+            f",host-nodes={host_node},policy=bind",
+            f"-numa node,nodeid={i},cpus={node.cpus},memdev=node{i}",
+        ]
+        # dist: distances to the following nodes (all nodes must exist first)
+        for j, d in enumerate(node.dist, start=i + 1):
+            dists.append(f"-numa dist,src={i},dst={j},val={d}")
+    return "", "\n".join(options + dists)
+
+
 def get_amd_vm_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     vmconfig: VMConfig = get_vm_config("amd")
     ssh_port = config["ssh_port"]
+    machine_memory, memory = qemu_option_memory(resource, config, required=False)
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -312,7 +387,8 @@ def get_amd_vm_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     -cpu host
     -smp {resource.cpu}
     -m {resource.memory}G
-    -machine q35
+    -machine q35{machine_memory}
+    {memory}
 
     -blockdev qcow2,node-name=q2,file.driver=file,file.filename={vmconfig.image}
     -device virtio-blk-pci,drive=q2,bootindex=0
@@ -331,6 +407,7 @@ def get_amd_vm_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     vmconfig: VMConfig = get_vm_config("amd-direct")
     ssh_port = config.get("ssh_port", SSH_PORT)
     extra_cmdline = config.get("extra_cmdline", "")
+    machine_memory, memory = qemu_option_memory(resource, config, required=False)
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -338,7 +415,8 @@ def get_amd_vm_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     -enable-kvm
     -smp {resource.cpu}
     -m {resource.memory}G
-    -machine q35
+    -machine q35{machine_memory}
+    {memory}
 
     -kernel {vmconfig.kernel}
     -append "{vmconfig.cmdline} {extra_cmdline}"
@@ -364,10 +442,9 @@ def get_amd_vm_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
 def get_snp_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     vmconfig: VMConfig = get_vm_config("snp")
     ssh_port = config["ssh_port"]
-    if config["boot_prealloc"]:
-        prealloc = "on"
-    else:
-        prealloc = "off"
+    machine_memory, memory = qemu_option_memory(
+        resource, config, backend="memfd", share=True
+    )
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -376,9 +453,9 @@ def get_snp_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     -smp {resource.cpu}
     -m {resource.memory}G
 
-    -machine q35,memory-backend=ram1,memory-encryption=sev0,vmport=off
+    -machine q35{machine_memory},memory-encryption=sev0,vmport=off
     -object sev-snp-guest,id=sev0,cbitpos=51,reduced-phys-bits=1,policy=0x30000
-    -object memory-backend-memfd,id=ram1,size={resource.memory}G,share=true,prealloc={prealloc}
+    {memory}
 
     -blockdev qcow2,node-name=q2,file.driver=file,file.filename={vmconfig.image}
     -device virtio-blk-pci,drive=q2,bootindex=0
@@ -397,10 +474,9 @@ def get_snp_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     vmconfig: VMConfig = get_vm_config("amd-direct")
     ssh_port = config.get("ssh_port", SSH_PORT)
     extra_cmdline = config.get("extra_cmdline", "")
-    if config["boot_prealloc"]:
-        prealloc = "on"
-    else:
-        prealloc = "off"
+    machine_memory, memory = qemu_option_memory(
+        resource, config, backend="memfd", share=True
+    )
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -409,9 +485,9 @@ def get_snp_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     -smp {resource.cpu}
     -m {resource.memory}G
 
-    -machine q35,memory-backend=ram1,memory-encryption=sev0,vmport=off
+    -machine q35{machine_memory},memory-encryption=sev0,vmport=off
     -object sev-snp-guest,id=sev0,cbitpos=51,reduced-phys-bits=1,policy=0x30000
-    -object memory-backend-memfd,id=ram1,size={resource.memory}G,share=true,prealloc={prealloc}
+    {memory}
 
     -kernel {vmconfig.kernel}
     -append "{vmconfig.cmdline} {extra_cmdline}"
@@ -437,6 +513,7 @@ def get_snp_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
 def get_intel_qemu_cmd(type: str, resource: VMResource, config: dict) -> List[str]:
     vmconfig: VMConfig = get_vm_config(type)
     ssh_port = config["ssh_port"]
+    machine_memory, memory = qemu_option_memory(resource, config, required=False)
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -444,7 +521,8 @@ def get_intel_qemu_cmd(type: str, resource: VMResource, config: dict) -> List[st
         -cpu host,pmu=off
         -smp {resource.cpu}
         -m {resource.memory}G
-        -machine q35,kernel_irqchip=split,hpet=off
+        -machine q35,kernel_irqchip=split,hpet=off{machine_memory}
+        {memory}
 
         -bios {vmconfig.ovmf}
         -nographic
@@ -465,18 +543,7 @@ def get_intel_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     vmconfig: VMConfig = get_vm_config("intel-direct")
     ssh_port = config["ssh_port"]
     extra_cmdline = config.get("extra_cmdline", "")
-
-    if resource.vnuma is not None:
-        # FIXME: the current vnuma config is static
-        numa_config = f"""
-        -object memory-backend-ram,size=128G,prealloc=yes,host-nodes=0,policy=bind,id=node0
-        -numa node,nodeid=0,cpus=0-27,memdev=node0
-        -object memory-backend-ram,size=128G,prealloc=yes,host-nodes=1,policy=bind,id=node1
-        -numa node,nodeid=1,cpus=28-55,memdev=node1
-        -numa dist,src=0,dst=1,val=12
-        """
-    else:
-        numa_config = ""
+    machine_memory, memory = qemu_option_memory(resource, config, required=False)
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -485,9 +552,9 @@ def get_intel_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
         -smp {resource.cpu}
 
         -m {resource.memory}G
-        -machine q35,kernel_irqchip=split,hpet=off
+        -machine q35,kernel_irqchip=split,hpet=off{machine_memory}
 
-        {numa_config}
+        {memory}
 
         -kernel {vmconfig.kernel}
         -append "{vmconfig.cmdline} {extra_cmdline}"
@@ -515,10 +582,7 @@ def get_tdx_qemu_cmd(type, resource: VMResource, config: dict) -> List[str]:
     vmconfig: VMConfig = get_vm_config(type)
     ssh_port = config["ssh_port"]
     guest_cid = config["guest_cid"]
-    if config["boot_prealloc"]:
-        prealloc = "on"
-    else:
-        prealloc = "off"
+    machine_memory, memory = qemu_option_memory(resource, config)
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -526,10 +590,10 @@ def get_tdx_qemu_cmd(type, resource: VMResource, config: dict) -> List[str]:
         -cpu host,pmu=off
         -smp {resource.cpu}
         -m {resource.memory}G
-        -machine q35,hpet=off,kernel_irqchip=split,confidential-guest-support=tdx,memory-backend=ram1
+        -machine q35,hpet=off,kernel_irqchip=split,confidential-guest-support=tdx{machine_memory}
 
         -object tdx-guest,id=tdx
-        -object memory-backend-ram,id=ram1,size={resource.memory}G,prealloc={prealloc}
+        {memory}
         -bios {vmconfig.ovmf}
         -nographic
         -nodefaults
@@ -552,21 +616,7 @@ def get_tdx_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
     ssh_port = config["ssh_port"]
     guest_cid = config["guest_cid"]
     extra_cmdline = config.get("extra_cmdline", "")
-    if config["boot_prealloc"]:
-        prealloc = "on"
-    else:
-        prealloc = "off"
-
-    if resource.vnuma is not None:
-        memory = f"""
-        -object memory-backend-ram,size={resource.memory//2}G,prealloc={prealloc},host-nodes=0,policy=bind,id=node0
-        -numa node,nodeid=0,cpus=0-27,memdev=node0
-        -object memory-backend-ram,size={resource.memory//2}G,prealloc={prealloc},host-nodes=1,policy=bind,id=node1
-        -numa node,nodeid=1,cpus=28-55,memdev=node1
-        -numa dist,src=0,dst=1,val=12
-        """
-    else:
-        memory = f"-object memory-backend-ram,id=node0,size={resource.memory}G,prealloc={prealloc}"
+    machine_memory, memory = qemu_option_memory(resource, config)
 
     qemu_cmd = f"""
     {vmconfig.qemu}
@@ -574,7 +624,7 @@ def get_tdx_direct_qemu_cmd(resource: VMResource, config: dict) -> List[str]:
         -cpu host,pmu=off
         -smp {resource.cpu}
         -m {resource.memory}G
-        -machine q35,hpet=off,kernel_irqchip=split,confidential-guest-support=tdx
+        -machine q35,hpet=off,kernel_irqchip=split,confidential-guest-support=tdx{machine_memory}
 
         -object tdx-guest,id=tdx
         {memory}
@@ -611,6 +661,8 @@ def qemu_option_virtio_blk(
     iothread: bool = True,  # if True, use QEMU iothread
     iommu_option: bool = False,  # if True, enable VIRTIO_F_ACCESS_PLATFORM (VIRTIO_F_IOMMU_PLATFORM) feature bit
     # (this is necessary to force bounce buffers in a normal VM for testing)
+    num_queues: Optional[int] = None,  # virtqueues (QEMU's default: one per vCPU)
+    iothreads: int = 1,  # with iothread; queues are spread over the iothreads
 ) -> List[str]:
     # QEMU options (https://www.qemu.org/docs/master/system/qemu-manpage.html)
     # -drive cache=
@@ -650,16 +702,49 @@ def qemu_option_virtio_blk(
     else:
         iommu = ""
 
-    if iothread:
+    queues = f",num-queues={num_queues}" if num_queues is not None else ""
+
+    if not iothread and iothreads > 1:
+        raise ValueError(f"{iothreads} iothreads contradict --no-virtio-blk-iothread")
+    if iothread and iothreads > 1:
+        # iothread-vq-mapping (QEMU 9.0+) is a list, so -device takes JSON.
+        # Without explicit vqs, QEMU assigns the queues round-robin.
+        if num_queues is not None and num_queues < iothreads:
+            raise ValueError(f"{iothreads} iothreads need at least as many queues")
+        device = {
+            "driver": "virtio-blk-pci",
+            "id": VIRTIO_BLK_ID,
+            "drive": "q1",
+            "iothread-vq-mapping": [
+                {"iothread": f"iothread{i}"} for i in range(iothreads)
+            ],
+        }
+        if num_queues is not None:
+            device["num-queues"] = num_queues
+        if iommu_option:
+            device.update(
+                {
+                    "iommu_platform": True,
+                    "disable-modern": False,
+                    "disable-legacy": "on",
+                }
+            )
+        objects = " ".join(f"-object iothread,id=iothread{i}" for i in range(iothreads))
+        option = f"""
+            -blockdev node-name=q1,driver=raw,file.driver={driver},file.filename={file},file.aio={aio},cache.direct={cache_direct},cache.no-flush=off
+            -device {shlex.quote(json.dumps(device))}
+            {objects}
+        """
+    elif iothread:
         option = f"""
             -blockdev node-name=q1,driver=raw,file.driver={driver},file.filename={file},file.aio={aio},cache.direct={cache_direct},cache.no-flush=off
-            -device virtio-blk-pci,drive=q1,iothread=iothread0{iommu}
+            -device virtio-blk-pci,id={VIRTIO_BLK_ID},drive=q1,iothread=iothread0{queues}{iommu}
             -object iothread,id=iothread0
         """
     else:
         option = f"""
             -blockdev node-name=q1,driver=raw,file.driver={driver},file.filename={file},file.aio={aio},cache.direct={cache_direct},cache.no-flush=off
-            -device virtio-blk-pci,drive=q1{iommu}
+            -device virtio-blk-pci,id={VIRTIO_BLK_ID},drive=q1{queues}{iommu}
         """
 
     return shlex.split(option)
@@ -704,17 +789,70 @@ def qemu_option_virtio_nic(
     return shlex.split(option)
 
 
+@contextmanager
+def booted_vm(qemu_cmd: List[str], pin: bool, config: dict) -> Iterator[QemuVm]:
+    """Start a VM, pin vCPUs, and wait until ssh is available.
+    The VM is shut down when the context exits."""
+    resource: VMResource = config["resource"]
+    vm: QemuVm
+    with spawn_qemu(qemu_cmd, numa_node=resource.numa_node, config=config) as vm:
+        if pin:
+            vm.pin(config["pin_plan"])
+        vm.wait_for_ssh()
+        if pin:
+            vm.pin_vhost(config["pin_plan"])
+        yield vm
+        vm.shutdown()
+
+
+def new_vm(qemu_cmd: List[str], pin: bool, config: dict) -> ContextManager[QemuVm]:
+    """Boot a VM, or restore it from a snapshot with --snapshot (see snapshot.py)"""
+    if not config.get("snapshot", False):
+        return booted_vm(qemu_cmd, pin, config)
+    import snapshot
+
+    type: str = config["type"]
+    if not snapshot.is_supported(type):
+        print(f"WARN: {type} VMs cannot be snapshotted, boot the VM instead")
+        return booted_vm(qemu_cmd, pin, config)
+    vmconfig = get_vm_config(f"{type}-direct" if config["direct"] else type)
+    qemu_img = Path(vmconfig.qemu).parent / "qemu-img"
+    return snapshot.restored_vm(qemu_cmd, pin, config, vmconfig.image, qemu_img)
+
+
+@contextmanager
+def running_vm(qemu_cmd: List[str], pin: bool, config: dict) -> Iterator[QemuVm]:
+    """Get a VM for a benchmark action.
+    With --pool, a warm VM started by a previous action with the same QEMU
+    command is reused (see pool.py). Otherwise a fresh VM is booted.
+    With --collect, collectors run while the VM is used (see collect.py).
+    """
+    from collect import collecting
+
+    if config.get("pool", False):
+        from pool import get_pool, pool_key
+
+        with get_pool().acquire(
+            pool_key(qemu_cmd, config),
+            lambda: new_vm(qemu_cmd, pin, config),
+            config,
+        ) as vm, collecting(vm, config):
+            yield vm
+    else:
+        with new_vm(qemu_cmd, pin, config) as vm, collecting(vm, config):
+            yield vm
+
+
 def start_and_attach(qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
     """Start a VM and attach to the console (tmux session) to interact with the VM.
     Note 1: The VM automatically terminates when the tmux session is closed.
     Note 2: Ctrl-C goes to the tmux session, not the VM, killing the entier session with the VM.
     """
     resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
     vm: QemuVM
     with spawn_qemu(qemu_cmd, numa_node=resource.numa_node) as vm:
         if pin:
-            vm.pin_vcpu(pin_base)
+            vm.pin(kargs["config"]["pin_plan"])
         vm.attach()
         vm.shutdown()
 
@@ -738,13 +876,12 @@ def ipython(qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
     Note that the VM automatically terminates when the ipython session is closed.
     """
     resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
     vm: QemuVM
     with spawn_qemu(
         qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
     ) as vm:
         if pin:
-            vm.pin_vcpu(pin_base)
+            vm.pin(kargs["config"]["pin_plan"])
         from IPython import embed
 
         embed()
@@ -757,23 +894,13 @@ def ssh_cmd(qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
     # we can have multiple ssh commands
     inv vm.start --type intel --ssh-cmd "echo hi" --ssh-cmd "ls /" --action ssh-cmd
     """
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
     cmds: [str] = kargs["config"]["ssh_cmd"]
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
-
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         for cmd in cmds:
             cmd_ = shlex.split(cmd)
             vm.ssh_cmd(cmd_)
 
-        vm.shutdown()
-
 
 def boottime(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
     """Measure the boot time of a VM"""
@@ -791,38 +918,24 @@ def prepare(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
 
 
 def prepare_phoronix(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from phoronix import install_bench
 
         install_bench("pts/memory", vm)
         install_bench("pts/npb", vm)
-        vm.shutdown()
 
 
 def prepare_app(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
-
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from application import prepare
 
         prepare(vm)
 
-        vm.shutdown()
+
+def get_vm_name(type: str, direct: bool, size: str, name_extra: str = "") -> str:
+    return f"{type}-{'direct' if direct else 'disk'}-{size}" + name_extra
 
 
 def run_phoronix(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
@@ -833,291 +946,219 @@ def run_phoronix(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> Non
         )
         return
 
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         import phoronix
 
         phoronix.run_phoronix(name, f"{bench_name}", f"pts/{bench_name}", vm)
-        vm.shutdown()
 
 
 def run_mlc(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         import memory
 
         memory.run_mlc(name, vm)
-        vm.shutdown()
 
 
 def run_blender(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
     repeat: int = kargs["config"].get("repeat", 1)
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    target_ci: Optional[float] = kargs["config"].get("repeat_ci")
+    max_repeat: int = kargs["config"].get("repeat_max", 20)
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from application import run_blender
 
-        run_blender(name, vm, repeat=repeat)
-        vm.shutdown()
+        run_blender(name, vm, repeat=repeat, target_ci=target_ci, max_repeat=max_repeat)
+
+
+def run_vmexit(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
+    repeat: int = kargs["config"].get("repeat", 1)
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
+        from vmexit_bench import run_vmexit
+
+        run_vmexit(name, vm, repeat=repeat)
+
+
+def client_cpus(config: dict) -> Optional[str]:
+    """CPUs of the host-side load generator in the pinning plan (see pinning.py).
+    None (without --pin) uses the defaults of network.py. If the plan has no
+    CPU for it, the load generator runs unpinned (on all CPUs of this process)
+    rather than on the defaults, which may be vCPUs of the plan."""
+    if "pin_plan" not in config:
+        return None
+    cpus = config["pin_plan"].client_cpus()
+    if cpus is None:
+        from topology import format_cpulist
+
+        cpus = format_cpulist(sorted(os.sched_getaffinity(0)))
+        print(f"WARN: no CPUs for the load generator in the plan; unpinned ({cpus})")
+    return cpus
 
 
 def run_iperf(
     name: str, qemu_cmd: List[str], pin: bool, udp: bool = False, **kargs: Any
 ):
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    stop_converged: bool = kargs["config"].get("iperf_stop_converged", False)
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from network import run_iperf
 
-        if kargs["config"]["virtio_nic_vhost"]:
-            name += f"-vhost"
-        if kargs["config"]["virtio_nic_mq"]:
-            name += f"-mq"
-        if (
-            kargs["config"]["virtio_iommu"]
-            and "swiotlb" in kargs["config"]["extra_cmdline"]
-        ):
-            name += f"-swiotlb"
-        run_iperf(name, vm, udp=udp)
-
-        vm.shutdown()
+        name += nic_name_suffix(kargs["config"])
+        run_iperf(
+            name,
+            vm,
+            udp=udp,
+            stop_converged=stop_converged,
+            pin_cpus=client_cpus(kargs["config"]),
+        )
 
 
 def run_memtier(
     name: str, qemu_cmd: List[str], pin: bool, server: str = "redis", **kargs: Any
 ):
     tls: bool = kargs["config"].get("tls", False)
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from network import run_memtier
 
-        if kargs["config"]["virtio_nic_vhost"]:
-            name += f"-vhost"
-        if kargs["config"]["virtio_nic_mq"]:
-            name += f"-mq"
-        if (
-            kargs["config"]["virtio_iommu"]
-            and "swiotlb" in kargs["config"]["extra_cmdline"]
-        ):
-            name += f"-swiotlb"
-        run_memtier(name, vm, server=server, tls=tls)
-        vm.shutdown()
+        name += nic_name_suffix(kargs["config"])
+        run_memtier(
+            name, vm, server=server, tls=tls, pin_cpus=client_cpus(kargs["config"])
+        )
 
 
 def run_nginx(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any):
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from network import run_nginx
 
-        if kargs["config"]["virtio_nic_vhost"]:
-            name += f"-vhost"
-        if kargs["config"]["virtio_nic_mq"]:
-            name += f"-mq"
-        if (
-            kargs["config"]["virtio_iommu"]
-            and "swiotlb" in kargs["config"]["extra_cmdline"]
-        ):
-            name += f"-swiotlb"
-        run_nginx(name, vm)
-        vm.shutdown()
+        name += nic_name_suffix(kargs["config"])
+        run_nginx(name, vm, pin_cpus=client_cpus(kargs["config"]))
 
 
 def run_ping(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any):
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from network import run_ping
 
-        if kargs["config"]["virtio_nic_vhost"]:
-            name += f"-vhost"
-        if kargs["config"]["virtio_nic_mq"]:
-            name += f"-mq"
-        if (
-            kargs["config"]["virtio_iommu"]
-            and "swiotlb" in kargs["config"]["extra_cmdline"]
-        ):
-            name += f"-swiotlb"
-        run_ping(name, vm)
-        vm.shutdown()
+        name += nic_name_suffix(kargs["config"])
+        run_ping(name, vm, pin_cpus=client_cpus(kargs["config"]))
 
 
 def run_tensorflow(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
     repeat: int = kargs["config"].get("repeat", 1)
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    target_ci: Optional[float] = kargs["config"].get("repeat_ci")
+    max_repeat: int = kargs["config"].get("repeat_max", 20)
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from application import run_tensorflow
 
-        run_tensorflow(name, vm, repeat=repeat)
-        vm.shutdown()
+        run_tensorflow(
+            name, vm, repeat=repeat, target_ci=target_ci, max_repeat=max_repeat
+        )
 
 
 def run_pytorch(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
     repeat: int = kargs["config"].get("repeat", 1)
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    target_ci: Optional[float] = kargs["config"].get("repeat_ci")
+    max_repeat: int = kargs["config"].get("repeat_max", 20)
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from application import run_pytorch
 
-        run_pytorch(name, vm, repeat=repeat)
-        vm.shutdown()
+        run_pytorch(name, vm, repeat=repeat, target_ci=target_ci, max_repeat=max_repeat)
 
 
 def run_sqlite(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
-    resource: VMResource = kargs["config"]["resource"]
     virtio_blk: Optional[str] = kargs["config"]["virtio_blk"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
     dbpath: str = "/tmp/test.db"
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
-
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         if virtio_blk:
             import storage
 
             storage.mount_disk(vm, "/dev/vdb", "/mnt", format="auto")
             dbpath = "/mnt/test.db"
 
-            name += f"-{kargs['config']['virtio_blk_aio']}"
-            if not kargs["config"]["virtio_blk_direct"]:
-                name += f"-nodirect"
-            if not kargs["config"]["virtio_blk_iothread"]:
-                name += f"-noiothread"
-            if (
-                kargs["config"]["virtio_iommu"]
-                and "swiotlb" in kargs["config"]["extra_cmdline"]
-            ):
-                name += f"-swiotlb"
+            name += blk_name_suffix(kargs["config"])
 
         from application import run_sqlite
 
         run_sqlite(name, vm, dbpath)
-        vm.shutdown()
+
+
+def blockstats_interval(config: dict) -> Optional[float]:
+    """Sampling interval of --blockstats, or None if not sampled"""
+    if not config["blockstats"]:
+        return None
+    if config["virtio_blk_backend"] != "qemu":
+        # the export's block backend is not in query-blockstats
+        print("WARN: no block statistics of qemu-storage-daemon exports")
+        return None
+    return config["blockstats_interval"]
 
 
 def run_fio(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         import storage
 
-        name += f"-{kargs['config']['virtio_blk_aio']}"
-        if not kargs["config"]["virtio_blk_direct"]:
-            name += f"-nodirect"
-        if not kargs["config"]["virtio_blk_iothread"]:
-            name += f"-noiothread"
-        if (
-            kargs["config"]["virtio_iommu"]
-            and "swiotlb" in kargs["config"]["extra_cmdline"]
-        ):
-            name += f"-swiotlb"
-        fio_job = kargs["config"]["fio_job"]
-        storage.run_fio(name, vm, fio_job)
-        vm.shutdown()
+        name += blk_name_suffix(kargs["config"])
+        config = kargs["config"]
+        storage.run_fio(
+            name,
+            vm,
+            config["fio_job"],
+            blockstats_interval=blockstats_interval(config),
+        )
+
+
+def run_fio_sweep(name: str, qemu_cmd: List[str], pin: bool, **kargs: Any) -> None:
+    config = kargs["config"]
+    from fio_matrix import job_matrix
+
+    jobs = job_matrix(
+        config["fio_rw"],
+        config["fio_bs"],
+        config["fio_iodepth"],
+        config["fio_numjobs"],
+        config["fio_ioengine"],
+    )
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, config) as vm:
+        import storage
+
+        name += blk_name_suffix(config)
+        storage.run_fio_sweep(
+            name,
+            vm,
+            jobs,
+            runtime=config["fio_runtime"],
+            ramp_time=config["fio_ramp_time"],
+            blockstats_interval=blockstats_interval(config),
+        )
 
 
 def run_attestation_sev(
     name: str, qemu_cmd: List[str], pin: bool, **kargs: Any
 ) -> None:
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from attestation import run_attestation_sev
 
         run_attestation_sev(name, vm)
-        vm.shutdown()
 
 
 def run_attestation_tdx(
     name: str, qemu_cmd: List[str], pin: bool, **kargs: Any
 ) -> None:
-    resource: VMResource = kargs["config"]["resource"]
-    pin_base: int = kargs["config"].get("pin_base", resource.pin_base)
-    vm: QemuVM
-    with spawn_qemu(
-        qemu_cmd, numa_node=resource.numa_node, config=kargs["config"]
-    ) as vm:
-        if pin:
-            vm.pin_vcpu(pin_base)
-        vm.wait_for_ssh()
+    vm: QemuVm
+    with running_vm(qemu_cmd, pin, kargs["config"]) as vm:
         from attestation import run_attestation_tdx
 
         run_attestation_tdx(name, vm)
-        vm.shutdown()
 
 
 def do_action(action: str, **kwargs: Any) -> None:
@@ -1149,6 +1190,10 @@ def do_action(action: str, **kwargs: Any) -> None:
         run_sqlite(**kwargs)
     elif action == "run-fio":
         run_fio(**kwargs)
+    elif action == "run-fio-sweep":
+        run_fio_sweep(**kwargs)
+    elif action == "run-vmexit":
+        run_vmexit(**kwargs)
     elif action == "run-iperf":
         run_iperf(**kwargs)
     elif action == "run-iperf-udp":
@@ -1176,6 +1221,8 @@ def do_action(action: str, **kwargs: Any) -> None:
 # inv vm.start --type snp --size small
 # inv vm.start --type normal --no-direct
 # inv vm.start --type snp --action run-phoronix
+# inv vm.start --type snp --pool --action run-blender,run-tensorflow,run-pytorch
+# inv vm.start --type amd --snapshot --action run-mlc
 @task
 def start(
     ctx: Any,
@@ -1183,21 +1230,38 @@ def start(
     size: str = "medium",  # small, medium, large, numa
     hostname: str = None,  # by default use the local hostname
     direct: bool = True,  # if True, do direct boot. otherwise boot from the disk
-    action: str = "attach",
+    action: str = "attach",  # comma separated list of actions is executed in order
+    pool: bool = False,  # if True, reuse the booted VM for successive actions
+    snapshot: bool = False,  # if True, restore the VM from a saved state instead of booting
     ssh_port: int = SSH_PORT,
     guest_cid: int = 11,  # Guest CID for vsock (only for TDX)
     pin: bool = True,  # if True, pin vCPUs
     pin_base: Optional[int] = None,  # pinning base
+    pin_cpus: Optional[str] = None,  # host CPUs for the VM (cpulist, e.g., "8-15")
+    numa_node: Optional[int] = None,  # bind the VM to this host NUMA node
     extra_cmdline: str = "",  # extra kernel cmdline (only for direct boot)
     # ssh_cmd options
     ssh_cmd: [str] = [],
+    # collectors running during benchmark actions: perf, mpstat, vmstat, iostat
+    collect: [str] = [],
+    collect_interval: int = 1,  # sampling interval (seconds)
+    collect_guest: bool = True,  # also run collectors in the guest
+    vmexit_profile: bool = False,  # record VM exits of the QEMU process with bpftrace
     # boot eval options
     boot_trace: bool = True,
     boot_prealloc: bool = True,
+    # memory backend options (override the resource profile)
+    hugepages: Optional[str] = None,  # back guest memory with huge pages: 2M, 1G
+    hugetlbfs: Optional[str] = None,  # hugetlbfs mount for --hugepages (default: memfd)
+    prealloc_threads: Optional[int] = None,  # threads preallocating guest memory
+    memory_reserve: bool = True,  # if False, do not reserve swap space (reserve=off)
     # phoronix options
     phoronix_bench_name: Optional[str] = None,
     # application bench options
-    repeat: int = 1,
+    repeat: int = 1,  # number of runs (the minimum with --repeat-ci)
+    # repeat until the relative 95% CI is below this (e.g., 0.02)
+    repeat_ci: Optional[float] = None,
+    repeat_max: int = 20,  # maximum number of runs with --repeat-ci
     virtio_iommu: bool = False,  # enable VIRTIO_F_ACCESS_PLATFORM (VIRTIO_F_IOMMU_PLATFORM) feature bit
     # virtio-nic options
     virtio_nic: bool = False,
@@ -1212,8 +1276,23 @@ def start(
     virtio_blk_aio: str = "native",
     virtio_blk_direct: bool = True,
     virtio_blk_iothread: bool = True,
+    virtio_blk_iothreads: int = 1,  # iothreads serving the queues (QEMU 9.0+ if > 1)
+    virtio_blk_queues: Optional[int] = None,  # number of queues (default: vCPUs)
+    virtio_blk_backend: str = "qemu",  # qemu or vhost-user (qemu-storage-daemon)
+    blockstats: bool = False,  # sample QEMU's block statistics during run-fio
+    blockstats_interval: float = 1.0,  # sampling interval (seconds)
+    # network bench options
+    iperf_stop_converged: bool = False,  # stop iperf once the throughput is stable
     tls: bool = False,
     fio_job: str = "test",
+    # run-fio-sweep options (see fio_matrix.py; default: the DEFAULT_* lists)
+    fio_rw: [str] = [],
+    fio_bs: [str] = [],
+    fio_iodepth: [str] = [],
+    fio_numjobs: [str] = [],
+    fio_ioengine: [str] = [],
+    fio_runtime: int = 30,  # seconds per job
+    fio_ramp_time: int = 20,  # seconds per job before measuring
     warn: bool = True,
     name_extra: str = "",
 ) -> None:
@@ -1221,8 +1300,31 @@ def start(
         import socket
 
         hostname = socket.gethostname()
+    # invoke passes options without a typed default (None) as strings
+    if pin_base is not None:
+        pin_base = int(pin_base)
+    if numa_node is not None:
+        numa_node = int(numa_node)
+    if repeat_ci is not None:
+        repeat_ci = float(repeat_ci)
+    if prealloc_threads is not None:
+        prealloc_threads = int(prealloc_threads)
+    if virtio_blk_queues is not None:
+        virtio_blk_queues = int(virtio_blk_queues)
     config: dict = locals()
     resource: VMResource = get_vm_resource(hostname, size)
+    if numa_node is not None:
+        resource = replace(resource, numa_node=[numa_node])
+    if hugepages is not None:
+        resource = replace(resource, hugepages=hugepages, hugetlbfs=hugetlbfs)
+    elif hugetlbfs is not None:
+        if resource.hugepages is None:
+            raise ValueError("--hugetlbfs needs --hugepages (the huge page size)")
+        resource = replace(resource, hugetlbfs=hugetlbfs)
+    if prealloc_threads is not None:
+        resource = replace(resource, prealloc_threads=prealloc_threads)
+    if not memory_reserve:
+        resource = replace(resource, reserve=False)
     config["resource"] = resource
 
     if direct and (type == "intel-ubuntu" or type == "tdx-ubuntu"):
@@ -1277,16 +1379,286 @@ def start(
         elif not virtio_blk.is_file():
             print(f"{virtio_blk} is not a file nor a block device")
             return
-        qemu_cmd += qemu_option_virtio_blk(
-            virtio_blk,
-            virtio_blk_aio,
-            virtio_blk_direct,
-            virtio_blk_iothread,
-            virtio_iommu,
-        )
+        if virtio_blk_backend == "vhost-user":
+            import tempfile
+
+            from storage_daemon import (
+                check_vhost_user,
+                daemon_binary,
+                daemon_cmd,
+                qemu_option_vhost_user_blk,
+            )
+
+            check_vhost_user(type, virtio_iommu, virtio_blk_iothreads)
+            num_queues = virtio_blk_queues or resource.cpu
+            sock = f"vhost-user-blk-{os.getpid()}.sock"
+            socket = Path(tempfile.gettempdir()) / sock
+            config["storage_daemon_cmd"] = daemon_cmd(
+                daemon_binary(get_vm_config(type).qemu),
+                virtio_blk,
+                socket,
+                virtio_blk_aio,
+                virtio_blk_direct,
+                virtio_blk_iothread,
+                num_queues,
+            )
+            config["storage_daemon_socket"] = socket
+            qemu_cmd += qemu_option_vhost_user_blk(socket, num_queues)
+        elif virtio_blk_backend == "qemu":
+            qemu_cmd += qemu_option_virtio_blk(
+                virtio_blk,
+                virtio_blk_aio,
+                virtio_blk_direct,
+                virtio_blk_iothread,
+                virtio_iommu,
+                num_queues=virtio_blk_queues,
+                iothreads=virtio_blk_iothreads,
+            )
+        else:
+            raise ValueError(f"Unknown virtio-blk backend: {virtio_blk_backend}")
 
     if config["pin_base"] is None:
         config.pop("pin_base", None)
-    name = f"{type}-{'direct' if direct else 'disk'}-{size}" + name_extra
+    if pin:
+        from pinning import vm_plan
+
+        config["pin_plan"] = vm_plan(qemu_cmd, config)
+        print(config["pin_plan"].report())
+    name = get_vm_name(type, direct, size, name_extra)
+    config["name"] = name
     print(f"Starting VM: {name}")
-    do_action(action, qemu_cmd=qemu_cmd, pin=pin, name=name, config=config)
+    daemon: ContextManager[Any] = nullcontext()
+    if "storage_daemon_cmd" in config:
+        from storage_daemon import storage_daemon
+
+        plan = config.get("pin_plan")
+        daemon = storage_daemon(
+            config["storage_daemon_cmd"],
+            config["storage_daemon_socket"],
+            cpus=plan.iothreads if plan is not None else None,
+        )
+    with daemon:
+        for a in action.split(","):
+            config["current_action"] = a
+            do_action(a, qemu_cmd=qemu_cmd, pin=pin, name=name, config=config)
+
+
+# actions that use the host-side load generators (see network.py)
+NETWORK_ACTIONS = [
+    "run-iperf",
+    "run-iperf-udp",
+    "run-memtier",
+    "run-memtier-memcached",
+    "run-nginx",
+    "run-ping",
+]
+
+
+# examples:
+# inv vm.schedule --type amd --type snp --size small --action run-mlc
+# inv vm.schedule --type snp --size small --size medium --action run-blender --action run-pytorch --dry-run
+@task
+def schedule(
+    ctx: Any,
+    type: [str] = [],
+    size: [str] = [],
+    action: [str] = [],
+    hostname: str = None,  # by default use the local hostname
+    reserved_cpus: str = "",  # host CPUs not used for VMs (e.g., "0-7")
+    extra: str = "",  # extra options passed to every `inv vm.start`
+    dry_run: bool = False,
+) -> None:
+    """Run all combinations of types, sizes and actions, running VMs in parallel
+    as long as they fit into the host (see scheduler.py)"""
+    from scheduler import Allocator, Job, Scheduler
+    from topology import numa_nodes, parse_cpulist
+
+    if hostname is None:
+        import socket
+
+        hostname = socket.gethostname()
+    # the VMs use the resource profiles the jobs were sized with
+    args = shlex.split(extra) + ["--hostname", hostname]
+    uses_nic = "--virtio-nic" in args
+    uses_blk = "--virtio-blk" in args
+    iothreads = 0
+    if uses_blk and "--no-virtio-blk-iothread" not in args:
+        iothreads = 1
+        if "--virtio-blk-iothreads" in args:
+            iothreads = int(args[args.index("--virtio-blk-iothreads") + 1])
+    # host-wide collectors (e.g., perf -a) would see the other VMs
+    uses_collect = "--collect" in args
+
+    jobs = []
+    for t in type or ["amd"]:
+        for s in size or ["medium"]:
+            resource = get_vm_resource(hostname, s)
+            for a in action or ["run-mlc"]:
+                jobs.append(
+                    Job(
+                        type=t,
+                        size=s,
+                        action=a,
+                        cpu=resource.cpu,
+                        memory=resource.memory,
+                        numa_node=resource.numa_node or [0],
+                        args=args,
+                        extra_pcpus=iothreads,
+                        exclusive=len(resource.numa_node or [0]) > 1
+                        or uses_nic
+                        or uses_blk
+                        or uses_collect
+                        or a in NETWORK_ACTIONS,
+                    )
+                )
+
+    allocator = Allocator(numa_nodes(), set(parse_cpulist(reserved_cpus)))
+    results = Scheduler(jobs, allocator, dry_run=dry_run).run()
+    failed = [job.name for job, ret in zip(jobs, results) if ret != 0]
+    print(f"{len(results) - len(failed)}/{len(results)} jobs succeeded")
+    if failed:
+        print(f"failed: {', '.join(failed)}")
+
+
+# examples:
+# inv vm.boot-sweep --type amd --type snp --repeat 10 --reserved-cpus 0-7
+# inv vm.boot-sweep --type snp --size boot-mem8 --size boot-mem256 --dry-run
+# inv vm.boot-sweep --type snp --extra "--no-boot-prealloc --name-extra -no-prealloc"
+@task
+def boot_sweep(
+    ctx: Any,
+    type: [str] = [],
+    size: [str] = [],  # default: all boot-* resource profiles of the host
+    hostname: str = None,  # by default use the local hostname
+    repeat: int = 10,  # boots per profile
+    control: int = 3,  # boots per profile alone for the serial control (0: none)
+    reserved_cpus: str = "",  # host CPUs not used for VMs (e.g., "0-7")
+    extra: str = "",  # extra options passed to every `inv vm.start`
+    alpha: float = 0.05,  # significance level of the perturbation check
+    threshold: float = 5.0,  # perturbed if the boot time differs by more than this [%]
+    dry_run: bool = False,
+) -> None:
+    """Measure the boot time of all boot-* profiles (see plot_boottime), booting
+    VMs in parallel as long as they fit into the host (see scheduler.py).
+    Each profile that ran next to others is then booted `control` times alone
+    ({name}-serial), and profiles whose results differ from the serial control
+    are reported as perturbed by the concurrency."""
+    import pandas as pd
+
+    from boottime import perturbation
+    from matrix import RESULT_DIR
+    from scheduler import Allocator, Job, Scheduler
+    from topology import numa_nodes, parse_cpulist
+
+    if hostname is None:
+        import socket
+
+        hostname = socket.gethostname()
+    sizes = size or [s for s in VMRESOURCES[hostname] if s.startswith("boot-")]
+    args = shlex.split(extra)
+    name_extra = ""
+    if "--name-extra" in args:
+        i = args.index("--name-extra")
+        name_extra = args[i + 1]
+        del args[i : i + 2]
+
+    named = ["--name-extra", name_extra] if name_extra else []
+    # the VMs use the resource profiles the jobs were sized with
+    args += ["--hostname", hostname]
+    allocator = Allocator(numa_nodes(), set(parse_cpulist(reserved_cpus)))
+    jobs, controls = [], []
+    # the parallel job of each control
+    parallels: List[Any] = []
+    for t in type or ["amd"]:
+        for s in sizes:
+            resource = get_vm_resource(hostname, s)
+            job = Job(
+                type=t,
+                size=s,
+                action="boottime",
+                cpu=resource.cpu,
+                memory=resource.memory,
+                numa_node=resource.numa_node or [0],
+                args=args + ["--repeat", str(repeat)] + named,
+            )
+            job.exclusive = len(job.numa_node) > 1 or not allocator.fits_empty_host(job)
+            jobs.append(job)
+            if control > 0 and not job.exclusive:
+                serial = ["--repeat", str(control)]
+                serial += ["--name-extra", f"{name_extra}-serial"]
+                controls.append(
+                    replace(job, args=args + serial, exclusive=True, suffix="-serial")
+                )
+                parallels.append(job)
+
+    # exclusive jobs run alone in order: run them (and the controls) last, so
+    # that they do not hold back the parallel jobs
+    jobs.sort(key=lambda j: j.exclusive)
+    all_jobs = jobs + controls
+    scheduler = Scheduler(all_jobs, allocator, dry_run=dry_run)
+    results = scheduler.run()
+    failed = [job.name for job, ret in zip(all_jobs, results) if ret != 0]
+    print(f"{len(results) - len(failed)}/{len(results)} jobs succeeded")
+    if failed:
+        print(f"failed: {', '.join(failed)}")
+    if dry_run:
+        return
+
+    reports = []
+    for i, (job, parallel) in enumerate(zip(controls, parallels)):
+        parallel_index = next(j for j, other in enumerate(jobs) if other is parallel)
+        if results[len(jobs) + i] != 0 or results[parallel_index] != 0:
+            continue
+        name = get_vm_name(job.type, True, job.size, name_extra)
+        df = perturbation(name, f"{name}-serial", RESULT_DIR, alpha, threshold)
+        reports.append(df.assign(name=name))
+    if not reports:
+        return
+    report = pd.concat(reports, ignore_index=True)
+    columns = ["name", "metric", "n_base", "n_target", "median_base"]
+    columns += ["median_target", "overhead", "p_value", "perturbed"]
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(report[columns].to_string(index=False, float_format="{:.4g}".format))
+    perturbed = sorted(report[report["perturbed"]]["name"].unique())
+    if perturbed:
+        print(f"WARN: concurrency perturbed the boot time of: {', '.join(perturbed)}")
+    else:
+        print("No profile was perturbed by the concurrency")
+    path = scheduler.logdir / "perturbation.csv"
+    report.to_csv(path, index=False)
+    print(f"Saved {path}")
+
+
+# examples:
+# inv vm.experiment experiment/network.toml
+# inv vm.experiment experiment/network.toml --dry-run
+@task
+def experiment(
+    ctx: Any,
+    file: str,
+    state: Optional[str] = None,  # default: bench-result/experiment/{file stem}.json
+    dry_run: bool = False,
+) -> None:
+    """Run the experiment matrix described in `file` (see matrix.py).
+    Interrupted experiments are resumed by running the same command again."""
+    import inspect
+
+    from matrix import RESULT_DIR, State, load_experiment, run_experiment
+
+    params = inspect.signature(start.body).parameters
+    defaults = {k: p.default for k, p in params.items() if k != "ctx"}
+    jobs = load_experiment(Path(file), list(defaults))
+    state_path = Path(state or RESULT_DIR / f"experiment/{Path(file).stem}.json")
+
+    def job_config(options: dict) -> dict:
+        config = {**defaults, "warn": False, **options}
+        config["name"] = get_vm_name(
+            config["type"], config["direct"], config["size"], config["name_extra"]
+        )
+        return config
+
+    def run_job(options: dict) -> None:
+        start(ctx, **{"warn": False, **options})
+
+    print(f"{len(jobs)} jobs, state: {state_path}")
+    run_experiment(jobs, State(state_path), run_job, job_config, dry_run=dry_run)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""VMEXIT microbenchmark (benchmarks/vmexit/bench) in the guest
+(inv vm.start --action run-vmexit --repeat N).
+
+Each run loads the kernel module, which benchmarks the operations in its init
+function, and saves its kernel messages as
+./bench-result/vmexit/{name}/{date}/{i}.txt. Per operation the module prints
+the average over all calls and a histogram of per-call latencies:
+
+    bench: _cpuid_0, total_cycle 273468339, avg_cycle 2734, total_time 101286422, avg_time 1012
+    bench: _cpuid_0, samples 100000, overhead 30, min_cycle 2600, max_cycle 90000, tsc_khz 2400000
+    bench: _cpuid_0, hist 2560 3072 99000
+
+Histogram buckets are [low, high) in TSC cycles and are converted to ns with
+tsc_khz. Histograms of repeated runs are merged for percentiles.
+"""
+
+import re
+import subprocess
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+import histogram
+from config import PROJECT_ROOT
+from qemu import QemuVm
+
+GUEST_MODULE = "/share/benchmarks/vmexit/bench/bench.ko"
+RESULT_DIR = PROJECT_ROOT / "bench-result" / "vmexit"
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+SUMMARY = re.compile(
+    r"bench: (\w+), total_cycle (\d+), avg_cycle (\d+), "
+    r"total_time (-?\d+), avg_time (-?\d+)"
+)
+SAMPLES = re.compile(
+    r"bench: (\w+), samples (\d+), overhead (\d+), "
+    r"min_cycle (\d+), max_cycle (\d+), tsc_khz (\d+)"
+)
+HIST = re.compile(r"bench: (\w+), hist (\d+) (\d+) (\d+)")
+
+
+@dataclass
+class OpResult:
+    avg_cycle: int
+    avg_time: int  # ns
+    samples: int = 0
+    min_cycle: Optional[int] = None
+    max_cycle: Optional[int] = None
+    tsc_khz: Optional[int] = None
+    hist: List[Tuple[int, int, int]] = field(default_factory=list)  # cycles
+
+    def cycles_to_ns(self, cycles: float) -> float:
+        if self.tsc_khz:
+            return cycles * 1e6 / self.tsc_khz
+        # modules without the histogram: use the ratio of the averages
+        return cycles * self.avg_time / self.avg_cycle
+
+
+def last_run(lines: Sequence[str]) -> List[str]:
+    """Return the messages of the last module load of a kernel log"""
+    start = None
+    for i, line in enumerate(lines):
+        if "bench: Initializing" in line:
+            start = i
+    if start is None:
+        raise ValueError("no 'bench: Initializing' message")
+    run = []
+    for line in lines[start:]:
+        run.append(line)
+        if "bench: done" in line:
+            break
+    return run
+
+
+def parse_result(lines: Sequence[str]) -> Dict[str, OpResult]:
+    """Parse the last run of a kernel log into per-operation results"""
+    results: Dict[str, OpResult] = {}
+    for line in last_run(lines):
+        m = SUMMARY.search(line)
+        if m:
+            results[m.group(1)] = OpResult(
+                avg_cycle=int(m.group(3)), avg_time=int(m.group(5))
+            )
+            continue
+        m = SAMPLES.search(line)
+        if m and m.group(1) in results:
+            r = results[m.group(1)]
+            r.samples = int(m.group(2))
+            r.min_cycle, r.max_cycle = int(m.group(4)), int(m.group(5))
+            r.tsc_khz = int(m.group(6))
+            continue
+        m = HIST.search(line)
+        if m and m.group(1) in results:
+            low, high, count = (int(g) for g in m.groups()[1:])
+            results[m.group(1)].hist.append((low, high, count))
+    return results
+
+
+def result_files(name: str, result_dir: Path = RESULT_DIR) -> List[Path]:
+    """{name}/{date}/{i}.txt of all runs, or the single {name}.txt of results
+    saved by hand (see benchmarks/vmexit/README.md)"""
+    files = sorted((result_dir / name).glob("*/*.txt"))
+    legacy = result_dir / f"{name}.txt"
+    if not files and legacy.exists():
+        files = [legacy]
+    if not files:
+        raise FileNotFoundError(f"No vmexit results of {name} in {result_dir}")
+    return files
+
+
+def load_runs(name: str, result_dir: Path = RESULT_DIR) -> Dict[str, List[OpResult]]:
+    """Results of all runs of `name` per operation"""
+    return load_files(result_files(name, result_dir))
+
+
+def load_files(files: List[Path]) -> Dict[str, List[OpResult]]:
+    """Results of the runs in `files` per operation"""
+    runs: Dict[str, List[OpResult]] = {}
+    for file in files:
+        with open(file) as f:
+            for op, r in parse_result(f.readlines()).items():
+                runs.setdefault(op, []).append(r)
+    return runs
+
+
+def merged_hist(results: List[OpResult]) -> pd.DataFrame:
+    """Sum of the histograms of runs with buckets [low_ns, high_ns)"""
+    rows = [
+        dict(low_ns=r.cycles_to_ns(low), high_ns=r.cycles_to_ns(high), count=count)
+        for r in results
+        for low, high, count in r.hist
+    ]
+    if not rows:
+        return pd.DataFrame(columns=["low_ns", "high_ns", "count"])
+    # runs may differ in tsc_khz slightly; merge by the rounded bounds
+    df = pd.DataFrame(rows).round({"low_ns": 1, "high_ns": 1})
+    return df.groupby(["low_ns", "high_ns"], as_index=False)["count"].sum()
+
+
+def hist_percentiles(hist: pd.DataFrame, percentiles: Sequence[float]) -> np.ndarray:
+    """Percentiles of a histogram of merged_hist()"""
+    hist = hist.sort_values("low_ns")
+    low, high, counts = hist["low_ns"], hist["high_ns"], hist["count"]
+    return histogram.percentiles(low, high, counts, percentiles)
+
+
+def summarize(
+    runs: Dict[str, List[OpResult]], percentiles: Sequence[float] = PERCENTILES
+) -> pd.DataFrame:
+    """Per operation: the mean and std of avg_time over runs and percentiles,
+    min and max [ns] of the per-call latencies of all runs"""
+    rows = []
+    for op, results in runs.items():
+        avg = np.array([r.avg_time for r in results], dtype=float)
+        ps = hist_percentiles(merged_hist(results), percentiles)
+        mins = [r.cycles_to_ns(r.min_cycle) for r in results if r.min_cycle is not None]
+        maxs = [r.cycles_to_ns(r.max_cycle) for r in results if r.max_cycle is not None]
+        row = dict(
+            op=op,
+            runs=len(results),
+            avg_time=avg.mean(),
+            avg_time_std=avg.std(ddof=1) if len(avg) > 1 else np.nan,
+            min=min(mins, default=np.nan),
+        )
+        row.update({f"p{p:g}": v for p, v in zip(percentiles, ps)})
+        row["max"] = max(maxs, default=np.nan)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def run_vmexit(
+    name: str, vm: QemuVm, repeat: int = 1, mode: int = 0, module: str = GUEST_MODULE
+) -> None:
+    """Load the benchmark module `repeat` times. mode: 0=all, 1=cpuid, 2=msr,
+    3=hypercall, 4=pio. The module must be built for the guest kernel (and
+    with SNP or TDX defined for the CVM variants)."""
+    from repetition import repeat_runs
+
+    date = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    outputdir = RESULT_DIR / name / date
+    outputdir.mkdir(parents=True, exist_ok=True)
+    # in case the module is still loaded from a manual run
+    vm.ssh_cmd(["rmmod", "bench"], check=False, stderr=subprocess.DEVNULL)
+
+    def run(i: int) -> Optional[float]:
+        vm.ssh_cmd(["insmod", module, f"mode={mode}"])
+        vm.ssh_cmd(["rmmod", "bench"])
+        lines = vm.ssh_cmd(["dmesg"], verbose=False).stdout.splitlines(keepends=True)
+        outfile = outputdir / f"{i}.txt"
+        with open(outfile, "w") as f:
+            f.writelines(last_run(lines))
+        print(f"[vmexit] run {i}: saved {outfile}")
+        return None
+
+    repeat_runs(run, repeat)
+    # only the runs just taken, not those of earlier dates
+    df = summarize(load_files(sorted(outputdir.glob("*.txt"))))
+    with pd.option_context("display.width", 200):
+        print(df.to_string(index=False, float_format="{:.0f}".format))
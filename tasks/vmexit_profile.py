@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""VM-exit profile of a benchmark run (inv vm.start --vmexit-profile,
+see collect.py for where it is saved).
+
+The latency script of scripts/trace/ for the VM type runs with bpftrace while
+the benchmark action runs, filtered by the QEMU PID. When it is stopped,
+bpftrace prints the stats() and hist() maps per exit reason, which are saved as
+JSON:
+
+    {
+      "type": "snp", "qemu_pid": 1234, "script": "amd_kvm_vmexit_latency.bt",
+      "exit": {"HLT": {"count": 10, "average_ns": 2000, "total_ns": 20000,
+                       "hist": [[1024, 2048, 3], [2048, 4096, 7]]}, ...},
+      "vmgexit": {...}  # SEV-ES/SNP only
+    }
+
+"hist" is a list of [low, high, count] buckets in ns (high is exclusive).
+"""
+
+import json
+import re
+import signal
+import subprocess
+import time
+from pathlib import Path
+from typing import Any, Dict, IO, List, Optional
+
+from config import PROJECT_ROOT
+
+SCRIPT_DIR = PROJECT_ROOT / "scripts" / "trace"
+
+SCRIPTS = {
+    "amd": "amd_kvm_vmexit_latency.bt",
+    "snp": "amd_kvm_vmexit_latency.bt",
+    "intel": "intel_kvm_vmexit_latency.bt",
+    "intel-ubuntu": "intel_kvm_vmexit_latency.bt",
+    "tdx": "intel_kvm_vmexit_latency.bt",
+    "tdx-ubuntu": "intel_kvm_vmexit_latency.bt",
+}
+
+# bpftrace map name -> section of the profile
+MAPS = {"s": "exit", "h": "exit", "vmgexit_s": "vmgexit", "vmgexit_h": "vmgexit"}
+
+# @s[HLT]: count 10, average 2000, total 20000
+STATS = re.compile(r"^@(\w+)\[(.*)\]: count (\d+), average (\d+), total (\d+)$")
+# @h[HLT]:
+HIST = re.compile(r"^@(\w+)\[(.*)\]:$")
+# [1K, 2K)    3 |@@@@    |   or   [0]    1 |@   |
+BUCKET = re.compile(r"^\[([^,\]]+)(?:,\s*([^)]+))?[)\]]\s+(\d+)\s*\|")
+UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(s: str) -> int:
+    m = re.fullmatch(r"(\d+)([KMGT]?)", s.strip())
+    if m is None:
+        raise ValueError(f"invalid hist bound: {s}")
+    return int(m.group(1)) * UNITS[m.group(2)]
+
+
+def parse_output(lines: List[str]) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """Parse the maps printed by the END block of the latency scripts"""
+    result: Dict[str, Dict[str, Dict[str, Any]]] = {"exit": {}, "vmgexit": {}}
+    hist: Optional[List[List[int]]] = None
+    for line in lines:
+        line = line.rstrip()
+        m = STATS.match(line)
+        if m and m.group(1) in MAPS:
+            section = MAPS[m.group(1)]
+            entry = result[section].setdefault(m.group(2), {})
+            entry.update(
+                count=int(m.group(3)),
+                average_ns=int(m.group(4)),
+                total_ns=int(m.group(5)),
+            )
+            hist = None
+            continue
+        m = HIST.match(line)
+        if m and m.group(1) in MAPS:
+            section = MAPS[m.group(1)]
+            hist = result[section].setdefault(m.group(2), {}).setdefault("hist", [])
+            continue
+        m = BUCKET.match(line)
+        if m and hist is not None:
+            low = parse_size(m.group(1))
+            # "[N]" is a bucket of the single value N
+            high = parse_size(m.group(2)) if m.group(2) else low + 1
+            hist.append([low, high, int(m.group(3))])
+            continue
+        if not line:
+            hist = None
+    return result
+
+
+class VmexitProfiler:
+    def __init__(self, type: str, qemu_pid: int, output: Path) -> None:
+        if type not in SCRIPTS:
+            raise ValueError(f"No vmexit profile for VM type {type}")
+        self.type = type
+        self.qemu_pid = qemu_pid
+        self.script = SCRIPTS[type]
+        self.output = output  # raw bpftrace output
+        self.proc: Optional[subprocess.Popen] = None
+        self.out: Optional[IO[str]] = None
+
+    def start(self, timeout: float = 60) -> None:
+        """Start bpftrace and wait until its probes are attached"""
+        self.output.parent.mkdir(parents=True, exist_ok=True)
+        self.out = open(self.output, "w")
+        self.proc = subprocess.Popen(
+            ["bpftrace", str(SCRIPT_DIR / self.script), str(self.qemu_pid)],
+            stdout=self.out,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + timeout
+        while "Attaching" not in self.output.read_text():
+            if self.proc.poll() is not None:
+                self.out.close()
+                raise RuntimeError(f"bpftrace failed: {self.output.read_text()}")
+            if time.monotonic() > deadline:
+                self.proc.kill()
+                self.proc.wait()
+                self.out.close()
+                raise TimeoutError("bpftrace did not attach its probes")
+            time.sleep(0.1)
+
+    def stop(self, timeout: float = 60) -> Dict[str, Any]:
+        """Stop bpftrace (which prints the maps) and return the profile"""
+        assert self.proc is not None and self.out is not None
+        self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+        self.out.close()
+        with open(self.output) as f:
+            profile = parse_output(f.readlines())
+        return dict(
+            type=self.type, qemu_pid=self.qemu_pid, script=self.script, **profile
+        )
+
+
+def save_profile(profile: Dict[str, Any], path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(profile, f, indent=2)
+    print(f"[vmexit] saved {path}")